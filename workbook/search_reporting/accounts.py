@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import json
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AccountHierarchy:
+    def __init__(
+        self,
+        cache_path=None,
+        ttl_hours=24,
+        workers=4,
+        request_scheduler=None,
+        page_size=500,
+        max_age_hours=168,
+    ):
+
+        self.cache_path = cache_path
+        self.ttl = datetime.timedelta(hours=ttl_hours)
+        self.max_age = datetime.timedelta(hours=max_age_hours)
+        self.workers = workers
+        self.requests = request_scheduler
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+
+    def get_accounts(self, adw_client, account, refresh=False):
+
+        mcc = int(str(account).replace('-', ''))
+        tree = self.cache.get(str(mcc))
+
+        ### A recent tree is used as is. An older one is kept as long as the
+        ### number of customers under the MCC did not change, which misses an
+        ### account added while another was removed: past max_age, the tree
+        ### is always crawled again.
+        if tree is not None and not refresh:
+            now = datetime.datetime.now()
+            age = now - self.parse_time(tree['fetched'])
+            checked = now - self.parse_time(tree.get('checked', tree['fetched']))
+            if age >= self.max_age:
+                logging.info("Account hierarchy older than its maximum age")
+                tree = None
+            elif checked >= self.ttl:
+                total = self.get_page(adw_client, mcc, 0, 1)['totalNumEntries']
+                if int(total) == tree['total']:
+                    logging.info("Account hierarchy count unchanged, cache kept")
+                    tree['checked'] = now.strftime("%Y-%m-%dT%H:%M:%S")
+                    self.save_cache(mcc, tree)
+                else:
+                    tree = None
+            else:
+                logging.info("Account hierarchy read from cache")
+        else:
+            tree = None
+
+        if tree is None:
+            tree = self.crawl(adw_client, mcc)
+            self.save_tree(mcc, tree)
+
+        return self.get_leaves(tree, mcc)
+
+    def get_page(self, adw_client, mcc, offset, page_size):
+
+        managed_customer_service = adw_client.GetService(
+            'ManagedCustomerService', version='v201809'
+        )
+        selector = {
+            'fields': ['CustomerId', 'Name', 'CanManageClients'],
+            'paging': {'startIndex': str(offset), 'numberResults': str(page_size)},
+        }
+        if self.requests is None:
+            return managed_customer_service.get(selector)
+        return self.requests.call(mcc, managed_customer_service.get, selector)
+
+    def crawl(self, adw_client, mcc):
+
+        ### The first page gives the number of entries, the next ones are
+        ### fetched in parallel
+        first_page = self.get_page(adw_client, mcc, 0, self.page_size)
+        total = int(first_page['totalNumEntries'])
+        offsets = range(self.page_size, total, self.page_size)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pages = [first_page] + list(
+                executor.map(
+                    lambda offset: self.get_page(
+                        adw_client, mcc, offset, self.page_size
+                    ),
+                    offsets,
+                )
+            )
+
+        ### Keep every customer and every manager-to-child link
+        tree = {'total': total, 'managers': [], 'links': {}}
+        for page in pages:
+            entries = (page['entries'] if 'entries' in page else None) or []
+            links = (page['links'] if 'links' in page else None) or []
+            for entry in entries:
+                if entry['canManageClients']:
+                    tree['managers'].append(str(entry['customerId']))
+            for link in links:
+                children = tree['links'].setdefault(str(link['managerCustomerId']), [])
+                children.append(str(link['clientCustomerId']))
+        logging.info(
+            "Account hierarchy crawled: {} customers in {} page(s)".format(
+                total, len(pages)
+            )
+        )
+        return tree
+
+    def get_leaves(self, tree, mcc):
+
+        ### Walk nested managers down to the client accounts
+        if str(mcc) not in tree['links']:
+            return [mcc]
+        leaves = []
+        seen = set()
+        managers = set(tree['managers'])
+        to_visit = [str(mcc)]
+        while to_visit:
+            manager = to_visit.pop()
+            for child in tree['links'].get(manager, []):
+                if child in seen:
+                    continue
+                seen.add(child)
+                if child in managers or child in tree['links']:
+                    to_visit.append(child)
+                else:
+                    leaves.append(int(child))
+        return sorted(leaves)
+
+    def parse_time(self, value):
+
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+    def save_tree(self, mcc, tree):
+
+        ### Time of the crawl, and of the last count check
+        tree['fetched'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        tree['checked'] = tree['fetched']
+        self.save_cache(mcc, tree)
+
+    def save_cache(self, mcc, tree):
+
+        with self.lock:
+            self.cache[str(mcc)] = tree
+            if not self.cache_path:
+                return
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.cache, f)
+            os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+### Import Python libraries
+import argparse
+import logging
+import os
+import json
+import time
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+
+### Load project modules
+import bq_create_tables
+import buffers
+import connections
+import fakes
+import launcher
+
+STAGES = ['snowflake', 'adwords', 'join', 'export']
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, interval=0.05):
+
+        ### Resident memory sampled in the background, to get the peak of
+        ### each stage and not only the peak of the whole process
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.running = True
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def rss_mb(self):
+
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self.page_size / 1024 ** 2
+        except OSError:
+            return buffers.peak_memory_mb()
+
+    def run(self):
+
+        while self.running:
+            self.samples.append((time.monotonic(), self.rss_mb()))
+            time.sleep(self.interval)
+
+    def stop(self):
+
+        self.running = False
+        self.join()
+
+    def peak(self, start, end):
+
+        samples = [rss for t, rss in self.samples if start <= t <= end]
+        return round(max(samples or [self.rss_mb()]), 1)
+
+
+def git_revision():
+
+    ### Results are only comparable between known commits
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, text=True
+        ).strip()
+        dirty = bool(
+            subprocess.check_output(
+                ['git', 'status', '--porcelain', '--', '.'], cwd=directory, text=True
+            ).strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return revision, dirty
+
+
+def install_fakes(data, latency, stage=None, max_report_days=None):
+
+    ### Every connection of the launcher returns an in-process fake
+    bq_client = fakes.FakeBigQueryClient(data, latency)
+    gs_client = fakes.FakeStorageClient(latency)
+    connections.bigquery_connection = lambda: bq_client
+    connections.bigquery_write_connection = lambda: fakes.FakeBigQueryWriteClient(
+        bq_client, latency
+    )
+    connections.storage_connection = lambda: gs_client
+    connections.adwords_api_connection = lambda yaml_file: fakes.FakeAdwordsClient(
+        data, latency, max_report_days
+    )
+    connections.snowflake_connection = lambda *args: fakes.FakeSnowflakeConnection(
+        data, latency, stage
+    )
+
+    ### Results are read from the fake jobs, never through the Storage Read API
+    connections.ClientPool.bigquery_read = lambda self: None
+    return bq_client, gs_client
+
+
+def stage_results(stages, sampler, report):
+
+    ### Wall time and peak memory of each stage, volumes from the run report
+    results = {}
+    for name in STAGES:
+        if name not in stages.spans:
+            continue
+        start, end = stages.spans[name]
+        operations = [o for o in report['operations'] if o['stage'] == name]
+        rows = sum(
+            o['rows']
+            for o in operations
+            if o['operation'] not in ('bq_load', 'bq_stream')
+        )
+        nb_bytes = sum(o['bytes_in'] + o['bytes_out'] for o in operations)
+        seconds = end - start
+        results[name] = {
+            'seconds': round(seconds, 3),
+            'peak_rss_mb': sampler.peak(start, end),
+            'rows': rows,
+            'bytes': nb_bytes,
+            'rows_per_second': round(rows / seconds) if seconds else None,
+            'mb_per_second': round(nb_bytes / 1024 ** 2 / seconds, 2)
+            if seconds
+            else None,
+            'failed': name in stages.failed + stages.blocked,
+        }
+    return results
+
+
+def compare(results, baseline_path):
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline['scale'] != results['scale']:
+        logging.warning(
+            "Baseline was run at another scale: {}".format(baseline['scale'])
+        )
+    print(
+        "Compared to {} ({}):".format(baseline_path, baseline.get('revision'))
+    )
+    for name, stage in results['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            continue
+        deltas = []
+        for key in ['seconds', 'peak_rss_mb', 'rows_per_second']:
+            if before.get(key) and stage.get(key) is not None:
+                deltas.append(
+                    '{} {:+.1f}%'.format(key, 100 * (stage[key] / before[key] - 1))
+                )
+        print("  {:<10} {}".format(name, ', '.join(deltas)))
+
+
+def main(
+    accounts=10,
+    days=7,
+    clicks=1000,
+    keywords=200,
+    conversions=50000,
+    latency_ms=0,
+    workers=4,
+    load_mode='append',
+    export_reader='arrow',
+    join_backend='bigquery',
+    gclid_mode='raw',
+    snow_transfer='stream',
+    adperf_chunk_rows=200000,
+    adperf_timeout_days=None,
+    stream_max_mb=0,
+    out_path='benchmark.json',
+    baseline_path=None,
+    seed=42,
+):
+
+    ### Same scale and seed, same data
+    data = fakes.SyntheticData(accounts, days, clicks, keywords, conversions, seed=seed)
+    date_from, date_until = str(data.dates[0]), str(data.dates[-1])
+    bq_dataset = 'benchmark'
+
+    ### Caches, reports and unloaded files stay in a temporary directory
+    sampler = MemorySampler()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stage = fakes.FilesystemStage(os.path.join(tmp_dir, 'stage'))
+        bq_client, gs_client = install_fakes(
+            data, latency_ms / 1000, stage, adperf_timeout_days
+        )
+        dataset_ref = bq_client.dataset(bq_dataset)
+        for create_table in [
+            bq_create_tables.create_table_gclid,
+            bq_create_tables.create_table_adperf,
+            bq_create_tables.create_table_kwnames,
+            bq_create_tables.create_table_final,
+            bq_create_tables.create_table_snow,
+        ]:
+            create_table(bq_client, dataset_ref)
+
+        snow_yaml = os.path.join(tmp_dir, 'snowflake.yaml')
+        with open(snow_yaml, 'w') as f:
+            f.write("sf_account: fake\nsf_user: fake\nsf_password: fake\n")
+        metrics_json = os.path.join(tmp_dir, 'run_report.json')
+
+        sampler.start()
+        start = time.monotonic()
+        stages = launcher.main(
+            str(data.mcc),
+            date_from,
+            date_until,
+            bq_dataset,
+            os.path.join(tmp_dir, 'googleads.yaml'),
+            snow_yaml,
+            workers=workers,
+            load_mode=load_mode,
+            manifest_path=os.path.join(tmp_dir, 'run_manifest.json'),
+            adw_rate=1000000,
+            adw_account_rate=1000000,
+            kw_cache_path=os.path.join(tmp_dir, 'kw_names_cache.json'),
+            accounts_cache_path=os.path.join(tmp_dir, 'accounts_cache.json'),
+            metrics_json=metrics_json,
+            query_cache_path=os.path.join(tmp_dir, 'query_cache.json'),
+            export_reader=export_reader,
+            join_backend=join_backend,
+            local_dir=os.path.join(tmp_dir, 'local_tables'),
+            gclid_mode=gclid_mode,
+            gclid_filter_path=os.path.join(tmp_dir, 'gclid_filter.bin'),
+            snow_transfer=snow_transfer,
+            snow_stage=stage.name,
+            snow_stage_url=stage.url,
+            adperf_chunk_rows=adperf_chunk_rows,
+            adperf_volumes_path=os.path.join(tmp_dir, 'adperf_volumes.json'),
+            stream_max_mb=stream_max_mb,
+        )
+        seconds = time.monotonic() - start
+        sampler.stop()
+        with open(metrics_json) as f:
+            report = json.load(f)
+
+    revision, dirty = git_revision()
+    results = {
+        'revision': revision,
+        'dirty': dirty,
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'scale': {
+            'accounts': accounts,
+            'days': days,
+            'clicks': clicks,
+            'keywords': keywords,
+            'conversions': conversions,
+            'latency_ms': latency_ms,
+            'workers': workers,
+            'load_mode': load_mode,
+            'export_reader': export_reader,
+            'join_backend': join_backend,
+            'gclid_mode': gclid_mode,
+            'snow_transfer': snow_transfer,
+            'adperf_chunk_rows': adperf_chunk_rows,
+            'adperf_timeout_days': adperf_timeout_days,
+            'stream_max_mb': stream_max_mb,
+            'seed': seed,
+        },
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': sampler.peak(0, float('inf')),
+        'stages': stage_results(stages, sampler, report),
+        'startup': {
+            '{} {}'.format(t['operation'], t['component']): round(t['seconds'], 3)
+            for t in report['startup']
+        },
+        'uploaded_bytes': sum(
+            blob.size
+            for bucket in gs_client.buckets.values()
+            for blob in bucket.blobs.values()
+        ),
+    }
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    print("Run took {:.2f}s, peak memory {} MB".format(seconds, results['peak_rss_mb']))
+    for name, stage in results['stages'].items():
+        print(
+            "  {:<10} {:>8.2f}s {:>8.1f} MB {:>10} rows/s {:>8} MB/s".format(
+                name,
+                stage['seconds'],
+                stage['peak_rss_mb'],
+                stage['rows_per_second'],
+                stage['mb_per_second'],
+            )
+        )
+    logging.info("Benchmark results written to '{}'".format(out_path))
+    if baseline_path:
+        compare(results, baseline_path)
+    return results
+
+
+if __name__ == "__main__":
+
+    ### Define logging level, the launcher logs are too verbose for a benchmark
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(filename)s - %(message)s',
+        level=logging.WARNING,
+    )
+
+    ### Parse arguments
+    parser = argparse.ArgumentParser(
+        description="Run the whole launcher offline against in-process fakes"
+    )
+    parser.add_argument(
+        '--accounts', default=10, type=int, help="Number of Adwords client accounts"
+    )
+    parser.add_argument(
+        '--days', default=7, type=int, help="Number of days in the period"
+    )
+    parser.add_argument(
+        '--clicks',
+        default=1000,
+        type=int,
+        help="Clicks per account and per day in the click performance reports",
+    )
+    parser.add_argument(
+        '--keywords', default=200, type=int, help="Keywords per account"
+    )
+    parser.add_argument(
+        '--conversions',
+        default=50000,
+        type=int,
+        help="Conversions returned by Snowflake",
+    )
+    parser.add_argument(
+        '--latency-ms',
+        dest='latency_ms',
+        default=0,
+        type=float,
+        help="Average latency added to every call to a fake service",
+    )
+    parser.add_argument(
+        '--workers',
+        default=4,
+        type=int,
+        help="Number of Adwords reports downloaded concurrently",
+    )
+    parser.add_argument(
+        '--load-mode',
+        dest='load_mode',
+        default='append',
+        choices=['append', 'replace'],
+        help="Load mode of the Adwords reports",
+    )
+    parser.add_argument(
+        '--export-reader',
+        dest='export_reader',
+        default='arrow',
+        choices=['arrow', 'rows'],
+        help="Reader of the exported conversions",
+    )
+    parser.add_argument(
+        '--join-backend',
+        dest='join_backend',
+        default='bigquery',
+        choices=['bigquery', 'duckdb'],
+        help="Backend of the final join",
+    )
+    parser.add_argument(
+        '--gclid-mode',
+        dest='gclid_mode',
+        default='raw',
+        choices=['raw', 'prune'],
+        help="Load every click, or only converting ones",
+    )
+    parser.add_argument(
+        '--snow-transfer',
+        dest='snow_transfer',
+        default='stream',
+        choices=['stream', 'unload'],
+        help="Extract conversions in process, or unload them to a stage",
+    )
+    parser.add_argument(
+        '--adperf-chunk-rows',
+        dest='adperf_chunk_rows',
+        default=200000,
+        type=int,
+        help="Rows per Ad Performance download, 0 for the whole period at once",
+    )
+    parser.add_argument(
+        '--adperf-timeout-days',
+        dest='adperf_timeout_days',
+        default=None,
+        type=int,
+        help="Ad Performance downloads over more days than this time out",
+    )
+    parser.add_argument(
+        '--stream-max-mb',
+        dest='stream_max_mb',
+        default=0,
+        type=float,
+        help="Stream Adwords batches up to this size instead of loading them",
+    )
+    parser.add_argument('--seed', default=42, type=int, help="Seed of the data")
+    parser.add_argument(
+        '--out',
+        dest='out_path',
+        default='benchmark.json',
+        help="Path to the JSON file with the results",
+    )
+    parser.add_argument(
+        '--compare',
+        dest='baseline_path',
+        default=None,
+        help="Path to the results of a previous benchmark to compare with",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.accounts,
+        args.days,
+        args.clicks,
+        args.keywords,
+        args.conversions,
+        args.latency_ms,
+        args.workers,
+        args.load_mode,
+        args.export_reader,
+        args.join_backend,
+        args.gclid_mode,
+        args.snow_transfer,
+        args.adperf_chunk_rows,
+        args.adperf_timeout_days,
+        args.stream_max_mb,
+        args.out_path,
+        args.baseline_path,
+        args.seed,
+    )
@@ -7,31 +7,39 @@ from google.cloud import bigquery
 from google.api_core import exceptions
 
 
-def create_bq_table(client, dataset_ref, table_name, schema):
+### Date partitioning and clustering of each table
+TABLE_LAYOUTS = {
+    'adw_gclid_list': ('Date', ['AdGroupId', 'CreativeId', 'KeywordId', 'Device']),
+    'adw_keywords': ('Date', ['AdGroupId', 'CreativeId', 'KeywordId', 'Device']),
+    'adw_kw_names': (None, ['AdGroupId', 'KeywordId']),
+    'snow_conversions': ('SALEDATE', ['TRACKING_GCLID']),
+    'snow_conversions_delta': (None, None),
+    'final_report': ('Date', None),
+    'exported_conversions': ('ExportedAt', ['GclId']),
+}
 
-    ### Table reference
-    table_ref = dataset_ref.table(table_name)
-
-    ### Delete table if exists
-    try:
-        client.get_table(table_ref)
-        client.delete_table(table_ref)
-        logging.info("Table '{}' supprimée".format(table_ref.table_id))
-    except exceptions.NotFound:
-        pass
-
-    ### Create new table with specified schema
-    table = bigquery.Table(table_ref, schema=schema)
-    try:
-        table = client.create_table(table)
-        logging.info("Table '{}' créée".format(table.full_table_id))
-    except:
-        logging.error("La table n'a pas pu être créée")
+### Columns renamed by the current schema, with their previous name
+RENAMED_COLUMNS = {
+    'final_report': {'Conversions': 'ConversionsAdw'},
+}
 
+### Tables created before final_report.Date was a DATE hold 'YYYYMMDD'
+### strings, until converted with --migrate --convert
+LEGACY_DATE_FORMAT = '%Y%m%d'
 
-def create_table_gclid(client, dataset_ref):
+### Standard SQL types used to cast columns during a migration
+SQL_TYPES = {
+    'STRING': 'STRING',
+    'INTEGER': 'INT64',
+    'FLOAT': 'FLOAT64',
+    'DATE': 'DATE',
+    'TIMESTAMP': 'TIMESTAMP',
+    'DATETIME': 'DATETIME',
+}
 
-    schema = [
+### Standard schema of each table
+SCHEMAS = {
+    'adw_gclid_list': [
         bigquery.SchemaField('AccountName', 'STRING'),
         bigquery.SchemaField('CampaignName', 'STRING'),
         bigquery.SchemaField('AdGroupId', 'STRING'),
@@ -41,13 +49,9 @@ def create_table_gclid(client, dataset_ref):
         bigquery.SchemaField('Device', 'STRING'),
         bigquery.SchemaField('GclId', 'STRING'),
         bigquery.SchemaField('Clicks', 'INTEGER'),
-    ]
-    return create_bq_table(client, dataset_ref, 'adw_gclid_list', schema)
-
-
-def create_table_adperf(client, dataset_ref):
-
-    schema = [
+        bigquery.SchemaField('ExternalCustomerId', 'STRING'),
+    ],
+    'adw_keywords': [
         bigquery.SchemaField('AccountDescriptiveName', 'STRING'),
         bigquery.SchemaField('CampaignName', 'STRING'),
         bigquery.SchemaField('CampaignId', 'STRING'),
@@ -63,25 +67,17 @@ def create_table_adperf(client, dataset_ref):
         bigquery.SchemaField('Clicks', 'INTEGER'),
         bigquery.SchemaField('Conversions', 'FLOAT'),
         bigquery.SchemaField('AveragePosition', 'STRING'),
-    ]
-    return create_bq_table(client, dataset_ref, 'adw_keywords', schema)
-
-
-def create_table_kwnames(client, dataset_ref):
-
-    schema = [
+        bigquery.SchemaField('ExternalCustomerId', 'STRING'),
+    ],
+    'adw_kw_names': [
         bigquery.SchemaField('AccountDescriptiveName', 'STRING'),
         bigquery.SchemaField('AdGroupId', 'STRING'),
         bigquery.SchemaField('Keyword', 'STRING'),
         bigquery.SchemaField('MatchType', 'STRING'),
         bigquery.SchemaField('KeywordId', 'STRING'),
-    ]
-    return create_bq_table(client, dataset_ref, 'adw_kw_names', schema)
-
-
-def create_table_final(client, dataset_ref):
-
-    schema = [
+        bigquery.SchemaField('ExternalCustomerId', 'STRING'),
+    ],
+    'final_report': [
         bigquery.SchemaField('Site', 'STRING'),
         bigquery.SchemaField('AccountName', 'STRING'),
         bigquery.SchemaField('CampaignName', 'STRING'),
@@ -95,16 +91,318 @@ def create_table_final(client, dataset_ref):
         bigquery.SchemaField('Cost', 'FLOAT'),
         bigquery.SchemaField('Impressions', 'INTEGER'),
         bigquery.SchemaField('Clicks', 'INTEGER'),
-        bigquery.SchemaField('ConversionsAdw', 'FLOAT'),
+        bigquery.SchemaField('Conversions', 'FLOAT'),
         bigquery.SchemaField('AveragePosition', 'FLOAT'),
         bigquery.SchemaField('Orders', 'INTEGER'),
         bigquery.SchemaField('Revenue', 'FLOAT'),
         bigquery.SchemaField('SalesValue', 'FLOAT'),
+    ],
+    'snow_conversions': [
+        bigquery.SchemaField('CLICK_TIMESTAMP', 'TIMESTAMP'),
+        bigquery.SchemaField('SALEDATE', 'DATE'),
+        bigquery.SchemaField('TRACKING_GCLID', 'STRING'),
+        bigquery.SchemaField('ORDERS', 'INTEGER'),
+        bigquery.SchemaField('REVENUE', 'FLOAT'),
+        bigquery.SchemaField('SALES_VALUE', 'FLOAT'),
+    ],
+    'exported_conversions': [
+        bigquery.SchemaField('GclId', 'STRING'),
+        bigquery.SchemaField('ConversionTime', 'DATETIME'),
+        bigquery.SchemaField('ConversionValue', 'FLOAT'),
+        bigquery.SchemaField('ExportedAt', 'TIMESTAMP'),
+    ],
+}
+
+
+def date_type(client, table_ref):
+
+    ### Type of the Date column of an existing table, DATE for a new one
+    try:
+        table = client.get_table(table_ref)
+    except exceptions.NotFound:
+        return 'DATE'
+    types = {field.name: field.field_type for field in table.schema}
+    return types.get('Date', 'DATE')
+
+
+def date_value(expression, field_type):
+
+    ### SQL value of a DATE expression for a Date column of the given type
+    if field_type == 'STRING':
+        return 'FORMAT_DATE("{}", {})'.format(LEGACY_DATE_FORMAT, expression)
+    return expression
+
+
+def apply_layout(obj, table_name):
+
+    ### Works on tables as well as on load and query job configs
+    partition_field, clustering_fields = TABLE_LAYOUTS.get(table_name, (None, None))
+    if partition_field:
+        obj.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field=partition_field
+        )
+    if clustering_fields:
+        obj.clustering_fields = clustering_fields
+    return obj
+
+
+def keep_layout(client, table_ref, job_config, table_name):
+
+    ### Jobs replacing a table must keep its current layout, or use the
+    ### standard one if the table does not exist yet
+    try:
+        table = client.get_table(table_ref)
+    except exceptions.NotFound:
+        return apply_layout(job_config, table_name)
+    job_config.time_partitioning = table.time_partitioning
+    job_config.clustering_fields = table.clustering_fields
+    return job_config
+
+
+def create_bq_table(
+    client, dataset_ref, table_name, schema, migrate=False, convert=False
+):
+
+    ### Table reference
+    table_ref = dataset_ref.table(table_name)
+
+    ### Migrate the existing table instead of dropping it
+    if migrate:
+        return migrate_bq_table(client, dataset_ref, table_name, schema, convert)
+
+    ### Delete table if exists
+    try:
+        client.get_table(table_ref)
+        client.delete_table(table_ref)
+        logging.info("Table '{}' supprimée".format(table_ref.table_id))
+    except exceptions.NotFound:
+        pass
+
+    ### Create new table with specified schema
+    table = apply_layout(bigquery.Table(table_ref, schema=schema), table_name)
+    try:
+        table = client.create_table(table)
+        logging.info("Table '{}' créée".format(table.full_table_id))
+    except:
+        logging.error("La table n'a pas pu être créée")
+
+
+def rename_table(client, dataset_ref, table_name, new_name):
+
+    query = "ALTER TABLE `{0}.{1}` RENAME TO `{2}`".format(
+        dataset_ref.dataset_id, table_name, new_name
+    )
+    client.query(query).result()
+
+
+def migrate_bq_table(client, dataset_ref, table_name, schema, convert=False):
+
+    ### A migration stopped between its two renames leaves the data in the
+    ### backup table, which is never overwritten
+    table_ref = dataset_ref.table(table_name)
+    backup_name = table_name + '_backup'
+    try:
+        client.get_table(dataset_ref.table(backup_name))
+    except exceptions.NotFound:
+        pass
+    else:
+        raise Exception(
+            "Table '{}' left by a previous migration, restore or delete it "
+            "first".format(backup_name)
+        )
+
+    ### Create the table if it does not exist yet
+    try:
+        table = client.get_table(table_ref)
+    except exceptions.NotFound:
+        table = apply_layout(bigquery.Table(table_ref, schema=schema), table_name)
+        table = client.create_table(table)
+        logging.info("Table '{}' créée".format(table.full_table_id))
+        return
+
+    ### Same layout and types: new columns are added in place, and columns
+    ### missing from the schema are kept
+    target = apply_layout(bigquery.Table(table_ref, schema=schema), table_name)
+    current_fields = {field.name: field.field_type for field in table.schema}
+    same_layout = (
+        getattr(table.time_partitioning, 'field', None)
+        == getattr(target.time_partitioning, 'field', None)
+        and (table.clustering_fields or None) == (target.clustering_fields or None)
+    )
+    changed = [
+        field.name
+        for field in schema
+        if current_fields.get(field.name, field.field_type) != field.field_type
+    ]
+    if same_layout and not changed:
+        new_fields = [field for field in schema if field.name not in current_fields]
+        if new_fields:
+            table.schema = list(table.schema) + new_fields
+            client.update_table(table, ['schema'])
+        logging.info(
+            "Table '{}' migrée: {} colonne(s) ajoutée(s)".format(
+                table_name, len(new_fields)
+            )
+        )
+        return
+
+    ### Otherwise the data is copied to a table with the target layout.
+    ### Changing a column type, or renaming or dropping a column, breaks
+    ### the readers of the table: it is only done when asked.
+    renamed = RENAMED_COLUMNS.get(table_name, {})
+    names = [field.name for field in schema]
+    dropped = [
+        name
+        for name in current_fields
+        if name not in names and name not in renamed.values()
     ]
-    return create_bq_table(client, dataset_ref, 'final_report', schema)
+    renames = [
+        '{} -> {}'.format(old, new)
+        for new, old in renamed.items()
+        if old in current_fields and new not in current_fields
+    ]
+    if (changed or dropped or renames) and not convert:
+        logging.warning(
+            "Table '{}' non migrée: colonnes modifiées {}, renommées {}, "
+            "supprimées {}. Relancer avec --convert pour l'appliquer".format(
+                table_name, changed, renames, dropped
+            )
+        )
+        return
+
+    tmp_name = table_name + '_migrate'
+    tmp_ref = dataset_ref.table(tmp_name)
+    client.delete_table(tmp_ref, not_found_ok=True)
+    tmp_table = apply_layout(bigquery.Table(tmp_ref, schema=schema), table_name)
+    client.create_table(tmp_table)
+
+    columns = []
+    for field in schema:
+        sql_type = SQL_TYPES[field.field_type]
+        source = field.name
+        if source not in current_fields and renamed.get(source) in current_fields:
+            source = renamed[source]
+        current_type = current_fields.get(source)
+        if current_type is None:
+            columns.append("CAST(NULL AS {0}) AS {1}".format(sql_type, field.name))
+        elif current_type == 'STRING' and field.field_type == 'DATE':
+            columns.append(
+                "COALESCE(SAFE.PARSE_DATE('%Y%m%d', {0}), SAFE_CAST({0} AS DATE)) "
+                "AS {1}".format(source, field.name)
+            )
+        else:
+            columns.append(
+                "CAST({0} AS {1}) AS {2}".format(source, sql_type, field.name)
+            )
+
+    job_config = bigquery.QueryJobConfig()
+    job_config.destination = tmp_ref
+    job_config.write_disposition = 'WRITE_APPEND'
+    query = "SELECT {0} FROM `{1}.{2}`".format(
+        ', '.join(columns), dataset_ref.dataset_id, table_name
+    )
+    client.query(query, job_config=job_config).result()
+    logging.info("Données de '{}' copiées dans '{}'".format(table_name, tmp_name))
+
+    ### The original table is only deleted once the new one took its name
+    rename_table(client, dataset_ref, table_name, backup_name)
+    try:
+        rename_table(client, dataset_ref, tmp_name, table_name)
+    except Exception:
+        rename_table(client, dataset_ref, backup_name, table_name)
+        raise
+    client.delete_table(dataset_ref.table(backup_name))
+    logging.info("Table '{}' migrée vers le nouveau format".format(table_name))
+
+
+def dedupe_table(client, dataset_ref, table_name, keys):
+
+    ### Keep one row per key, rewriting the table in place with its layout
+    table_ref = dataset_ref.table(table_name)
+    job_config = bigquery.QueryJobConfig()
+    job_config.destination = table_ref
+    job_config.write_disposition = 'WRITE_TRUNCATE'
+    keep_layout(client, table_ref, job_config, table_name)
+    query = """
+    SELECT *
+    FROM `{0}.{1}`
+    WHERE TRUE
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY {2}) = 1
+    """.format(
+        dataset_ref.dataset_id, table_name, ', '.join(keys)
+    )
+    client.query(query, job_config=job_config).result()
+    logging.info("Doublons supprimés de la table '{}'".format(table_name))
 
 
-def main(dataset, gclid, adperf, kwnames, final, snow):
+def create_table_gclid(client, dataset_ref, migrate=False, convert=False):
+
+    return create_bq_table(
+        client,
+        dataset_ref,
+        'adw_gclid_list',
+        SCHEMAS['adw_gclid_list'],
+        migrate,
+        convert,
+    )
+
+
+def create_table_adperf(client, dataset_ref, migrate=False, convert=False):
+
+    return create_bq_table(
+        client, dataset_ref, 'adw_keywords', SCHEMAS['adw_keywords'], migrate, convert
+    )
+
+
+def create_table_kwnames(client, dataset_ref, migrate=False, convert=False):
+
+    return create_bq_table(
+        client, dataset_ref, 'adw_kw_names', SCHEMAS['adw_kw_names'], migrate, convert
+    )
+
+
+def create_table_final(client, dataset_ref, migrate=False, convert=False):
+
+    return create_bq_table(
+        client, dataset_ref, 'final_report', SCHEMAS['final_report'], migrate, convert
+    )
+
+
+def create_table_snow(client, dataset_ref, migrate=False, convert=False):
+
+    return create_bq_table(
+        client,
+        dataset_ref,
+        'snow_conversions',
+        SCHEMAS['snow_conversions'],
+        migrate,
+        convert,
+    )
+
+
+def create_table_exported(client, dataset_ref, migrate=False, convert=False):
+
+    return create_bq_table(
+        client,
+        dataset_ref,
+        'exported_conversions',
+        SCHEMAS['exported_conversions'],
+        migrate,
+        convert,
+    )
+
+
+def main(
+    dataset,
+    gclid,
+    adperf,
+    kwnames,
+    final,
+    snow=False,
+    migrate=False,
+    exported=False,
+    convert=False,
+):
 
     ### Initializes BigQuery object
     client = bigquery.Client()
@@ -112,13 +410,21 @@ def main(dataset, gclid, adperf, kwnames, final, snow):
 
     ### Creates specified tables
     if gclid == True:
-        create_table_gclid(client, dataset_ref)
+        create_table_gclid(client, dataset_ref, migrate, convert)
     if adperf == True:
-        create_table_adperf(client, dataset_ref)
+        create_table_adperf(client, dataset_ref, migrate, convert)
     if kwnames == True:
-        create_table_kwnames(client, dataset_ref)
+        create_table_kwnames(client, dataset_ref, migrate, convert)
+        if migrate:
+            dedupe_table(
+                client, dataset_ref, 'adw_kw_names', ['AdGroupId', 'KeywordId']
+            )
     if final == True:
-        create_table_final(client, dataset_ref)
+        create_table_final(client, dataset_ref, migrate, convert)
+    if snow == True:
+        create_table_snow(client, dataset_ref, migrate, convert)
+    if exported == True:
+        create_table_exported(client, dataset_ref, migrate, convert)
 
 
 if __name__ == '__main__':
@@ -144,7 +450,38 @@ if __name__ == '__main__':
     parser.add_argument(
         '--final', action='store_true', help="Create table for FINAL report"
     )
+    parser.add_argument(
+        '--snow', action='store_true', help="Create table for SNOWFLAKE conversions"
+    )
+    parser.add_argument(
+        '--exported',
+        action='store_true',
+        help="Create table for EXPORTED conversions ledger",
+    )
+    parser.add_argument(
+        '--migrate',
+        action='store_true',
+        help="Migrate existing tables to the new schema and layout, keeping data",
+    )
+    parser.add_argument(
+        '--convert',
+        action='store_true',
+        help=(
+            "With --migrate, also change column types and rename or drop columns, "
+            "which breaks the readers of the tables"
+        ),
+    )
     args = parser.parse_args()
 
     ### Call to main function
-    main(args.dataset, args.gclid, args.adperf, args.kwnames, args.final)
+    main(
+        args.dataset,
+        args.gclid,
+        args.adperf,
+        args.kwnames,
+        args.final,
+        args.snow,
+        args.migrate,
+        args.exported,
+        args.convert,
+    )
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import uuid
+import datetime
+import threading
+from google.cloud import bigquery
+
+### Load project modules
+import buffers
+import metrics
+import bq_create_tables
+
+### Columns identifying the slice of a table that a work unit owns. Accounts
+### are keyed on their customer ID, two of them may share the same name.
+REPLACE_KEYS = {
+    'adw_gclid_list': ['Date', 'ExternalCustomerId'],
+    'adw_keywords': ['Date', 'ExternalCustomerId'],
+}
+
+### Dimension tables are always upserted on their key columns
+MERGE_KEYS = {
+    'adw_kw_names': ['AdGroupId', 'KeywordId'],
+}
+
+
+class BatchLoader:
+    def __init__(
+        self,
+        bq_client,
+        dataset_name,
+        max_bytes=256 * 1024 * 1024,
+        max_units=500,
+        mode='append',
+        manifest=None,
+        max_memory=64 * 1024 * 1024,
+        run_metrics=None,
+        sink=None,
+        upload=True,
+        writer=None,
+    ):
+
+        ### With a writer, small batches of its tables are streamed through
+        ### the Storage Write API rather than loaded by a load job
+        self.bq_client = bq_client
+        self.dataset_name = dataset_name
+        self.max_bytes = max_bytes
+        self.max_units = max_units
+        self.mode = mode
+        self.manifest = manifest
+        self.max_memory = max_memory
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.sink = sink
+        self.upload = upload
+        self.writer = writer
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.batch_locks = {}
+        self.table_locks = {}
+        self.load_jobs = 0
+        self.streams = 0
+        self.bytes_sent = 0
+        self.failed_keys = []
+
+    def add(
+        self,
+        table_name,
+        report_data,
+        dates=(),
+        unit_key=None,
+        on_loaded=None,
+        account_id=None,
+    ):
+
+        ### Reports for different tables can be added concurrently
+        with self.lock:
+            batch_lock = self.batch_locks.setdefault(table_name, threading.Lock())
+
+        ### With a local sink, fact tables are also written locally, one file
+        ### per unit, which a resumed run overwrites
+        if self.sink is not None and table_name not in MERGE_KEYS:
+            self.sink.write(table_name, report_data.finish(), name=unit_key)
+
+        ### Append the report to the pending batch of its destination table
+        with batch_lock:
+            batch = self.batches.get(table_name)
+            if batch is None:
+                batch = {
+                    'data': buffers.ReportBuffer(self.max_memory),
+                    'units': 0,
+                    'dates': set(),
+                    'slices': set(),
+                    'keys': [],
+                    'callbacks': [],
+                }
+                self.batches[table_name] = batch
+            batch['data'].write_from(report_data)
+            batch['units'] += 1
+            batch['dates'].update(dates)
+            if account_id is not None:
+                batch['slices'].update(
+                    '{}/{}'.format(date, account_id) for date in dates
+                )
+            if unit_key is not None:
+                batch['keys'].append(unit_key)
+            if on_loaded is not None:
+                batch['callbacks'].append(on_loaded)
+            full = (
+                batch['data'].size >= self.max_bytes
+                or batch['units'] >= self.max_units
+            )
+            if full:
+                batch = self.batches.pop(table_name)
+
+        ### Load outside the lock so other workers can keep adding reports
+        if full:
+            self.load_batch(table_name, batch)
+
+    def flush(self, table_name):
+
+        with self.lock:
+            batch_lock = self.batch_locks.setdefault(table_name, threading.Lock())
+        with batch_lock:
+            batch = self.batches.pop(table_name, None)
+        if batch is not None:
+            self.load_batch(table_name, batch)
+
+    def flush_all(self):
+
+        for table_name in list(self.batches):
+            self.flush(table_name)
+        logging.info(
+            "All batches flushed, {} load job(s), {} stream(s), "
+            "{} compressed bytes sent".format(
+                self.load_jobs, self.streams, self.bytes_sent
+            )
+        )
+
+    def load_batch(self, table_name, batch):
+
+        ### A batch holds the units of several workers, and the error would
+        ### only reach the one which filled it: every unit is failed instead
+        try:
+            self.send_batch(table_name, batch)
+        except Exception as e:
+            logging.error(
+                "Batch of {} report(s) not loaded to table '{}': {}".format(
+                    batch['units'], table_name, e
+                )
+            )
+            with self.lock:
+                self.failed_keys.extend(batch['keys'])
+            if self.manifest is not None:
+                for key in batch['keys']:
+                    self.manifest.mark(key, 'failed', error=str(e))
+            return
+
+        ### Units only count as done once their data is in BigQuery
+        if self.manifest is not None:
+            for key in batch['keys']:
+                self.manifest.mark_done(key)
+        for callback in batch['callbacks']:
+            callback()
+
+    def send_batch(self, table_name, batch):
+
+        ### A replaced slice is deleted even when its rerun returned no rows
+        replace = (
+            self.upload and self.mode == 'replace' and table_name in REPLACE_KEYS
+        )
+        if batch['data'].size == 0 and not (replace and batch['slices']):
+            logging.info("Nothing to load to table '{}'".format(table_name))
+        elif batch['data'].size == 0:
+            self.replace_slices(
+                table_name, None, sorted(batch['dates']), sorted(batch['slices'])
+            )
+        else:
+            report_data = batch['data'].finish()
+            logging.info(
+                "Loading batch of {} report(s) to table '{}.{}': "
+                "{} bytes, {} compressed".format(
+                    batch['units'],
+                    self.dataset_name,
+                    table_name,
+                    batch['data'].size,
+                    batch['data'].compressed_size,
+                )
+            )
+
+            ### With a local sink, fact tables are only uploaded when asked.
+            ### Dimension tables are always merged.
+            stream = self.writer is not None and self.writer.accepts(
+                table_name, batch['data'].size
+            )
+            if table_name in MERGE_KEYS:
+                self.merge_rows(table_name, report_data, stream)
+            elif not self.upload:
+                logging.info("Batch of table '{}' kept locally".format(table_name))
+            elif replace:
+                self.replace_slices(
+                    table_name,
+                    report_data,
+                    sorted(batch['dates']),
+                    sorted(batch['slices']),
+                    stream,
+                )
+            else:
+                self.load_to_table(
+                    table_name, report_data, stream=stream, keys=batch['keys']
+                )
+            if self.upload or table_name in MERGE_KEYS:
+                with self.lock:
+                    self.bytes_sent += batch['data'].compressed_size
+
+    def load_to_table(
+        self, table_name, report_data, schema=None, stream=False, keys=()
+    ):
+
+        if stream and self.stream_to_table(table_name, report_data, schema, keys):
+            return
+
+        dataset_ref = self.bq_client.dataset(self.dataset_name)
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.CSV
+        if schema is not None:
+            job_config.schema = schema
+            job_config.write_disposition = 'WRITE_TRUNCATE'
+
+        with self.metrics.timer('adwords', 'bq_load', table=table_name) as event:
+            event['bytes_out'] = metrics.stream_size(report_data)
+            report_data.seek(0)
+            with report_data as source:
+                load_job = self.bq_client.load_table_from_file(
+                    source, dataset_ref.table(table_name), job_config=job_config
+                )
+            load_job.result()
+            self.metrics.record_job(event, load_job)
+        with self.lock:
+            self.load_jobs += 1
+        logging.info(
+            "Data loaded to table '{}.{}'".format(self.dataset_name, table_name)
+        )
+
+    def stream_to_table(self, table_name, report_data, schema=None, keys=()):
+
+        ### Until its commit, a pending stream can be dropped for a load job
+        ### without duplicating any row
+        if schema is None:
+            schema = bq_create_tables.SCHEMAS[table_name]
+        try:
+            stream_name = self.writer.append(table_name, report_data, schema)
+        except Exception as e:
+            logging.warning(
+                "Streaming to table '{}' failed, using a load job: {}".format(
+                    table_name, e
+                )
+            )
+            return False
+
+        ### Units are marked with their stream before the commit, so that a
+        ### run stopped right after it knows their rows are already in
+        if self.manifest is not None:
+            for key in keys:
+                self.manifest.mark(key, 'committing', stream=stream_name)
+        self.writer.commit(table_name, [stream_name])
+        with self.lock:
+            self.streams += 1
+        return True
+
+    def recover_commits(self):
+
+        if self.manifest is None or self.writer is None:
+            return
+        ### A commit may also have gone through before the error of its batch
+        for key in self.manifest.keys('committing') + self.manifest.keys('failed'):
+            stream_name = self.manifest.get(key).get('stream')
+            if stream_name and self.writer.is_committed(stream_name):
+                logging.info("Unit {} committed by a previous run".format(key))
+                self.manifest.mark_done(key)
+
+    def load_to_stage(self, table_name, report_data, stream=False):
+
+        ### Load a batch to a short-lived staging table with the target schema
+        dataset_ref = self.bq_client.dataset(self.dataset_name)
+        table = self.bq_client.get_table(dataset_ref.table(table_name))
+        stage_name = '{}_stage_{}'.format(table_name, uuid.uuid4().hex[:8])
+        stage = bigquery.Table(dataset_ref.table(stage_name), schema=table.schema)
+        stage.expires = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        self.bq_client.create_table(stage)
+        self.load_to_table(stage_name, report_data, table.schema, stream)
+        return stage_name, table.schema
+
+    def run_from_stage(self, table_name, stage_name, query, job_config=None):
+
+        ### Concurrent DML on the same table would abort each other
+        with self.lock:
+            table_lock = self.table_locks.setdefault(table_name, threading.Lock())
+        try:
+            with table_lock, self.metrics.timer(
+                'adwords', 'bq_query', table=table_name
+            ) as event:
+                query_job = self.bq_client.query(query, job_config=job_config)
+                query_job.result()
+                self.metrics.record_job(event, query_job)
+        finally:
+            if stage_name is not None:
+                self.bq_client.delete_table(
+                    self.bq_client.dataset(self.dataset_name).table(stage_name),
+                    not_found_ok=True,
+                )
+        return query_job
+
+    def replace_slices(self, table_name, report_data, dates, slices, stream=False):
+
+        ### Replace the (date, account) slices owned by the units of the batch,
+        ### whether or not their reports returned rows. Dates are passed
+        ### explicitly so that only their partitions are read.
+        keys = REPLACE_KEYS[table_name]
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [
+            bigquery.ArrayQueryParameter('dates', 'DATE', dates),
+            bigquery.ArrayQueryParameter('slices', 'STRING', slices),
+        ]
+        delete = """
+        DELETE FROM `{0}.{1}`
+        WHERE Date IN UNNEST(@dates)
+        AND CONCAT({2}) IN UNNEST(@slices);
+        """.format(
+            self.dataset_name,
+            table_name,
+            ", '/', ".join('CAST({} AS STRING)'.format(key) for key in keys),
+        )
+
+        if report_data is None:
+            self.run_from_stage(table_name, None, delete, job_config)
+        else:
+            stage_name, schema = self.load_to_stage(table_name, report_data, stream)
+            query = """
+            BEGIN TRANSACTION;
+            {2}
+            INSERT INTO `{0}.{1}`
+            SELECT * FROM `{0}.{3}`;
+
+            COMMIT TRANSACTION;
+            """.format(self.dataset_name, table_name, delete, stage_name)
+            self.run_from_stage(table_name, stage_name, query, job_config)
+        logging.info(
+            "{} slices replaced in table '{}.{}'".format(
+                len(slices), self.dataset_name, table_name
+            )
+        )
+
+    def merge_rows(self, table_name, report_data, stream=False):
+
+        stage_name, schema = self.load_to_stage(table_name, report_data, stream)
+
+        ### Insert new keys, and update existing keys whose values changed.
+        ### Staged duplicates of a key keep the same row on every run.
+        keys = MERGE_KEYS[table_name]
+        values = [field.name for field in schema if field.name not in keys]
+        query = """
+        MERGE `{0}.{1}` AS t
+        USING (
+            SELECT *
+            FROM `{0}.{2}`
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {3} ORDER BY {7}) = 1
+        ) AS s
+        ON {4}
+        WHEN MATCHED AND ({5}) THEN
+            UPDATE SET {6}
+        WHEN NOT MATCHED THEN
+            INSERT ROW
+        """.format(
+            self.dataset_name,
+            table_name,
+            stage_name,
+            ', '.join(keys),
+            ' AND '.join('t.{0} = s.{0}'.format(key) for key in keys),
+            ' OR '.join('t.{0} IS DISTINCT FROM s.{0}'.format(v) for v in values),
+            ', '.join('{0} = s.{0}'.format(v) for v in values),
+            ', '.join(values),
+        )
+
+        query_job = self.run_from_stage(table_name, stage_name, query)
+        logging.info(
+            "Rows merged into table '{}.{}': {} new or changed".format(
+                self.dataset_name, table_name, query_job.num_dml_affected_rows
+            )
+        )
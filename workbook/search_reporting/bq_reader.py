@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import io
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+
+
+def read_batches(query_job, bqstorage_client=None):
+
+    ### Columnar batches straight from the results, without any row object.
+    ### Without a Storage Read client, they are read through the REST API.
+    rows = query_job.result()
+    if hasattr(rows, 'to_arrow_iterable'):
+        return rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
+    return rows.to_arrow(bqstorage_client=bqstorage_client).to_batches()
+
+
+def csv_bytes(data, include_header=False):
+
+    ### Works on record batches as well as on tables. Arrow quotes every
+    ### string value, which CSV readers and Google Ads imports accept.
+    sink = pa.BufferOutputStream()
+    pa_csv.write_csv(
+        data, sink, write_options=pa_csv.WriteOptions(include_header=include_header)
+    )
+    return sink.getvalue().to_pybytes()
+
+
+class CsvShardWriter:
+    def __init__(self, header, max_rows, max_bytes, keep_batches=False):
+
+        ### Every shard starts with the same header rows
+        self.header = header.encode('utf-8')
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.keep_batches = keep_batches
+        self.batches = []
+        self.shards = []
+        self.rows = 0
+        self.size = 0
+        self.new_shard()
+
+    def new_shard(self):
+
+        shard = io.BytesIO()
+        shard.write(self.header)
+        self.shards.append(shard)
+        self.shard_rows = 0
+        self.shard_size = len(self.header)
+
+    def write_batch(self, batch):
+
+        if self.keep_batches:
+            self.batches.append(batch)
+        offset = 0
+        while offset < batch.num_rows:
+
+            ### Take as many rows as the current shard can hold
+            if self.shard_rows >= self.max_rows:
+                self.new_shard()
+            piece = batch.slice(offset, self.max_rows - self.shard_rows)
+            data = csv_bytes(piece)
+            room = self.max_bytes - self.shard_size
+
+            ### Rows differ in size, so shrink the piece until it fits
+            while len(data) > room and piece.num_rows > 1:
+                nb_rows = int(room * piece.num_rows / len(data))
+                piece = batch.slice(offset, max(1, min(nb_rows, piece.num_rows - 1)))
+                data = csv_bytes(piece)
+            if len(data) > room and self.shard_rows > 0:
+                self.new_shard()
+                continue
+
+            self.shards[-1].write(data)
+            self.shard_rows += piece.num_rows
+            self.shard_size += len(data)
+            self.rows += piece.num_rows
+            self.size += len(data)
+            offset += piece.num_rows
+
+    def write_batches(self, batches):
+
+        for batch in batches:
+            self.write_batch(batch)
+        return self.shards
+
+    def table(self):
+
+        ### Kept batches, as a single table
+        return pa.Table.from_batches(self.batches)
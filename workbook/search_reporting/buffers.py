@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import gzip
+import codecs
+import hashlib
+import resource
+import tempfile
+
+### Size of the chunks read back from a buffer
+CHUNK_SIZE = 1024 * 1024
+
+
+def peak_memory_mb():
+
+    ### ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ReportBuffer:
+    def __init__(self, max_memory=64 * 1024 * 1024):
+
+        ### Compressed bytes stay in memory up to max_memory, then spill to disk.
+        ### The 'r+b' mode lets BigQuery accept the spool as a binary upload.
+        self.raw = tempfile.SpooledTemporaryFile(max_size=max_memory, mode='r+b')
+        self.gzip = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.size = 0
+        self.lines = 0
+        self.compressed_size = 0
+        self.last_char = ''
+        self.hash = hashlib.sha256()
+
+    def write(self, text):
+
+        if not text:
+            return 0
+        data = text.encode('utf-8')
+        self.gzip.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+        self.lines += text.count('\n')
+        self.last_char = text[-1]
+        return len(text)
+
+    def write_stream(self, stream):
+
+        ### Bytes of a response, decoded one chunk at a time so that the
+        ### whole body is never held in memory
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.write(decoder.decode(chunk))
+        self.write(decoder.decode(b'', final=True))
+
+    def write_from(self, other):
+
+        ### Append the content of another buffer, one line per row
+        for chunk in other.read_chunks():
+            self.write(chunk)
+        if self.last_char not in ('', '\n'):
+            self.write('\n')
+
+    def checksum(self):
+
+        return self.hash.hexdigest()
+
+    def finish(self):
+
+        ### Close the gzip stream and return the compressed file, rewound
+        if not self.gzip.closed:
+            self.gzip.close()
+            self.compressed_size = self.raw.tell()
+        self.raw.seek(0)
+        return self.raw
+
+    def read_chunks(self):
+
+        ### Decompressed content, read back without loading it all in memory
+        raw = self.finish()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with gzip.GzipFile(fileobj=raw, mode='rb') as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield decoder.decode(chunk)
+        raw.seek(0)
+
+    def getvalue(self):
+
+        return ''.join(self.read_chunks())
@@ -2,15 +2,20 @@
 
 ### Import libraries
 import logging
-import googleads
-from google.cloud import bigquery
-from google.cloud import storage
-import snowflake.connector
-from snowflake.connector import DictCursor
+import threading
+
+### Load project modules
+import metrics
+import rate_limiter
+
+### Client libraries are imported by the function building the client, so a
+### run only pays for the libraries of the stages it runs
 
 
 def bigquery_connection():
 
+    from google.cloud import bigquery
+
     try:
         bq_client = bigquery.Client()
         logging.info("BigQuery client initialized")
@@ -20,10 +25,38 @@ def bigquery_connection():
     return bq_client
 
 
+def bigquery_write_connection():
+
+    from google.cloud import bigquery_storage_v1
+
+    try:
+        write_client = bigquery_storage_v1.BigQueryWriteClient()
+        logging.info("BigQuery Storage Write client initialized")
+    except:
+        logging.error("Error initializing BigQuery Storage Write client")
+        return
+    return write_client
+
+
+def bigquery_read_connection():
+
+    from google.cloud import bigquery_storage
+
+    try:
+        read_client = bigquery_storage.BigQueryReadClient()
+        logging.info("BigQuery Storage Read client initialized")
+    except:
+        logging.error("Error initializing BigQuery Storage Read client")
+        return
+    return read_client
+
+
 def adwords_api_connection(yaml_file):
 
+    from googleads import adwords
+
     try:
-        adwords_client = googleads.adwords.AdWordsClient.LoadFromStorage(yaml_file)
+        adwords_client = adwords.AdWordsClient.LoadFromStorage(yaml_file)
         logging.info("Connected to the Adwords API")
     except:
         logging.error("Error trying to connect to the Adwords API")
@@ -33,17 +66,22 @@ def adwords_api_connection(yaml_file):
 
 def storage_connection():
 
+    from google.cloud import storage
+
     try:
         gs_client = storage.Client()
         logging.info("Google Storage client initialized")
     except:
-        logging.error("Error initializing BigQuery client")
+        logging.error("Error initializing Google Storage client")
         return
     return gs_client
 
 
 def snowflake_connection(sf_account, sf_user, sf_password):
 
+    import snowflake.connector
+    from snowflake.connector import DictCursor
+
     try:
         sf_connex = snowflake.connector.connect(
             account=sf_account, user=sf_user, password=sf_password
@@ -56,3 +94,94 @@ def snowflake_connection(sf_account, sf_user, sf_password):
         logging.error("Error establishing Snowflake connection")
         return
     return sf_connex
+
+
+class ClientPool:
+    def __init__(self, google_yaml=None, run_metrics=None):
+
+        ### Each client is built by the first stage asking for it, then shared
+        ### by every stage of the run
+        self.google_yaml = google_yaml
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.clients = {}
+
+    def get(self, name, factory):
+
+        ### One lock per client: a stage building the Snowflake connection
+        ### does not wait for another building the BigQuery client
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self.clients:
+                with self.metrics.timer('startup', 'client', component=name):
+                    client = factory()
+                    if client is None:
+                        raise Exception("Client '{}' could not be built".format(name))
+                self.clients[name] = client
+            return self.clients[name]
+
+    def bigquery(self):
+
+        return self.get('bigquery', lambda: bigquery_connection())
+
+    def bigquery_write(self):
+
+        return self.get('bigquery_write', lambda: bigquery_write_connection())
+
+    def bigquery_read(self):
+
+        ### The Storage Read API is optional, results are otherwise read
+        ### through REST
+        try:
+            return self.get('bigquery_read', lambda: bigquery_read_connection())
+        except ImportError:
+            logging.info("BigQuery Storage API not installed, reading through REST")
+            return None
+
+    def storage(self):
+
+        return self.get('storage', lambda: storage_connection())
+
+    def adwords(self, mcc=None, yaml_file=None):
+
+        ### The client holds the customer id it works on: one client per MCC
+        yaml_file = yaml_file or self.google_yaml
+        return self.get(
+            'adwords/{}'.format(mcc) if mcc else 'adwords',
+            lambda: adwords_api_connection(yaml_file),
+        )
+
+    def adwords_requests(self, token_rate, account_rate, yaml_file=None):
+
+        ### Tenants using the same developer token share its rate limit
+        yaml_file = yaml_file or self.google_yaml
+        return self.get(
+            'adwords_requests/{}'.format(yaml_file),
+            lambda: rate_limiter.AdwordsRequestScheduler(
+                token_rate=token_rate, account_rate=account_rate
+            ),
+        )
+
+    def snowflake(self, sf_account, sf_user, sf_password):
+
+        ### Tenants reading the same Snowflake account share one connection
+        return self.get(
+            'snowflake/{}/{}'.format(sf_account, sf_user),
+            lambda: snowflake_connection(sf_account, sf_user, sf_password),
+        )
+
+    def close(self):
+
+        ### Clients without a close method (Adwords) are simply dropped
+        with self.lock:
+            clients, self.clients = self.clients, {}
+        for name, client in clients.items():
+            close = getattr(client, 'close', None)
+            if not callable(close):
+                continue
+            try:
+                close()
+            except Exception as e:
+                logging.warning("Error closing client '{}': {}".format(name, e))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import json
+import socket
+import datetime
+import threading
+import urllib.error
+
+### Rows aimed at per AD_PERFORMANCE_REPORT download
+DEFAULT_CHUNK_ROWS = 200000
+
+### Days per download for an account whose volume is not known yet
+DEFAULT_CHUNK_DAYS = 7
+
+### Server-side timeouts, for which a smaller date range is worth trying
+TIMEOUT_CODES = (408, 504)
+TIMEOUT_TYPES = ('DEADLINE_EXCEEDED', 'timed out', 'Timeout')
+
+
+def is_timeout(error):
+
+    if isinstance(error, (socket.timeout, TimeoutError)):
+        return True
+    if isinstance(error, urllib.error.URLError) and isinstance(
+        getattr(error, 'reason', None), (socket.timeout, TimeoutError)
+    ):
+        return True
+    if getattr(error, 'code', None) in TIMEOUT_CODES:
+        return True
+    description = '{} {}'.format(getattr(error, 'type', ''), error)
+    return any(error_type in description for error_type in TIMEOUT_TYPES)
+
+
+def to_date(value):
+
+    return datetime.datetime.strptime(str(value), "%Y-%m-%d").date()
+
+
+def split_dates(dates, days):
+
+    ### Runs of consecutive dates, each cut into ranges of at most days
+    ranges = []
+    days = max(1, int(days))
+    for date in sorted(to_date(d) for d in dates):
+        if ranges:
+            begin, end = ranges[-1]
+            if date == end + datetime.timedelta(1) and (date - begin).days < days:
+                ranges[-1] = (begin, date)
+                continue
+        ranges.append((date, date))
+    return [(str(begin), str(end)) for begin, end in ranges]
+
+
+def halve(date_begin, date_end):
+
+    ### Two halves of a range, or None for a single day
+    begin, end = to_date(date_begin), to_date(date_end)
+    days = (end - begin).days + 1
+    if days < 2:
+        return None
+    middle = begin + datetime.timedelta(days // 2 - 1)
+    return [
+        (str(begin), str(middle)),
+        (str(middle + datetime.timedelta(1)), str(end)),
+    ]
+
+
+class ReportVolumes:
+    def __init__(
+        self, path=None, chunk_rows=DEFAULT_CHUNK_ROWS, default_days=DEFAULT_CHUNK_DAYS
+    ):
+
+        ### Rows per day of each account's Ad Performance report, as observed
+        ### by previous downloads, to size the date ranges of the next ones
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.default_days = default_days
+        self.lock = threading.Lock()
+        self.accounts = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.accounts = json.load(f)
+
+    def chunk_days(self, account_id):
+
+        with self.lock:
+            entry = self.accounts.get(str(account_id))
+        if entry is None:
+            return self.default_days
+        return max(1, int(self.chunk_rows // max(entry['rows_per_day'], 1)))
+
+    def record(self, account_id, rows, days):
+
+        ### Smoothed, so that one unusual day does not resize every chunk
+        rows_per_day = rows / max(days, 1)
+        with self.lock:
+            entry = self.accounts.get(str(account_id))
+            if entry is not None:
+                rows_per_day = (entry['rows_per_day'] + rows_per_day) / 2
+            self.accounts[str(account_id)] = {
+                'rows_per_day': round(rows_per_day, 1),
+                'updated': datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            if self.path:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.accounts, f, indent=1)
+                os.replace(tmp_path, self.path)
+        logging.debug(
+            "Account {}: {:.0f} Ad Performance rows per day".format(
+                account_id, rows_per_day
+            )
+        )
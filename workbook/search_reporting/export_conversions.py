@@ -3,53 +3,215 @@
 ### Load libraries
 import logging
 import io
-import pandas as pd
+import re
+import csv
+import uuid
+import datetime
+import pyarrow as pa
 from google.cloud import bigquery
-from google.cloud import storage
+from google.api_core import exceptions
+
+### Load project modules
+import bq_create_tables
+import bq_reader
+import metrics
+import query_planner
+
+### Size limits of a conversions file imported by Google Ads
+MAX_SHARD_ROWS = 1000000
+MAX_SHARD_BYTES = 50 * 1024 * 1024
+
+### Days a conversion is exported again after its first export, for Google Ads
+### to fetch it even when a later run overwrites the file first
+EXPORT_WINDOW_DAYS = 7
+
+### Parameters row and column names of the conversions file
+HEADER_ROWS = (
+    "Parameters:TimeZone=Europe/Paris,,,,\n"
+    "Google Click ID,Conversion Name,Conversion Time,Conversion Value,"
+    "Conversion Currency\n"
+)
 
 
 class ExportConversionsAdwords:
-    def __init__(self, gs_client, bq_client, dataset_name):
+    def __init__(
+        self,
+        gs_client,
+        bq_client,
+        dataset_name,
+        run_metrics=None,
+        planner=None,
+        mode='incremental',
+        max_rows=MAX_SHARD_ROWS,
+        max_bytes=MAX_SHARD_BYTES,
+        reader='arrow',
+        bucket_name='client_bucket',
+        window_days=EXPORT_WINDOW_DAYS,
+        read_client=None,
+    ):
 
         logging.info("Initializing module")
-        self.bucket_name = 'client_bucket'
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.planner = planner or query_planner.QueryPlanner(bq_client)
+        self.bucket_name = bucket_name
         self.blob_name = 'adwords_conversions.csv'
+        self.ledger_name = 'exported_conversions'
+        self.query_label = '{}.export'.format(dataset_name)
+        self.window_days = window_days
+        self.read_client = read_client
+
+        ### In incremental mode, conversions already exported are left out
+        if mode == 'incremental':
+            self.create_ledger(bq_client, dataset_name)
+
+        ### The uploaded files are kept when the conversions did not change
+        query = self.get_query(dataset_name, mode, reader)
+        query_job = self.run_query(query)
+        if query_job is None:
+            logging.info("Conversions unchanged since last export, upload skipped")
+            return
+
+        ### The Arrow reader writes the files from columnar batches, the rows
+        ### reader goes through a list of rows and a DataFrame
+        with self.metrics.timer('export', 'read', reader=reader) as event:
+            if reader == 'arrow':
+                self.io_objects, ledger_data, nb_rows = self.read_arrow(
+                    query_job, max_rows, max_bytes, mode == 'incremental'
+                )
+            else:
+                self.bq_results = self.get_conversions_from_bq(query_job)
+                self.io_objects = self.transform_results(
+                    self.bq_results, max_rows, max_bytes
+                )
+                ledger_data, nb_rows = self.ledger_rows(self.bq_results)
+            event['rows'] = nb_rows
+            event['bytes_in'] = sum(len(o.getvalue()) for o in self.io_objects)
+        logging.info(
+            "{} conversion(s) read by the {} reader in {:.1f}s, {:.0f} rows/s".format(
+                nb_rows,
+                reader,
+                event['seconds'],
+                nb_rows / max(event['seconds'], 1e-6),
+            )
+        )
+
+        self.public_urls = self.upload_shards(
+            gs_client, self.io_objects, self.bucket_name, self.blob_name
+        )
+        if mode == 'incremental' and nb_rows:
+            self.record_exported(bq_client, dataset_name, ledger_data, nb_rows)
+        self.planner.remember(self.query_label)
 
-        self.bq_results = self.get_conversions_from_bq(bq_client, dataset_name)
-        self.io_object = self.transform_results(self.bq_results)
-        self.upload_to_gs(gs_client, self.io_object, self.bucket_name, self.blob_name)
+    def create_ledger(self, bq_client, dataset_name):
 
-    def get_conversions_from_bq(self, bq_client, dataset_name):
+        dataset_ref = bq_client.dataset(dataset_name)
+        try:
+            bq_client.get_table(dataset_ref.table(self.ledger_name))
+        except exceptions.NotFound:
+            bq_create_tables.create_table_exported(bq_client, dataset_ref)
 
-        ### Build the query to export conversions list
+    def get_query(self, dataset_name, mode='full', reader='arrow'):
+
+        ### Build the query to export conversions list. In incremental mode,
+        ### conversions first exported more than window_days ago are left out:
+        ### Google Ads fetched them since, and dedupes those exported again.
+        ledger_filter = ''
+        if mode == 'incremental':
+            ledger_filter = """
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM `{0}.{1}` AS e
+                WHERE
+                    e.GclId = c.GclId
+                    AND e.ConversionTime = c.ConversionTime
+                    AND e.ExportedAt < TIMESTAMP_SUB(
+                        CURRENT_TIMESTAMP(), INTERVAL {2} DAY
+                    )
+            )""".format(
+                dataset_name, self.ledger_name, int(self.window_days)
+            )
         sql = """
-            SELECT
-                TRACKING_GCLID AS GclId,
-                DATETIME_ADD(DATETIME(SALEDATE), INTERVAL 86399 SECOND) AS ConversionTime,
-                REVENUE AS ConversionValue
-            FROM `{0}.snow_conversions`
-            WHERE
-                REVENUE > 0
-                AND SALEDATE < CURRENT_DATE()
+            WITH c AS (
+                SELECT
+                    TRACKING_GCLID AS GclId,
+                    DATETIME_ADD(DATETIME(SALEDATE), INTERVAL 86399 SECOND) AS ConversionTime,
+                    REVENUE AS ConversionValue,
+                    SALEDATE
+                FROM `{0}.snow_conversions`
+                WHERE
+                    REVENUE > 0
+                    AND SALEDATE < CURRENT_DATE()
+            )
+            SELECT {2}
+            FROM c{1}
             ORDER BY SALEDATE DESC
-            LIMIT 2000
-        """.format(
-            dataset_name
-        )
+        """
+
+        ### The Arrow reader gets every column of the file, already formatted
+        if reader == 'arrow':
+            columns = """
+                GclId,
+                'Commissions' AS ConversionName,
+                FORMAT_DATETIME('%Y-%m-%d %H:%M:%S', ConversionTime) AS ConversionTime,
+                ConversionValue,
+                'EUR' AS ConversionCurrency"""
+        else:
+            columns = "GclId, ConversionTime, ConversionValue"
+        return sql.format(dataset_name, ledger_filter, columns)
+
+    def run_query(self, query):
 
         ### Fire query to BigQuery
         logging.info("Firing BigQuery query")
-        query_job = bq_client.query(sql)
-        query_results = query_job.result()
+        with self.metrics.timer('export', 'bq_query') as event:
+            query_job = self.planner.run(
+                query, label=self.query_label, reuse=True, remember=False
+            )
+            if query_job is not None:
+                self.metrics.record_job(event, query_job)
+        return query_job
+
+    def get_conversions_from_bq(self, query_job):
 
         ### Load query results into a list
+        query_results = query_job.result()
         bq_list = []
         for row in query_results:
             bq_list.append(list(row))
         logging.info("Query results saved")
         return bq_list
 
-    def transform_results(self, bq_list):
+    def read_arrow(self, query_job, max_rows, max_bytes, keep_batches=False):
+
+        ### Record batches are written to the files as they arrive
+        writer = bq_reader.CsvShardWriter(
+            HEADER_ROWS, max_rows, max_bytes, keep_batches=keep_batches
+        )
+        io_objects = writer.write_batches(
+            bq_reader.read_batches(query_job, self.read_client)
+        )
+        logging.info(
+            "{} conversion(s) split into {} file(s)".format(
+                writer.rows, len(io_objects)
+            )
+        )
+        if not keep_batches or not writer.rows:
+            return io_objects, None, writer.rows
+
+        ### Ledger rows, from the same batches
+        table = writer.table().select(['GclId', 'ConversionTime', 'ConversionValue'])
+        exported_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        table = table.append_column(
+            'ExportedAt', pa.repeat(exported_at, table.num_rows)
+        )
+        return io_objects, bq_reader.csv_bytes(table), writer.rows
+
+    def transform_results(
+        self, bq_list, max_rows=MAX_SHARD_ROWS, max_bytes=MAX_SHARD_BYTES
+    ):
+
+        ### Only the row-by-row reader needs pandas
+        import pandas as pd
 
         logging.info("Transforming query results")
 
@@ -60,14 +222,8 @@ class ExportConversionsAdwords:
         df['Conversion Name'] = 'Commissions'
         df['Conversion Currency'] = 'EUR'
 
-        ### Create IO object and add header row
-        io_object = io.StringIO()
-        header_row = ["Parameters:TimeZone=Europe/Paris,,,,\n"]
-        io_object.writelines(header_row)
-
-        ### Write DataFrame to IO object
-        df.to_csv(
-            io_object,
+        ### Write DataFrame to CSV lines
+        lines = df.to_csv(
             index=False,
             columns=[
                 'Google Click ID',
@@ -76,8 +232,123 @@ class ExportConversionsAdwords:
                 'Conversion Value',
                 'Conversion Currency',
             ],
+        ).splitlines(keepends=True)
+
+        ### Split the rows into files under the import limits, each one
+        ### starting with the header rows
+        header_rows = ["Parameters:TimeZone=Europe/Paris,,,,\n", lines[0]]
+        header_size = sum(len(row.encode('utf-8')) for row in header_rows)
+        io_objects = []
+        nb_rows, size = 0, header_size
+        for line in lines[1:] or [None]:
+            if (
+                not io_objects
+                or nb_rows >= max_rows
+                or size + len(line.encode('utf-8')) > max_bytes
+            ):
+                io_object = io.StringIO()
+                io_object.writelines(header_rows)
+                io_objects.append(io_object)
+                nb_rows, size = 0, header_size
+            if line is not None:
+                io_object.write(line)
+                nb_rows += 1
+                size += len(line.encode('utf-8'))
+        logging.info(
+            "{} conversion(s) split into {} file(s)".format(
+                len(bq_list), len(io_objects)
+            )
+        )
+        return io_objects
+
+    def shard_name(self, blob_name, index):
+
+        ### The first file keeps the original name, so that existing
+        ### scheduled imports still find it
+        if index == 0:
+            return blob_name
+        stem, extension = blob_name.rsplit('.', 1)
+        return '{}_{:03d}.{}'.format(stem, index + 1, extension)
+
+    def upload_shards(self, gs_client, io_objects, bucket_name, blob_name):
+
+        public_urls = []
+        for index, io_object in enumerate(io_objects):
+            public_urls.append(
+                self.upload_to_gs(
+                    gs_client, io_object, bucket_name, self.shard_name(blob_name, index)
+                )
+            )
+
+        ### Remove the extra files left by a previous, larger export
+        stem, extension = blob_name.rsplit('.', 1)
+        pattern = re.compile(r'^{}_\d{{3}}\.{}$'.format(re.escape(stem), extension))
+        names = set(self.shard_name(blob_name, i) for i in range(len(io_objects)))
+        bucket = gs_client.get_bucket(bucket_name)
+        for blob in bucket.list_blobs(prefix=stem + '_'):
+            if pattern.match(blob.name) and blob.name not in names:
+                blob.delete()
+                logging.info("Stale blob '{}' deleted".format(blob.name))
+        return public_urls
+
+    def ledger_rows(self, bq_list):
+
+        exported_at = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        report_data = io.StringIO()
+        writer = csv.writer(report_data, lineterminator='\n')
+        for gclid, conversion_time, conversion_value in bq_list:
+            writer.writerow([gclid, conversion_time, conversion_value, exported_at])
+        return report_data.getvalue().encode('utf-8'), len(bq_list)
+
+    def record_exported(self, bq_client, dataset_name, ledger_data, nb_rows):
+
+        ### The exported conversions go to a staging table first. Only those
+        ### not in the ledger yet are added, keeping their first export time.
+        dataset_ref = bq_client.dataset(dataset_name)
+        table = bq_client.get_table(dataset_ref.table(self.ledger_name))
+        stage_name = '{}_stage_{}'.format(self.ledger_name, uuid.uuid4().hex[:8])
+        stage = bigquery.Table(dataset_ref.table(stage_name), schema=table.schema)
+        stage.expires = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        bq_client.create_table(stage)
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.CSV
+        job_config.write_disposition = 'WRITE_TRUNCATE'
+        job_config.schema = table.schema
+        try:
+            with self.metrics.timer('export', 'bq_load', table=stage_name) as event:
+                source = io.BytesIO(ledger_data)
+                event['bytes_out'] = len(ledger_data)
+                load_job = bq_client.load_table_from_file(
+                    source, dataset_ref.table(stage_name), job_config=job_config
+                )
+                load_job.result()
+                self.metrics.record_job(event, load_job)
+            query = """
+            MERGE `{0}.{1}` AS e
+            USING `{0}.{2}` AS s
+            ON e.GclId = s.GclId AND e.ConversionTime = s.ConversionTime
+            WHEN NOT MATCHED THEN
+                INSERT ROW
+            """.format(
+                dataset_name, self.ledger_name, stage_name
+            )
+            with self.metrics.timer(
+                'export', 'bq_query', table=self.ledger_name
+            ) as event:
+                query_job = self.planner.run(
+                    query, label='{}.ledger'.format(dataset_name)
+                )
+                self.metrics.record_job(event, query_job)
+        finally:
+            bq_client.delete_table(dataset_ref.table(stage_name), not_found_ok=True)
+        logging.info(
+            "{} conversion(s) exported, {} new in '{}.{}'".format(
+                nb_rows,
+                query_job.num_dml_affected_rows,
+                dataset_name,
+                self.ledger_name,
+            )
         )
-        return io_object
 
     def upload_to_gs(self, gs_client, io_object, bucket_name, blob_name):
 
@@ -86,8 +357,13 @@ class ExportConversionsAdwords:
         blob = bucket.blob(blob_name)
 
         ### Upload blob
-        io_object.seek(0)
-        blob.upload_from_file(io_object)
+        with self.metrics.timer('export', 'gcs_upload', blob=blob_name) as event:
+            content = io_object.getvalue()
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            event['bytes_out'] = len(content)
+            io_object.seek(0)
+            blob.upload_from_file(io_object)
 
         ### Make public
         blob.make_public()
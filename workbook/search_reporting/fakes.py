@@ -0,0 +1,826 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import os
+import io
+import re
+import glob
+import gzip
+import shutil
+import socket
+import time
+import random
+import datetime
+import threading
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from google.api_core import exceptions
+
+### Load project modules
+import join_backends
+import snow_unload
+import storage_write
+
+### Rows generated per write to a report buffer
+WRITE_ROWS = 1000
+
+DEVICES = ['DESKTOP', 'MOBILE', 'TABLET']
+
+CONVERSION_COLUMNS = [
+    'CLICK_TIMESTAMP',
+    'SALEDATE',
+    'TRACKING_GCLID',
+    'ORDERS',
+    'REVENUE',
+    'SALES_VALUE',
+]
+
+
+class SyntheticData:
+    def __init__(
+        self,
+        accounts=10,
+        days=7,
+        clicks=1000,
+        keywords=200,
+        conversions=5000,
+        date_end=None,
+        seed=42,
+    ):
+
+        ### Every click has a GCLID, conversions are drawn among the clicks
+        self.nb_accounts = accounts
+        self.days = days
+        self.clicks = clicks
+        self.keywords = keywords
+        self.conversions = conversions
+        self.seed = seed
+        self.mcc = 1000000000
+        self.accounts = [self.mcc + 1 + i for i in range(accounts)]
+        if date_end is None:
+            date_end = datetime.date.today() - datetime.timedelta(1)
+        self.dates = [date_end - datetime.timedelta(days - 1 - i) for i in range(days)]
+
+    def account_name(self, account_id):
+
+        return 'Site{} Account {}'.format(account_id % 2 + 1, account_id)
+
+    def gclid(self, account_id, date, index):
+
+        return 'gclid-{}-{:%Y%m%d}-{}'.format(account_id, date, index)
+
+    def keyword(self, account_id, index):
+
+        ### AdGroupId, CreativeId and KeywordId of a keyword, unique per account
+        base = (account_id - self.mcc) * 1000000
+        return base + index // 10, base + 500000 + index, base + 900000 + index
+
+    def click_rows(self, account_id, date):
+
+        name = self.account_name(account_id)
+        for i in range(self.clicks):
+            keyword = self.keyword(account_id, i % self.keywords)
+            adgroup_id, creative_id, keyword_id = keyword
+            yield [
+                name,
+                'SEA-partner-{}'.format(adgroup_id),
+                adgroup_id,
+                creative_id,
+                keyword_id,
+                str(date),
+                DEVICES[i % 3],
+                self.gclid(account_id, date, i),
+                1,
+                account_id,
+            ]
+
+    def adperf_rows(self, account_id, dates):
+
+        ### One generator per day, the same rows whatever the date ranges
+        name = self.account_name(account_id)
+        for date in dates:
+            rng = random.Random((self.seed + account_id) * 100003 + date.toordinal())
+            for i in range(self.keywords):
+                adgroup_id, creative_id, keyword_id = self.keyword(account_id, i)
+                for device in DEVICES:
+                    yield [
+                        name,
+                        'SEA-partner-{}'.format(adgroup_id),
+                        adgroup_id // 100,
+                        'AdGroup {}'.format(adgroup_id),
+                        adgroup_id,
+                        'enabled',
+                        creative_id,
+                        keyword_id,
+                        device,
+                        str(date),
+                        rng.randint(0, 5000000),
+                        rng.randint(0, 1000),
+                        rng.randint(0, 50),
+                        rng.randint(0, 3),
+                        '{:.1f}'.format(rng.uniform(1, 5)),
+                        account_id,
+                    ]
+
+    def keyword_rows(self, account_id):
+
+        name = self.account_name(account_id)
+        for i in range(self.keywords):
+            adgroup_id, creative_id, keyword_id = self.keyword(account_id, i)
+            yield [
+                name,
+                adgroup_id,
+                'keyword {}'.format(i),
+                'EXACT',
+                keyword_id,
+                account_id,
+            ]
+
+    def conversion_rows(self):
+
+        ### CLICK_TIMESTAMP, SALEDATE, TRACKING_GCLID, ORDERS, REVENUE, SALES_VALUE
+        rng = random.Random(self.seed)
+        for _ in range(self.conversions):
+            account_id = rng.choice(self.accounts)
+            date = rng.choice(self.dates)
+            click = datetime.datetime.combine(date, datetime.time(rng.randint(0, 23)))
+            revenue = round(rng.uniform(1, 100), 2)
+            yield (
+                click,
+                date,
+                self.gclid(account_id, date, rng.randrange(self.clicks)),
+                1,
+                revenue,
+                revenue * 10,
+            )
+
+    def export_rows(self, nb_rows):
+
+        ### GclId, ConversionTime, ConversionValue
+        for i, row in enumerate(self.conversion_rows()):
+            if i >= nb_rows:
+                break
+            yield (
+                row[2],
+                datetime.datetime.combine(row[1], datetime.time(23, 59, 59)),
+                row[4],
+            )
+
+
+def sleep(latency):
+
+    ### Latency of one call to a remote service, with some jitter
+    if latency:
+        time.sleep(random.uniform(0.5, 1.5) * latency)
+
+
+def csv_line(row):
+
+    return ','.join(str(value) for value in row) + '\n'
+
+
+class FakeReportDownloader:
+    def __init__(self, client):
+
+        self.client = client
+
+    def DownloadReportAsStream(self, report, **kwargs):
+
+        return FakeReportStream(
+            chunk.encode('utf-8') for chunk in self.report_chunks(report)
+        )
+
+    def report_chunks(self, report):
+
+        sleep(self.client.latency)
+        data = self.client.data
+        account_id = int(self.client.client_customer_id)
+        date_range = report['selector']['dateRange']
+        if report['reportType'] == 'CLICK_PERFORMANCE_REPORT':
+            date = datetime.datetime.strptime(date_range['min'], "%Y-%m-%d").date()
+            rows = data.click_rows(account_id, date)
+        elif report['reportType'] == 'AD_PERFORMANCE_REPORT':
+            dates = [
+                date
+                for date in data.dates
+                if date_range['min'] <= str(date) <= date_range['max']
+            ]
+            days = (
+                datetime.date.fromisoformat(date_range['max'])
+                - datetime.date.fromisoformat(date_range['min'])
+            ).days + 1
+            if self.client.max_report_days and days > self.client.max_report_days:
+                raise socket.timeout("The read operation timed out")
+            rows = data.adperf_rows(account_id, dates)
+        elif report['reportType'] == 'KEYWORDS_PERFORMANCE_REPORT':
+            rows = data.keyword_rows(account_id)
+        else:
+            raise Exception("Unknown report type '{}'".format(report['reportType']))
+
+        ### Reports are produced in chunks, like the streamed download
+        lines = []
+        for row in rows:
+            lines.append(csv_line(row))
+            if len(lines) >= WRITE_ROWS:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+
+class FakeReportStream:
+    def __init__(self, chunks):
+
+        ### Reads the response body as it is produced, like an HTTP response
+        self.chunks = chunks
+        self.pending = b''
+        self.closed = False
+
+    def read(self, size=-1):
+
+        while size < 0 or len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def close(self):
+
+        self.closed = True
+
+
+class FakeManagedCustomerService:
+    def __init__(self, data, latency=0):
+
+        self.data = data
+        self.latency = latency
+
+    def get(self, selector):
+
+        ### The MCC first, then every client account under it
+        sleep(self.latency)
+        offset = int(selector['paging']['startIndex'])
+        size = int(selector['paging']['numberResults'])
+        customers = [self.data.mcc] + self.data.accounts
+        entries = [
+            {
+                'customerId': customer_id,
+                'canManageClients': customer_id == self.data.mcc,
+            }
+            for customer_id in customers[offset : offset + size]
+        ]
+        links = [
+            {'managerCustomerId': self.data.mcc, 'clientCustomerId': e['customerId']}
+            for e in entries
+            if not e['canManageClients']
+        ]
+        return {'totalNumEntries': len(customers), 'entries': entries, 'links': links}
+
+
+class FakeAdwordsClient:
+    def __init__(self, data, latency=0, max_report_days=None):
+
+        ### Ad Performance reports over more than max_report_days time out
+        self.data = data
+        self.latency = latency
+        self.max_report_days = max_report_days
+        self.client_customer_id = None
+
+    def SetClientCustomerId(self, client_customer_id):
+
+        self.client_customer_id = client_customer_id
+
+    def GetReportDownloader(self, version=None):
+
+        return FakeReportDownloader(self)
+
+    def GetService(self, service_name, version=None):
+
+        if service_name != 'ManagedCustomerService':
+            raise Exception("Unknown service '{}'".format(service_name))
+        return FakeManagedCustomerService(self.data, self.latency)
+
+
+class FakeRowIterator:
+    def __init__(self, rows, columns=None, schema=None):
+
+        ### With a BigQuery schema, Arrow columns get the types of the table
+        self.rows = list(rows)
+        self.columns = columns
+        self.schema = schema
+        self.total_rows = len(self.rows)
+
+    def __iter__(self):
+
+        return iter(self.rows)
+
+    def to_arrow(self, bqstorage_client=None):
+
+        if self.schema is not None:
+            return pa.Table.from_pylist(
+                [dict(zip(self.columns, row)) for row in self.rows],
+                schema=pa.schema(
+                    [
+                        (field.name, join_backends.ARROW_TYPES[field.field_type])
+                        for field in self.schema
+                    ]
+                ),
+            )
+        if self.columns is None:
+            return pa.table({})
+        columns = list(zip(*self.rows)) or [[] for _ in self.columns]
+        return pa.table([list(column) for column in columns], names=self.columns)
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+
+        return iter(self.to_arrow().to_batches(max_chunksize=10000))
+
+
+class FakeJob:
+    def __init__(self, client, rows=None, columns=None, **stats):
+
+        self.client = client
+        self.job_id = 'fake_{}'.format(id(self))
+        self.rows = rows or []
+        self.columns = columns
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.slot_millis = 0
+        self.output_rows = None
+        self.num_dml_affected_rows = None
+        self.referenced_tables = []
+        self.__dict__.update(stats)
+
+    def result(self):
+
+        sleep(self.client.latency)
+        return FakeRowIterator(self.rows, self.columns)
+
+
+class FakeBigQueryClient:
+    def __init__(self, data, latency=0, project='benchmark', row_bytes=100):
+
+        ### Only row counts are kept, never the loaded data itself
+        self.data = data
+        self.latency = latency
+        self.project = project
+        self.row_bytes = row_bytes
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.rows = {}
+
+    def table_id(self, table_ref):
+
+        if isinstance(table_ref, str):
+            if table_ref.count('.') > 1:
+                return table_ref.split('.', 1)[-1]
+            return table_ref
+        reference = getattr(table_ref, 'reference', table_ref)
+        return '{}.{}'.format(reference.dataset_id, reference.table_id)
+
+    def dataset(self, dataset_name):
+
+        return bigquery.DatasetReference(self.project, dataset_name)
+
+    def touch(self, table_id, nb_rows):
+
+        ### Update the row count and last modification of a table
+        with self.lock:
+            self.rows[table_id] = max(0, nb_rows)
+            properties = self.tables[table_id]._properties
+            properties['numRows'] = str(self.rows[table_id])
+            properties['lastModifiedTime'] = str(int(time.time() * 1000))
+
+    def get_table(self, table_ref):
+
+        table_id = self.table_id(table_ref)
+        with self.lock:
+            table = self.tables.get(table_id)
+        if table is None:
+            raise exceptions.NotFound("Table {} not found".format(table_id))
+        return table
+
+    def create_table(self, table, exists_ok=False):
+
+        table_id = self.table_id(table)
+        with self.lock:
+            if table_id in self.tables and not exists_ok:
+                raise exceptions.Conflict("Table {} already exists".format(table_id))
+            self.tables.setdefault(table_id, table)
+            self.rows.setdefault(table_id, 0)
+        self.touch(table_id, self.rows[table_id])
+        return table
+
+    def delete_table(self, table_ref, not_found_ok=False):
+
+        table_id = self.table_id(table_ref)
+        with self.lock:
+            if table_id not in self.tables and not not_found_ok:
+                raise exceptions.NotFound("Table {} not found".format(table_id))
+            self.tables.pop(table_id, None)
+            self.rows.pop(table_id, None)
+
+    def count_rows(self, file_obj, job_config):
+
+        head = file_obj.read(2)
+        file_obj.seek(-len(head), io.SEEK_CUR)
+        source = file_obj
+        if head == b'\x1f\x8b':
+            source = gzip.GzipFile(fileobj=file_obj, mode='rb')
+        nb_lines = 0
+        while True:
+            chunk = source.read(1024 * 1024)
+            if not chunk:
+                break
+            nb_lines += chunk.count(b'\n' if isinstance(chunk, bytes) else '\n')
+        return max(0, nb_lines - (getattr(job_config, 'skip_leading_rows', 0) or 0))
+
+    def load_table_from_uri(self, source_uris, table_ref, job_config=None, **kwargs):
+
+        ### Only local Parquet files, from a filesystem stage
+        sleep(self.latency)
+        nb_rows = 0
+        for uri in [source_uris] if isinstance(source_uris, str) else source_uris:
+            if not uri.startswith('file://'):
+                raise exceptions.BadRequest("Unsupported URI {}".format(uri))
+            paths = glob.glob(uri[len('file://') :])
+            if not paths:
+                raise exceptions.NotFound("No file matches {}".format(uri))
+            nb_rows += sum(pq.read_metadata(path).num_rows for path in paths)
+        return self.load_rows(table_ref, job_config, nb_rows)
+
+    def load_table_from_file(self, file_obj, table_ref, job_config=None, **kwargs):
+
+        ### Count the rows of the CSV, compressed or not, or of the Parquet file
+        sleep(self.latency)
+        if getattr(job_config, 'source_format', None) == 'PARQUET':
+            nb_rows = pq.read_metadata(file_obj).num_rows
+        else:
+            nb_rows = self.count_rows(file_obj, job_config)
+        return self.load_rows(table_ref, job_config, nb_rows)
+
+    def load_rows(self, table_ref, job_config, nb_rows):
+
+        table_id = self.table_id(table_ref)
+        schema = getattr(job_config, 'schema', None) or []
+        try:
+            self.get_table(table_ref)
+        except exceptions.NotFound:
+            self.create_table(bigquery.Table(table_ref, schema=schema))
+        total = nb_rows
+        if getattr(job_config, 'write_disposition', None) != 'WRITE_TRUNCATE':
+            total += self.rows.get(table_id, 0)
+        self.touch(table_id, total)
+        return FakeJob(self, output_rows=nb_rows)
+
+    def list_rows(self, table):
+
+        ### Only keyword names have content, other tables are read empty
+        table = self.get_table(table)
+        rows = []
+        if table.table_id == 'adw_kw_names':
+            rows = [
+                [str(value) for value in row]
+                for account_id in self.data.accounts
+                for row in self.data.keyword_rows(account_id)
+            ]
+        sleep(self.latency)
+        return FakeRowIterator(rows, [f.name for f in table.schema], table.schema)
+
+    def query(self, query, job_config=None, **kwargs):
+
+        ### Tables are found by their `dataset.table` names in the query
+        tables = []
+        for table_id in re.findall(r'`([\w-]+\.[\w-]+)`', query):
+            if table_id not in tables:
+                tables.append(table_id)
+        with self.lock:
+            missing = [t for t in tables if t not in self.tables]
+        if missing:
+            raise exceptions.NotFound("Table {} not found".format(missing[0]))
+        processed = sum(self.rows.get(t, 0) for t in tables) * self.row_bytes
+        stats = {
+            'total_bytes_processed': processed,
+            'referenced_tables': [bigquery.TableReference.from_string(
+                '{}.{}'.format(self.project, t)
+            ) for t in tables],
+        }
+        if getattr(job_config, 'dry_run', False):
+            return FakeJob(self, **stats)
+
+        sleep(self.latency)
+        stats['total_bytes_billed'] = max(10 * 1024 * 1024, processed)
+        stats['slot_millis'] = processed // 10000
+        rows, columns = [], None
+        statement = query.strip().upper()
+
+        ### High-water mark of the conversions
+        if statement.startswith('SELECT MAX('):
+            has_rows = self.rows.get(tables[0], 0) > 0
+            rows = [(max(self.data.dates) if has_rows else None,)]
+
+        ### Keywords per account, once their table was loaded
+        elif 'AS NB_KEYS' in statement:
+            if self.rows.get(tables[0], 0) > 0:
+                rows = [(str(a), self.data.keywords) for a in self.data.accounts]
+
+        ### Converting GCLIDs
+        elif 'DISTINCT TRACKING_GCLID' in statement:
+            rows = sorted(set((row[2],) for row in self.data.conversion_rows()))
+
+        ### Conversions export, only those missing from the ledger
+        elif 'CONVERSIONTIME' in statement and 'snow_conversions' in query:
+            nb_rows = self.rows.get(tables[0], 0)
+            for table_id in tables[1:]:
+                nb_rows -= self.rows.get(table_id, 0)
+            rows = list(self.data.export_rows(max(0, nb_rows)))
+            if 'CONVERSIONNAME' in statement:
+                columns = [
+                    'GclId',
+                    'ConversionName',
+                    'ConversionTime',
+                    'ConversionValue',
+                    'ConversionCurrency',
+                ]
+                rows = [
+                    (g, 'Commissions', '{:%Y-%m-%d %H:%M:%S}'.format(t), v, 'EUR')
+                    for g, t, v in rows
+                ]
+            else:
+                columns = ['GclId', 'ConversionTime', 'ConversionValue']
+
+        ### Writes: MERGE, INSERT and scripts insert the rows of their source
+        elif 'MERGE ' in statement or 'INSERT INTO' in statement:
+            target, sources = tables[0], tables[1:]
+            nb_rows = sum(self.rows.get(t, 0) for t in sources)
+            self.touch(target, self.rows.get(target, 0) + nb_rows)
+            stats['num_dml_affected_rows'] = nb_rows
+
+        ### Query results written to a destination table
+        destination = getattr(job_config, 'destination', None)
+        if destination is not None:
+            table_id = self.table_id(destination)
+            nb_rows = max([self.rows.get(t, 0) for t in tables] or [0])
+            try:
+                self.get_table(destination)
+            except exceptions.NotFound:
+                self.create_table(bigquery.Table(destination))
+            self.touch(table_id, nb_rows)
+            stats['output_rows'] = nb_rows
+        return FakeJob(self, rows, columns, **stats)
+
+
+class FakeBigQueryWriteClient:
+    def __init__(self, bq_client, latency=0):
+
+        ### Pending streams of the Storage Write API. Rows are decoded with the
+        ### writer schema and counted, then added to the table on commit.
+        self.bq_client = bq_client
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.streams = {}
+
+    def table_path(self, project, dataset, table):
+
+        return 'projects/{}/datasets/{}/tables/{}'.format(project, dataset, table)
+
+    def create_write_stream(self, parent, write_stream, **kwargs):
+
+        sleep(self.latency)
+        table_id = '.'.join(parent.split('/')[3::2])
+        self.bq_client.get_table(table_id)
+        with self.lock:
+            name = '{}/streams/{}'.format(parent, len(self.streams))
+            self.streams[name] = {
+                'table': table_id,
+                'rows': 0,
+                'finalized': False,
+                'committed': None,
+            }
+        return storage_write.types.WriteStream(name=name, type_=write_stream.type_)
+
+    def append_rows(self, requests, **kwargs):
+
+        ### Every row must decode, and every request start where the last ended
+        sleep(self.latency)
+        responses = []
+        name = row_class = None
+        for request in requests:
+            if row_class is None:
+                name = request.write_stream
+                row_class = storage_write.message_class(
+                    request.proto_rows.writer_schema.proto_descriptor
+                )
+            stream = self.streams[name]
+            if stream['finalized'] or request.offset != stream['rows']:
+                raise exceptions.OutOfRange(
+                    "Offset {} of stream {}".format(request.offset, name)
+                )
+            for serialized in request.proto_rows.rows.serialized_rows:
+                row_class.FromString(serialized)
+            stream['rows'] += len(request.proto_rows.rows.serialized_rows)
+            responses.append(
+                storage_write.types.AppendRowsResponse(
+                    append_result={'offset': request.offset}
+                )
+            )
+        return responses
+
+    def finalize_write_stream(self, name, **kwargs):
+
+        self.streams[name]['finalized'] = True
+        return storage_write.types.FinalizeWriteStreamResponse(
+            row_count=self.streams[name]['rows']
+        )
+
+    def batch_commit_write_streams(self, request, **kwargs):
+
+        sleep(self.latency)
+        commit_time = datetime.datetime.now(datetime.timezone.utc)
+        for name in request.write_streams:
+            stream = self.streams[name]
+            if not stream['finalized'] or stream['committed']:
+                return storage_write.types.BatchCommitWriteStreamsResponse(
+                    stream_errors=[{'entity': name, 'error_message': 'Not pending'}]
+                )
+        for name in request.write_streams:
+            stream = self.streams[name]
+            stream['committed'] = commit_time
+            self.bq_client.touch(
+                stream['table'],
+                self.bq_client.rows.get(stream['table'], 0) + stream['rows'],
+            )
+        return storage_write.types.BatchCommitWriteStreamsResponse(
+            commit_time=commit_time
+        )
+
+    def get_write_stream(self, name, **kwargs):
+
+        stream = self.streams.get(name)
+        if stream is None:
+            raise exceptions.NotFound("Stream {} not found".format(name))
+        return storage_write.types.WriteStream(
+            name=name, commit_time=stream['committed']
+        )
+
+
+class FakeSnowflakeCursor:
+    def __init__(self, connection, as_dict=False):
+
+        self.connection = connection
+        self.as_dict = as_dict
+        self.rows = iter([])
+        self.description = []
+
+    def execute(self, query):
+
+        ### Unloads and removals go to the filesystem stage of the connection
+        sleep(self.connection.latency)
+        stage = self.connection.stage
+        statement = query.strip().upper()
+        if statement.startswith('COPY INTO') or statement.startswith('REMOVE'):
+            if stage is None or stage.name.upper() not in statement:
+                raise Exception("Stage not found in query: {}".format(query))
+            prefix = re.search(r'@[\w.]+/(\S+)/', query).group(1)
+        if statement.startswith('COPY INTO'):
+            table = pa.table(
+                list(zip(*self.connection.data.conversion_rows())),
+                names=CONVERSION_COLUMNS,
+            )
+            self.description = [('rows_unloaded',), ('input_bytes',), ('output_bytes',)]
+            self.rows = iter([stage.write(prefix, table)])
+        elif statement.startswith('REMOVE'):
+            stage.remove(prefix)
+        elif 'ADWORDS_GCLID_AGGREGATION' in query:
+            self.description = [(column,) for column in CONVERSION_COLUMNS]
+            self.rows = self.connection.data.conversion_rows()
+        return self
+
+    def format(self, row):
+
+        if self.as_dict:
+            return dict(zip([column[0] for column in self.description], row))
+        return row
+
+    def fetchmany(self, size):
+
+        sleep(self.connection.latency)
+        return [self.format(row) for _, row in zip(range(size), self.rows)]
+
+    def fetchall(self):
+
+        sleep(self.connection.latency)
+        return [self.format(row) for row in self.rows]
+
+    def close(self):
+
+        pass
+
+
+class FakeSnowflakeConnection:
+    def __init__(self, data, latency=0, stage=None):
+
+        self.data = data
+        self.latency = latency
+        self.stage = stage
+
+    def cursor(self, cursor_class=None):
+
+        ### Any cursor class means a DictCursor
+        return FakeSnowflakeCursor(self, as_dict=cursor_class is not None)
+
+    def close(self):
+
+        pass
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+class FilesystemStage(snow_unload.UnloadStage):
+    def __init__(self, path, name='@LOCAL_UNLOAD'):
+
+        ### A Snowflake stage backed by a local directory, read by the fake
+        ### BigQuery client through file:// URIs
+        self.path = os.path.abspath(path)
+        super().__init__(name, 'file://' + self.path)
+
+    def write(self, prefix, table):
+
+        directory = os.path.join(self.path, prefix)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'data_0_0_0.snappy.parquet')
+        pq.write_table(table, path, compression='snappy')
+        return (table.num_rows, table.nbytes, os.path.getsize(path))
+
+    def remove(self, prefix):
+
+        shutil.rmtree(os.path.join(self.path, prefix), ignore_errors=True)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+
+        self.bucket = bucket
+        self.name = name
+        self.size = 0
+        self.public_url = 'https://storage.googleapis.com/{}/{}'.format(
+            bucket.name, name
+        )
+
+    def upload_from_file(self, file_obj, **kwargs):
+
+        sleep(self.bucket.latency)
+        self.size = len(file_obj.read())
+        with self.bucket.lock:
+            self.bucket.blobs[self.name] = self
+
+    def make_public(self):
+
+        pass
+
+    def delete(self):
+
+        with self.bucket.lock:
+            self.bucket.blobs.pop(self.name, None)
+
+
+class FakeBucket:
+    def __init__(self, name, latency=0):
+
+        self.name = name
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.blobs = {}
+
+    def blob(self, name):
+
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=''):
+
+        with self.lock:
+            return [b for n, b in sorted(self.blobs.items()) if n.startswith(prefix)]
+
+
+class FakeStorageClient:
+    def __init__(self, latency=0):
+
+        self.latency = latency
+        self.buckets = {}
+
+    def get_bucket(self, bucket_name):
+
+        if bucket_name not in self.buckets:
+            self.buckets[bucket_name] = FakeBucket(bucket_name, self.latency)
+        return self.buckets[bucket_name]
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import csv
+import array
+import bisect
+import hashlib
+
+### Load project modules
+import buffers
+
+### Columns of the click performance report
+KEY_COLUMNS = 7
+GCLID_COLUMN = 7
+CLICKS_COLUMN = 8
+
+
+def gclid_hash(gclid):
+
+    ### 64-bit hashes: collisions only keep a few extra clicks
+    return int.from_bytes(
+        hashlib.blake2b(gclid.encode('utf-8'), digest_size=8).digest(), 'little'
+    )
+
+
+class GclidFilter:
+    def __init__(self, hashes=()):
+
+        ### Sorted hashes of the converting GCLIDs, 8 bytes per GCLID
+        self.hashes = array.array('Q', sorted(set(hashes)))
+        self.pending = array.array('Q')
+
+    def add(self, gclid):
+
+        if gclid:
+            self.pending.append(gclid_hash(gclid))
+
+    def freeze(self):
+
+        if self.pending:
+            self.hashes = array.array('Q', sorted(set(self.hashes) | set(self.pending)))
+            self.pending = array.array('Q')
+        return self
+
+    def __contains__(self, gclid):
+
+        value = gclid_hash(gclid)
+        index = bisect.bisect_left(self.hashes, value)
+        return index < len(self.hashes) and self.hashes[index] == value
+
+    def __len__(self):
+
+        return len(self.hashes)
+
+    def add_from_bigquery(self, bq_client, dataset_name, planner=None):
+
+        ### Every converting GCLID already in the conversions table
+        query = """
+        SELECT DISTINCT TRACKING_GCLID
+        FROM `{0}.snow_conversions`
+        WHERE TRACKING_GCLID IS NOT NULL
+        """.format(
+            dataset_name
+        )
+        if planner is not None:
+            query_job = planner.run(query, label='converting_gclids')
+        else:
+            query_job = bq_client.query(query)
+        for row in query_job.result():
+            self.add(row[0])
+        return self.freeze()
+
+    def save(self, path):
+
+        self.freeze()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            self.hashes.tofile(f)
+        os.replace(tmp_path, path)
+        logging.info("{} converting GCLID(s) saved to '{}'".format(len(self), path))
+
+    @classmethod
+    def load(cls, path):
+
+        gclid_filter = cls()
+        with open(path, 'rb') as f:
+            gclid_filter.hashes.frombytes(f.read())
+        logging.info(
+            "{} converting GCLID(s) read from '{}'".format(len(gclid_filter), path)
+        )
+        return gclid_filter
+
+
+def read_lines(report_data):
+
+    ### Lines of a report buffer, across chunk boundaries
+    rest = ''
+    for chunk in report_data.read_chunks():
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def prune_clicks(report_data, gclid_filter, max_memory=64 * 1024 * 1024, event=None):
+
+    ### Converting clicks are kept one by one. The others are summed per
+    ### (account, campaign, ad group, ad, keyword, date, device, account ID),
+    ### without GCLID.
+    pruned = buffers.ReportBuffer(max_memory)
+    writer = csv.writer(pruned, lineterminator='\n')
+    aggregates = {}
+    rows_in = 0
+    rows_kept = 0
+    for row in csv.reader(read_lines(report_data)):
+        if not row:
+            continue
+        rows_in += 1
+        if row[GCLID_COLUMN] and row[GCLID_COLUMN] in gclid_filter:
+            writer.writerow(row)
+            rows_kept += 1
+            continue
+        key = tuple(row[:KEY_COLUMNS]) + tuple(row[CLICKS_COLUMN + 1 :])
+        aggregates[key] = aggregates.get(key, 0) + int(row[CLICKS_COLUMN] or 0)
+    for key, clicks in aggregates.items():
+        key = list(key)
+        writer.writerow(key[:KEY_COLUMNS] + ['', clicks] + key[KEY_COLUMNS:])
+
+    if event is not None:
+        event['rows'] = rows_in
+        event['bytes_in'] = report_data.size
+        event['bytes_out'] = pruned.size
+    logging.info(
+        "Clicks pruned: {} row(s) in, {} converting, {} aggregated row(s)".format(
+            rows_in, rows_kept, len(aggregates)
+        )
+    )
+    return pruned
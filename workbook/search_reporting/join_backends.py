@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import re
+import gzip
+import uuid
+import shutil
+import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv as pa_csv
+from google.cloud import bigquery
+from google.api_core import exceptions
+
+### Load project modules
+import bq_create_tables
+import bq_reader
+import metrics
+import query_planner
+
+### DuckDB is only needed by the local join backend
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+### Arrow types of the BigQuery columns
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'DATE': pa.date32(),
+    'TIMESTAMP': pa.timestamp('us'),
+    'DATETIME': pa.timestamp('us'),
+}
+
+### Tables read by the join
+JOIN_TABLES = ['adw_gclid_list', 'adw_keywords', 'adw_kw_names', 'snow_conversions']
+
+### Tables of which the join only reads the dates of the period
+DATED_TABLES = ['adw_gclid_list', 'adw_keywords']
+
+### Name of the local file holding the rows read from BigQuery
+REMOTE_NAME = 'bigquery'
+
+### Same join as JoinFinalTable.get_join_query, in the DuckDB dialect.
+### Conversions are already filtered on NB_ORDERS by the Snowflake extract.
+JOIN_QUERY = """
+WITH gclid AS (
+    SELECT *
+    FROM adw_gclid_list AS a
+    INNER JOIN (
+        SELECT *
+        FROM snow_conversions
+        WHERE TRACKING_GCLID IS NOT NULL
+    ) AS b
+    ON a.GclId = b.TRACKING_GCLID
+    WHERE a.Date BETWEEN $date_begin AND $date_end
+),
+kwnames AS (
+    SELECT
+        AdGroupId,
+        KeywordId,
+        Keyword
+    FROM adw_kw_names
+    QUALIFY ROW_NUMBER() OVER (
+        PARTITION BY AdGroupId, KeywordId ORDER BY Keyword
+    ) = 1
+)
+
+SELECT
+    CASE
+        WHEN kw.AccountDescriptiveName LIKE 'Site1%' THEN 'ST1'
+        WHEN kw.AccountDescriptiveName LIKE 'Site2%' THEN 'ST2'
+        ELSE 'Other'
+    END AS Site,
+    kw.AccountDescriptiveName AS AccountName,
+    kw.CampaignName AS CampaignName,
+    NULLIF(REGEXP_EXTRACT(kw.CampaignName, '^([A-Z]{2,6})-', 1), '') AS CampaignType,
+    LOWER(NULLIF(REGEXP_EXTRACT(kw.CampaignName, '^[A-Z]{2,6}-([A-Za-z''_\\.]+)-', 1), '')) AS Partner,
+    kw.AdGroupName AS AdGroupName,
+    kw.CreativeId AS CreativeId,
+    kwnames.Keyword AS Keyword,
+    kw.Device AS Device,
+    kw.Date AS Date,
+    kw.Cost/1000000 AS Cost,
+    kw.Impressions AS Impressions,
+    kw.Clicks AS Clicks,
+    kw.Conversions AS Conversions,
+    TRY_CAST(kw.AveragePosition AS DOUBLE) AS AveragePosition,
+    CAST(SUM(gclid.ORDERS) AS BIGINT) AS Orders,
+    ROUND(SUM(gclid.REVENUE), 4) AS Revenue,
+    ROUND(SUM(gclid.SALES_VALUE), 4) AS SalesValue
+
+FROM adw_keywords AS kw
+
+LEFT JOIN gclid
+ON
+    kw.AdGroupId = gclid.AdGroupId
+    AND kw.CreativeId = gclid.CreativeId
+    AND kw.KeywordId = gclid.KeywordId
+    AND kw.Date = gclid.Date
+    AND kw.Device = gclid.Device
+
+LEFT JOIN kwnames
+ON
+    kw.AdGroupId = kwnames.AdGroupId
+    AND kw.KeywordId = kwnames.KeywordId
+
+WHERE kw.Date BETWEEN $date_begin AND $date_end
+
+GROUP BY 1,2,3,4,5,6,7,8,9,10,11,12,13,14,15
+"""
+
+
+def arrow_schema(table_name):
+
+    return pa.schema(
+        [
+            (field.name, ARROW_TYPES[field.field_type])
+            for field in bq_create_tables.SCHEMAS[table_name]
+        ]
+    )
+
+
+class LocalSink:
+    def __init__(self, path, clear=True):
+
+        ### One directory of Parquet files per table. A resumed run keeps the
+        ### files written by the previous attempt.
+        self.path = path
+        if clear and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+
+    def table_dir(self, table_name):
+
+        return os.path.join(self.path, table_name)
+
+    def files(self, table_name):
+
+        directory = self.table_dir(table_name)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.endswith('.parquet')
+        )
+
+    def drop(self, table_name):
+
+        shutil.rmtree(self.table_dir(table_name), ignore_errors=True)
+
+    def file_path(self, table_name, name=None, truncate=False):
+
+        ### A named file is overwritten when its unit is written again, e.g.
+        ### by a resumed run, so that its rows are never read twice
+        if truncate:
+            self.drop(table_name)
+        os.makedirs(self.table_dir(table_name), exist_ok=True)
+        if name is None:
+            name = uuid.uuid4().hex
+        return os.path.join(
+            self.table_dir(table_name),
+            '{}.parquet'.format(re.sub(r'[^\w.-]', '_', name)),
+        )
+
+    def write_table(self, table_name, table, truncate=False, name=None):
+
+        path = self.file_path(table_name, name, truncate)
+        tmp_path = path + '.tmp'
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def write_batches(self, table_name, schema, batches, name=None):
+
+        ### Record batches written one at a time, without the whole table
+        path = self.file_path(table_name, name)
+        tmp_path = path + '.tmp'
+        nb_rows = nb_bytes = 0
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for batch in batches:
+                writer.write_table(pa.Table.from_batches([batch]).cast(schema))
+                nb_rows += batch.num_rows
+                nb_bytes += batch.nbytes
+        os.replace(tmp_path, path)
+        return nb_rows, nb_bytes
+
+    def write(
+        self, table_name, report_data, header=False, truncate=False, name=None
+    ):
+
+        ### CSV reports, compressed or not, converted with the standard schema
+        ### of the table. The report is rewound for the BigQuery load.
+        schema = arrow_schema(table_name)
+        position = report_data.tell()
+        source = report_data
+        if report_data.read(2) == b'\x1f\x8b':
+            report_data.seek(position)
+            source = gzip.GzipFile(fileobj=report_data, mode='rb')
+        else:
+            report_data.seek(position)
+            if not isinstance(report_data.read(0), bytes):
+                source = pa.py_buffer(report_data.read().encode('utf-8'))
+        table = pa_csv.read_csv(
+            source,
+            read_options=pa_csv.ReadOptions(
+                column_names=schema.names, skip_rows=1 if header else 0
+            ),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=schema, strings_can_be_null=True
+            ),
+        )
+        report_data.seek(position)
+        self.write_table(table_name, table, truncate, name)
+        return table.num_rows
+
+
+class DuckDBBackend:
+    def __init__(
+        self,
+        sink,
+        bq_client,
+        dataset_name,
+        run_metrics=None,
+        planner=None,
+        local_dates=None,
+        read_client=None,
+    ):
+
+        ### local_dates is the (first, last) date of the Adwords tables
+        ### written to the sink by the run. Without a Storage Read client,
+        ### tables are downloaded through REST.
+        if duckdb is None:
+            raise Exception("The local join backend needs the duckdb package")
+        self.sink = sink
+        self.bq_client = bq_client
+        self.dataset_name = dataset_name
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.planner = planner or query_planner.QueryPlanner(bq_client)
+        self.local_dates = local_dates
+        self.read_client = read_client
+
+    def period_config(self, date_begin, date_end, local_dates=None):
+
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [
+            bigquery.ScalarQueryParameter('date_begin', 'DATE', str(date_begin)),
+            bigquery.ScalarQueryParameter('date_end', 'DATE', str(date_end)),
+        ]
+        if local_dates is not None:
+            local_begin, local_end = local_dates
+            job_config.query_parameters += [
+                bigquery.ScalarQueryParameter('local_begin', 'DATE', str(local_begin)),
+                bigquery.ScalarQueryParameter('local_end', 'DATE', str(local_end)),
+            ]
+        return job_config
+
+    def download(self, table_name, date_begin, date_end, local_dates=None):
+
+        ### Tables not written locally by this run are read from BigQuery. Of
+        ### the daily Adwords tables, only the dates of the join are read,
+        ### except those already written locally.
+        table_ref = self.bq_client.dataset(self.dataset_name).table(table_name)
+        schema = arrow_schema(table_name)
+        with self.metrics.timer('join', 'download', table=table_name) as event:
+            try:
+                table = self.bq_client.get_table(table_ref)
+            except exceptions.NotFound:
+                batches = []
+            else:
+                if table_name in DATED_TABLES:
+                    query = """
+                    SELECT {0}
+                    FROM `{1}.{2}`
+                    WHERE Date BETWEEN @date_begin AND @date_end
+                    """.format(
+                        ', '.join(schema.names), self.dataset_name, table_name
+                    )
+                    if local_dates is not None:
+                        query += "AND Date NOT BETWEEN @local_begin AND @local_end"
+                    query_job = self.planner.run(
+                        query,
+                        self.period_config(date_begin, date_end, local_dates),
+                        label='{}.download'.format(table_name),
+                    )
+                    self.metrics.record_job(event, query_job)
+                    batches = bq_reader.read_batches(query_job, self.read_client)
+                else:
+                    rows = self.bq_client.list_rows(table)
+                    batches = rows.to_arrow(
+                        bqstorage_client=self.read_client
+                    ).to_batches()
+            nb_rows, nb_bytes = self.sink.write_batches(
+                table_name, schema, batches, name=REMOTE_NAME
+            )
+            event['rows'] = nb_rows
+            event['bytes_in'] = nb_bytes
+        logging.info("Table '{}' downloaded: {} rows".format(table_name, nb_rows))
+
+    def run_join(self, date_begin, date_end):
+
+        ### Every input is a view over its Parquet files. The dates of the
+        ### join missing from the Adwords tables written locally are read
+        ### from BigQuery, so that the result does not depend on the backend.
+        connection = duckdb.connect()
+        for table_name in JOIN_TABLES:
+            local_files = [
+                path
+                for path in self.sink.files(table_name)
+                if os.path.basename(path) != REMOTE_NAME + '.parquet'
+            ]
+            if not local_files:
+                self.download(table_name, date_begin, date_end)
+            elif table_name in DATED_TABLES and self.local_dates is not None:
+                self.download(table_name, date_begin, date_end, self.local_dates)
+            connection.execute(
+                "CREATE VIEW {} AS SELECT * FROM read_parquet([{}])".format(
+                    table_name,
+                    ', '.join(
+                        "'{}'".format(path.replace("'", "''"))
+                        for path in self.sink.files(table_name)
+                    ),
+                )
+            )
+
+        path = os.path.join(self.sink.path, 'final_report.parquet')
+        with self.metrics.timer('join', 'local_query', table='final_report') as event:
+            result = connection.execute(
+                JOIN_QUERY,
+                {
+                    'date_begin': datetime.date.fromisoformat(str(date_begin)),
+                    'date_end': datetime.date.fromisoformat(str(date_end)),
+                },
+            ).fetch_arrow_table()
+            pq.write_table(result, path)
+            event['rows'] = result.num_rows
+            event['bytes_out'] = os.path.getsize(path)
+        connection.close()
+        logging.info(
+            "Final report joined locally: {} rows from {} to {}".format(
+                result.num_rows, date_begin, date_end
+            )
+        )
+        return path
+
+    def upload(self, dest_table_name, path, date_begin, date_end):
+
+        ### The dates of the period are replaced in one transaction, from a
+        ### short-lived staging table loaded with the local result
+        dataset_ref = self.bq_client.dataset(self.dataset_name)
+        try:
+            self.bq_client.get_table(dataset_ref.table(dest_table_name))
+        except exceptions.NotFound:
+            bq_create_tables.create_table_final(self.bq_client, dataset_ref)
+        date_type = bq_create_tables.date_type(
+            self.bq_client, dataset_ref.table(dest_table_name)
+        )
+        stage_name = '{}_stage_{}'.format(dest_table_name, uuid.uuid4().hex[:8])
+        stage = bigquery.Table(dataset_ref.table(stage_name))
+        stage.expires = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        self.bq_client.create_table(stage)
+
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.PARQUET
+        job_config.write_disposition = 'WRITE_TRUNCATE'
+        with self.metrics.timer('join', 'bq_load', table=stage_name) as event:
+            event['bytes_out'] = os.path.getsize(path)
+            with open(path, 'rb') as source:
+                load_job = self.bq_client.load_table_from_file(
+                    source, dataset_ref.table(stage_name), job_config=job_config
+                )
+            load_job.result()
+            self.metrics.record_job(event, load_job)
+
+        ### An unconverted final table keeps its 'YYYYMMDD' dates
+        names = [field.name for field in bq_create_tables.SCHEMAS[dest_table_name]]
+        values = [
+            bq_create_tables.date_value(name, date_type) + ' AS Date'
+            if name == 'Date'
+            else name
+            for name in names
+        ]
+        query = """
+        BEGIN TRANSACTION;
+
+        DELETE FROM `{0}.{1}`
+        WHERE Date BETWEEN {5} AND {6};
+
+        INSERT INTO `{0}.{1}` ({3})
+        SELECT {4}
+        FROM `{0}.{2}`;
+
+        COMMIT TRANSACTION;
+        """.format(
+            self.dataset_name,
+            dest_table_name,
+            stage_name,
+            ', '.join(names),
+            ', '.join(values),
+            bq_create_tables.date_value('@date_begin', date_type),
+            bq_create_tables.date_value('@date_end', date_type),
+        )
+        try:
+            with self.metrics.timer(
+                'join', 'bq_query', table=dest_table_name
+            ) as event:
+                query_job = self.planner.run(
+                    query,
+                    self.period_config(date_begin, date_end),
+                    label=dest_table_name,
+                )
+                self.metrics.record_job(event, query_job)
+        finally:
+            self.bq_client.delete_table(
+                dataset_ref.table(stage_name), not_found_ok=True
+            )
+        logging.info(
+            "Dates {} to {} replaced in table '{}.{}'".format(
+                date_begin, date_end, self.dataset_name, dest_table_name
+            )
+        )
+
+    def join_final_table(self, dest_table_name, date_begin, date_end):
+
+        path = self.run_join(date_begin, date_end)
+        self.upload(dest_table_name, path, date_begin, date_end)
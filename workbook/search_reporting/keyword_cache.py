@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import json
+import hashlib
+import datetime
+import threading
+
+
+def content_hash(content):
+
+    ### Adwords does not guarantee the row order, so rows are sorted first
+    lines = sorted(line for line in content.splitlines() if line)
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def key_count(content):
+
+    ### One keyword per row of the report
+    return sum(1 for line in content.splitlines() if line)
+
+
+class KeywordDimensionCache:
+    def __init__(self, path, ttl_hours=12, dataset_name=None):
+
+        ### Entries are kept per dataset, a cache file may serve several
+        self.path = path
+        self.ttl = datetime.timedelta(hours=ttl_hours)
+        self.dataset_name = dataset_name
+        self.lock = threading.Lock()
+        self.accounts = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.accounts = json.load(f)
+
+    def key(self, account_id):
+
+        if self.dataset_name is None:
+            return str(account_id)
+        return '{}/{}'.format(self.dataset_name, account_id)
+
+    def get(self, account_id, table_keys=None):
+
+        ### An entry only holds while the table still has the account's
+        ### keywords, e.g. not after the table was recreated. Keywords removed
+        ### from Adwords stay in the table, which may hold more of them.
+        with self.lock:
+            entry = self.accounts.get(self.key(account_id))
+        if entry is None:
+            return None
+        if table_keys is not None and table_keys < entry.get('keys', 1):
+            logging.info(
+                "Keywords of account {} missing from the table: {} of {}".format(
+                    account_id, table_keys, entry.get('keys', 1)
+                )
+            )
+            return None
+        return entry
+
+    def is_fresh(self, account_id, table_keys=None):
+
+        ### An account refreshed less than ttl ago is not downloaded again
+        entry = self.get(account_id, table_keys)
+        if entry is None:
+            return False
+        refreshed = datetime.datetime.strptime(entry['refreshed'], "%Y-%m-%dT%H:%M:%S")
+        return datetime.datetime.now() - refreshed < self.ttl
+
+    def has_changed(self, account_id, new_hash, table_keys=None):
+
+        entry = self.get(account_id, table_keys)
+        return entry is None or entry['hash'] != new_hash
+
+    def update(self, account_id, new_hash, nb_keys):
+
+        with self.lock:
+            self.accounts[self.key(account_id)] = {
+                'hash': new_hash,
+                'keys': nb_keys,
+                'refreshed': datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.accounts, f, indent=1)
+            os.replace(tmp_path, self.path)
+        logging.info("Keyword cache updated for account {}".format(account_id))
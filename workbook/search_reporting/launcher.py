@@ -3,42 +3,423 @@
 ### Import Python libraries
 import argparse
 import logging
+import os
+import sys
 import datetime
+import importlib
 import yaml
 
-### Load project modules
+### Load project modules. The stage modules (report_gen, export_conversions,
+### join_backends, query_planner) pull in the client libraries, they are only
+### imported by the stages needing them.
+import accounts
 import connections
-import export_conversions
-import report_gen
+import date_chunks
+import gclid_filter
+import keyword_cache
+import manifest
+import metrics
+import scheduler
+import snow_unload
+import tenants
 
 
-def main(adwords_mcc, date_from, date_until, bq_dataset, google_yaml, snow_yaml):
+class StagesFailed(Exception):
+    def __init__(self, stages):
 
-    logging.info("Start Google connections")
-    bq_client = connections.bigquery_connection()
-    gs_client = connections.storage_connection()
-    adw_client = connections.adwords_api_connection(google_yaml)
+        ### The scheduler of the run is kept for the batch summary
+        failed = stages.failed + stages.blocked
+        super().__init__("Stage(s) not completed: {}".format(', '.join(failed)))
+        self.stages = stages
 
-    logging.info("Parsing Snowflake credentials")
-    snow_creds = yaml.load(open(snow_yaml))
 
-    logging.info("Starting DataStudio report")
-    with connections.snowflake_connection(
-        snow_creds['sf_account'], 
-        snow_creds['sf_user'], 
-        snow_creds['sf_password']
-    ) as sf_client:
-        report_gen.SnowflakeToBigQuery(sf_client, bq_client, bq_dataset)
-        
-    report_gen.AdwordsToBigQuery(
-        adwords_mcc, adw_client, bq_client, bq_dataset, date_from, date_until
-    )
-    report_gen.JoinFinalTable(bq_client, bq_dataset, '2000-01-01', date_until)
+def load_module(name, run_metrics):
+
+    ### Timed on first import only, importlib waits for an import in progress
+    if name in sys.modules:
+        return importlib.import_module(name)
+    with run_metrics.timer('startup', 'import', component=name):
+        return importlib.import_module(name)
+
+
+def main(
+    adwords_mcc,
+    date_from,
+    date_until,
+    bq_dataset,
+    google_yaml,
+    snow_yaml,
+    workers=1,
+    snow_batch_size=50000,
+    snow_mode='full',
+    snow_watermark='SALEDATE',
+    snow_lookback=3,
+    join_mode='full',
+    load_mode='append',
+    manifest_path='run_manifest.json',
+    resume=False,
+    adw_rate=10,
+    adw_account_rate=2,
+    kw_cache_path='kw_names_cache.json',
+    kw_ttl=12,
+    accounts_cache_path='accounts_cache.json',
+    accounts_ttl=24,
+    accounts_max_age=168,
+    refresh_accounts=False,
+    buffer_mb=64,
+    selected_stages=None,
+    skipped_stages=None,
+    metrics_json='run_report.json',
+    metrics_prom=None,
+    max_query_gb=None,
+    max_run_gb=None,
+    over_budget='fail',
+    query_cache_path='query_cache.json',
+    export_mode='incremental',
+    export_max_rows=None,
+    export_window_days=7,
+    export_reader='arrow',
+    join_backend='bigquery',
+    local_dir='local_tables',
+    local_upload='all',
+    gclid_mode='raw',
+    gclid_window_days=30,
+    gclid_filter_path='gclid_filter.bin',
+    snow_transfer='stream',
+    snow_stage='@SEARCH_REPORTING_UNLOAD',
+    snow_stage_url=None,
+    adperf_chunk_rows=date_chunks.DEFAULT_CHUNK_ROWS,
+    adperf_volumes_path='adperf_volumes.json',
+    stream_max_mb=0,
+    snow_source='ADWORDS_GCLID_AGGREGATION',
+    export_bucket='client_bucket',
+    pool=None,
+    slots=None,
+    tenant=None,
+):
+
+    ### Completed work units are recorded, so that a failed run can be resumed
+    run_params = {
+        'mcc': adwords_mcc,
+        'from': date_from,
+        'to': date_until,
+        'dataset': bq_dataset,
+    }
+    if tenant is not None:
+        run_params['tenant'] = tenant
+    run_manifest = manifest.RunManifest(manifest_path, run_params, resume=resume)
+    run_metrics = metrics.RunMetrics(run_params)
+
+    ### Clients are built by the first stage using them, and then reused. In
+    ### a batch, the pool is shared by all tenants and closed by the batch.
+    own_pool = pool is None
+    if own_pool:
+        pool = connections.ClientPool(google_yaml, run_metrics)
+    planner_name = 'planner/{}/{}'.format(adwords_mcc, bq_dataset)
+
+    def get_planner():
+
+        ### Every generated query is dry-run and checked against the byte budgets
+        bq_client = pool.bigquery()
+        query_planner = load_module('query_planner', run_metrics)
+        return pool.get(
+            planner_name,
+            lambda: query_planner.QueryPlanner(
+                bq_client,
+                max_query_bytes=max_query_gb * query_planner.GB
+                if max_query_gb
+                else None,
+                max_run_bytes=max_run_gb * query_planner.GB if max_run_gb else None,
+                cache_path=query_cache_path,
+            ),
+        )
+
+    ### The local join backend gets the Adwords reports and conversions as
+    ### Parquet files, and the Adwords tables are only uploaded when asked
+    sink = None
+    if join_backend == 'duckdb':
+        join_backends = load_module('join_backends', run_metrics)
+        sink = join_backends.LocalSink(local_dir, clear=not resume)
+
+    ### Conversions can go from Snowflake to BigQuery through a bucket
+    stage = None
+    if snow_transfer == 'unload':
+        if not snow_stage_url:
+            raise Exception("Unload transfer needs the bucket URL of the stage")
+        stage = snow_unload.UnloadStage(snow_stage, snow_stage_url)
+
+    ### Click reports are pruned with the converting GCLIDs of the run, so
+    ### the Adwords extract then waits for the Snowflake one. A filter left
+    ### by a previous run is only reused on resume.
+    pruning = []
+    if gclid_mode == 'prune':
+        pruning = ['gclid_filter']
+        if not resume and os.path.exists(gclid_filter_path):
+            os.remove(gclid_filter_path)
+
+    ### In a batch, stages other than the Adwords extract, and each Adwords
+    ### unit, wait for a slot shared fairly between tenants
+    slot_owner = tenant or adwords_mcc
+
+    def with_slot(func):
+
+        if slots is None:
+            return func
+
+        def run():
+            with slots.slot(slot_owner):
+                return func()
+
+        return run
 
-    logging.info("Starting conversions export for Adwords")
-    export_conversions.ExportConversionsAdwords(gs_client, bq_client, bq_dataset)
+    ### Each stage declares the tables it reads and writes, so that stages
+    ### sharing no table run at the same time
+    def run_snowflake():
 
-    logging.info("All tasks done. Have a good day!")
+        if run_manifest.is_done('snowflake'):
+            logging.info("Snowflake extract already done, skipped")
+            return
+        report_gen = load_module('report_gen', run_metrics)
+        logging.info("Parsing Snowflake credentials")
+        with open(snow_yaml) as f:
+            snow_creds = yaml.safe_load(f)
+        converting = None
+        if gclid_mode == 'prune':
+            converting = gclid_filter.GclidFilter()
+        snow_extract = report_gen.SnowflakeToBigQuery(
+            pool.snowflake(
+                snow_creds['sf_account'],
+                snow_creds['sf_user'],
+                snow_creds['sf_password'],
+            ),
+            pool.bigquery(),
+            bq_dataset,
+            batch_size=snow_batch_size,
+            mode=snow_mode,
+            watermark_column=snow_watermark,
+            lookback_days=snow_lookback,
+            buffer_memory=buffer_mb * 1024 * 1024,
+            run_metrics=run_metrics,
+            planner=get_planner(),
+            sink=sink,
+            converting=converting,
+            stage=stage,
+            source_table=snow_source,
+        )
+        if converting is not None:
+            converting.save(gclid_filter_path)
+        run_manifest.mark_done(
+            'snowflake', snow_extract.checksum, mode=snow_extract.mode
+        )
+
+    def run_adwords():
+
+        report_gen = load_module('report_gen', run_metrics)
+        adw_client = pool.adwords(adwords_mcc, google_yaml)
+        bq_client = pool.bigquery()
+        request_scheduler = pool.adwords_requests(
+            adw_rate, adw_account_rate, google_yaml
+        )
+        hierarchy = accounts.AccountHierarchy(
+            accounts_cache_path,
+            accounts_ttl,
+            request_scheduler=request_scheduler,
+            max_age_hours=accounts_max_age,
+        )
+        if refresh_accounts:
+            hierarchy.get_accounts(adw_client, adwords_mcc, refresh=True)
+
+        ### Small batches of the Adwords tables can be streamed instead of loaded
+        writer = None
+        if stream_max_mb:
+            storage_write = load_module('storage_write', run_metrics)
+            writer = storage_write.StorageWriter(
+                bq_client,
+                bq_dataset,
+                write_client=pool.bigquery_write(),
+                max_bytes=int(stream_max_mb * 1024 * 1024),
+                run_metrics=run_metrics,
+            )
+
+        ### Converting GCLIDs saved by the Snowflake stage, or read from BigQuery
+        ### when that stage did not run
+        converting = None
+        if gclid_mode == 'prune' and os.path.exists(gclid_filter_path):
+            converting = gclid_filter.GclidFilter.load(gclid_filter_path)
+        elif gclid_mode == 'prune':
+            converting = gclid_filter.GclidFilter().add_from_bigquery(
+                bq_client, bq_dataset, get_planner()
+            )
+
+        return report_gen.AdwordsToBigQuery(
+            adwords_mcc,
+            adw_client,
+            bq_client,
+            bq_dataset,
+            date_from,
+            date_until,
+            workers=workers,
+            client_factory=lambda: connections.adwords_api_connection(google_yaml),
+            load_mode=load_mode,
+            run_manifest=run_manifest,
+            request_scheduler=request_scheduler,
+            kw_cache=keyword_cache.KeywordDimensionCache(
+                kw_cache_path, kw_ttl, bq_dataset
+            ),
+            hierarchy=hierarchy,
+            buffer_memory=buffer_mb * 1024 * 1024,
+            run_metrics=run_metrics,
+            sink=sink,
+            upload=sink is None or local_upload == 'all',
+            converting=converting,
+            click_window_days=gclid_window_days,
+            slots=slots,
+            slot_owner=slot_owner,
+            volumes=date_chunks.ReportVolumes(adperf_volumes_path, adperf_chunk_rows)
+            if adperf_chunk_rows
+            else None,
+            writer=writer,
+            planner=get_planner(),
+        )
+
+    def run_join():
+
+        ### New conversions are only known when the Snowflake extract is incremental
+        if run_manifest.is_done('join'):
+            logging.info("Final table already joined, skipped")
+            return
+        report_gen = load_module('report_gen', run_metrics)
+        bq_client = pool.bigquery()
+        planner = get_planner()
+        mode = join_mode
+        snow_mode_used = run_manifest.get('snowflake').get('mode')
+        if mode == 'incremental' and snow_mode_used == 'full':
+            logging.info("Snowflake extract was a full reload, full join instead")
+            mode = 'full'
+        ### The local backend joins the same dates as BigQuery would, the
+        ### ones not written locally by the run are read from BigQuery
+        backend = None
+        if sink is not None:
+            backend = load_module('join_backends', run_metrics).DuckDBBackend(
+                sink,
+                bq_client,
+                bq_dataset,
+                run_metrics=run_metrics,
+                planner=planner,
+                local_dates=(date_from, date_until),
+                read_client=pool.bigquery_read(),
+            )
+        if mode == 'incremental':
+            report_gen.JoinFinalTable(
+                bq_client,
+                bq_dataset,
+                date_from,
+                date_until,
+                mode='incremental',
+                run_metrics=run_metrics,
+                planner=planner,
+                backend=backend,
+            )
+        else:
+            report_gen.JoinFinalTable(
+                bq_client,
+                bq_dataset,
+                '2000-01-01',
+                date_until,
+                run_metrics=run_metrics,
+                planner=planner,
+                over_budget=over_budget,
+                backend=backend,
+            )
+
+        ### The join is done again on resume if some Adwords units are missing
+        adwords_extract = stages.results.get('adwords')
+        nb_failed = 0
+        if adwords_extract is not None:
+            nb_failed = len(adwords_extract.failed_units) + len(
+                adwords_extract.failed_loads
+            )
+        if nb_failed:
+            logging.error(
+                "{} Adwords unit(s) failed, rerun with --resume to complete".format(
+                    nb_failed
+                )
+            )
+        else:
+            run_manifest.mark_done('join')
+
+    def run_export():
+
+        logging.info("Starting conversions export for Adwords")
+        if run_manifest.is_done('export'):
+            logging.info("Conversions export already done, skipped")
+            return
+        export_conversions = load_module('export_conversions', run_metrics)
+        export_conversions.ExportConversionsAdwords(
+            pool.storage(),
+            pool.bigquery(),
+            bq_dataset,
+            run_metrics=run_metrics,
+            planner=get_planner(),
+            mode=export_mode,
+            max_rows=export_max_rows or export_conversions.MAX_SHARD_ROWS,
+            reader=export_reader,
+            bucket_name=export_bucket,
+            window_days=export_window_days,
+            read_client=pool.bigquery_read() if export_reader == 'arrow' else None,
+        )
+        run_manifest.mark_done('export')
+
+    stages = scheduler.StageScheduler(
+        [
+            scheduler.Stage(
+                'snowflake',
+                with_slot(run_snowflake),
+                [],
+                ['snow_conversions', 'snow_conversions_delta'] + pruning,
+            ),
+            scheduler.Stage(
+                'adwords',
+                run_adwords,
+                pruning,
+                ['adw_gclid_list', 'adw_keywords', 'adw_kw_names'],
+            ),
+            scheduler.Stage(
+                'join',
+                with_slot(run_join),
+                [
+                    'snow_conversions',
+                    'snow_conversions_delta',
+                    'adw_gclid_list',
+                    'adw_keywords',
+                    'adw_kw_names',
+                ],
+                ['final_report'],
+            ),
+            scheduler.Stage(
+                'export', with_slot(run_export), ['snow_conversions'], []
+            ),
+        ]
+    )
+
+    ### The run report is written even when a stage fails
+    logging.info("Starting DataStudio report")
+    try:
+        failed = stages.run(selected_stages, skipped_stages)
+    finally:
+        run_manifest.compact()
+        if planner_name in pool.clients:
+            pool.clients[planner_name].log_stats()
+        if own_pool:
+            pool.close()
+        run_metrics.log_startup()
+        if metrics_json:
+            run_metrics.write_json(metrics_json, stages.durations)
+        if metrics_prom:
+            run_metrics.write_prometheus(metrics_prom, stages.durations)
+    if failed:
+        raise StagesFailed(stages)
+    return stages
 
 
 if __name__ == "__main__":
@@ -54,7 +435,9 @@ if __name__ == "__main__":
 
     ### Parse arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('mcc', type=str, help=("Adwords MCC or single account"))
+    parser.add_argument(
+        'mcc', type=str, nargs='?', help=("Adwords MCC or single account")
+    )
     parser.add_argument(
         '--from',
         dest='date_begin',
@@ -84,16 +467,399 @@ if __name__ == "__main__":
         default='../snowflake.yaml',
         help=("Path to YAML file for Snowflake API credentials"),
     )
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        default=1,
+        type=int,
+        help=("Number of Adwords reports downloaded concurrently"),
+    )
+    parser.add_argument(
+        '--snow-batch-size',
+        dest='snow_batch_size',
+        default=50000,
+        type=int,
+        help=("Snowflake rows fetched per batch, 0 to extract in memory at once"),
+    )
+    parser.add_argument(
+        '--snow-mode',
+        dest='snow_mode',
+        default='full',
+        choices=['full', 'incremental'],
+        help=("Reload all conversions, or merge only rows past the high-water mark"),
+    )
+    parser.add_argument(
+        '--snow-watermark',
+        dest='snow_watermark',
+        default='SALEDATE',
+        choices=['SALEDATE', 'CLICK_TIMESTAMP'],
+        help=("Column used as high-water mark in incremental mode"),
+    )
+    parser.add_argument(
+        '--snow-lookback',
+        dest='snow_lookback',
+        default=3,
+        type=int,
+        help=("Days re-extracted before the high-water mark for late arrivals"),
+    )
+    parser.add_argument(
+        '--full-refresh-weekday',
+        dest='full_refresh_weekday',
+        default=None,
+        type=int,
+        help=("Weekday (0 = Monday) on which incremental mode runs a full refresh"),
+    )
+    parser.add_argument(
+        '--join-mode',
+        dest='join_mode',
+        default='full',
+        choices=['full', 'incremental'],
+        help=("Rebuild the whole final table, or only the dates touched by the run"),
+    )
+    parser.add_argument(
+        '--load-mode',
+        dest='load_mode',
+        default='append',
+        choices=['append', 'replace'],
+        help=("Append Adwords reports, or replace their (date, account) slices"),
+    )
+    parser.add_argument(
+        '--manifest',
+        dest='manifest_path',
+        default='run_manifest.json',
+        help=("Path to the file recording the completed work units of the run"),
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help=("Skip the work units already completed by a previous identical run"),
+    )
+    parser.add_argument(
+        '--adw-rate',
+        dest='adw_rate',
+        default=10,
+        type=float,
+        help=("Maximum Adwords requests per second for the developer token"),
+    )
+    parser.add_argument(
+        '--adw-account-rate',
+        dest='adw_account_rate',
+        default=2,
+        type=float,
+        help=("Maximum Adwords requests per second for each client account"),
+    )
+    parser.add_argument(
+        '--kw-cache',
+        dest='kw_cache_path',
+        default='kw_names_cache.json',
+        help=("Path to the file caching the keyword names hash of each account"),
+    )
+    parser.add_argument(
+        '--kw-ttl',
+        dest='kw_ttl',
+        default=12,
+        type=float,
+        help=("Hours before the keyword names of an account are checked again"),
+    )
+    parser.add_argument(
+        '--accounts-cache',
+        dest='accounts_cache_path',
+        default='accounts_cache.json',
+        help=("Path to the file caching the account hierarchy of each MCC"),
+    )
+    parser.add_argument(
+        '--accounts-ttl',
+        dest='accounts_ttl',
+        default=24,
+        type=float,
+        help=("Hours before the cached account hierarchy is checked for changes"),
+    )
+    parser.add_argument(
+        '--accounts-max-age',
+        dest='accounts_max_age',
+        default=168,
+        type=float,
+        help=("Hours before the cached account hierarchy is always crawled again"),
+    )
+    parser.add_argument(
+        '--refresh-accounts',
+        action='store_true',
+        help=("Crawl the whole account hierarchy again, ignoring the cache"),
+    )
+    parser.add_argument(
+        '--buffer-mb',
+        dest='buffer_mb',
+        default=64,
+        type=int,
+        help=("Compressed megabytes kept in memory per report buffer before spilling"),
+    )
+    parser.add_argument(
+        '--stages',
+        dest='stages',
+        default=None,
+        help=("Comma-separated stages to run: snowflake, adwords, join, export"),
+    )
+    parser.add_argument(
+        '--skip',
+        dest='skip',
+        default=None,
+        help=("Comma-separated stages to leave out of the run"),
+    )
+    parser.add_argument(
+        '--metrics-json',
+        dest='metrics_json',
+        default='run_report.json',
+        help=("Path to the JSON run report with the metrics of every operation"),
+    )
+    parser.add_argument(
+        '--metrics-prom',
+        dest='metrics_prom',
+        default=None,
+        help=("Path to a Prometheus textfile written at the end of the run"),
+    )
+    parser.add_argument(
+        '--max-query-gb',
+        dest='max_query_gb',
+        default=None,
+        type=float,
+        help=("Maximum gigabytes a single BigQuery query may process"),
+    )
+    parser.add_argument(
+        '--max-run-gb',
+        dest='max_run_gb',
+        default=None,
+        type=float,
+        help=("Maximum gigabytes all BigQuery queries of the run may process"),
+    )
+    parser.add_argument(
+        '--over-budget',
+        dest='over_budget',
+        default='fail',
+        choices=['fail', 'narrow'],
+        help=("Fail, or narrow the date range of the final table, when over budget"),
+    )
+    parser.add_argument(
+        '--query-cache',
+        dest='query_cache_path',
+        default='query_cache.json',
+        help=("Path to the file recording the fingerprint of the last queries run"),
+    )
+    parser.add_argument(
+        '--export-mode',
+        dest='export_mode',
+        default='incremental',
+        choices=['full', 'incremental'],
+        help=(
+            "Export only the conversions not exported by a previous run, or every "
+            "conversion"
+        ),
+    )
+    parser.add_argument(
+        '--export-window-days',
+        dest='export_window_days',
+        default=7,
+        type=int,
+        help=("Days an incremental export keeps exporting a conversion again"),
+    )
+    parser.add_argument(
+        '--export-max-rows',
+        dest='export_max_rows',
+        default=None,
+        type=int,
+        help=("Maximum conversions per exported file, 1000000 by default"),
+    )
+    parser.add_argument(
+        '--export-reader',
+        dest='export_reader',
+        default='arrow',
+        choices=['arrow', 'rows'],
+        help=("Read the exported conversions as Arrow batches, or row by row"),
+    )
+    parser.add_argument(
+        '--join-backend',
+        dest='join_backend',
+        default='bigquery',
+        choices=['bigquery', 'duckdb'],
+        help=("Run the final join in BigQuery, or locally with DuckDB"),
+    )
+    parser.add_argument(
+        '--local-dir',
+        dest='local_dir',
+        default='local_tables',
+        help=("Directory of the Parquet files read by the local join backend"),
+    )
+    parser.add_argument(
+        '--local-upload',
+        dest='local_upload',
+        default='all',
+        choices=['final', 'all'],
+        help=("With the local backend, upload every table, or only the final table"),
+    )
+    parser.add_argument(
+        '--gclid-mode',
+        dest='gclid_mode',
+        default='raw',
+        choices=['raw', 'prune'],
+        help=("Load every click, or only converting ones with the others summed"),
+    )
+    parser.add_argument(
+        '--gclid-window-days',
+        dest='gclid_window_days',
+        default=30,
+        type=int,
+        help=("Days of recent clicks always loaded whole by the prune mode"),
+    )
+    parser.add_argument(
+        '--gclid-filter',
+        dest='gclid_filter_path',
+        default='gclid_filter.bin',
+        help=("Path to the file of converting GCLIDs shared by the stages"),
+    )
+    parser.add_argument(
+        '--snow-transfer',
+        dest='snow_transfer',
+        default='stream',
+        choices=['stream', 'unload'],
+        help=("Extract conversions through this host, or unload them to a bucket"),
+    )
+    parser.add_argument(
+        '--snow-stage',
+        dest='snow_stage',
+        default='@SEARCH_REPORTING_UNLOAD',
+        help=("Snowflake external stage used by the unload transfer"),
+    )
+    parser.add_argument(
+        '--snow-stage-url',
+        dest='snow_stage_url',
+        default=None,
+        help=("Bucket path of the stage, e.g. gs://bucket/unload"),
+    )
+    parser.add_argument(
+        '--adperf-chunk-rows',
+        dest='adperf_chunk_rows',
+        default=date_chunks.DEFAULT_CHUNK_ROWS,
+        type=int,
+        help=("Rows per Ad Performance download, 0 for the whole period at once"),
+    )
+    parser.add_argument(
+        '--adperf-volumes',
+        dest='adperf_volumes_path',
+        default='adperf_volumes.json',
+        help=("Path to the file of Ad Performance rows per day of each account"),
+    )
+    parser.add_argument(
+        '--stream-max-mb',
+        dest='stream_max_mb',
+        default=0,
+        type=float,
+        help=(
+            "Stream Adwords batches up to this size through the Storage Write API "
+            "instead of load jobs, 0 to always use load jobs"
+        ),
+    )
+    parser.add_argument(
+        '--tenants',
+        dest='tenants',
+        default=None,
+        help=("YAML file of tenants (MCC, dataset...) run together instead of mcc"),
+    )
+    parser.add_argument(
+        '--tenants-dir',
+        dest='tenants_dir',
+        default='tenants',
+        help=("Directory of the run files of each tenant, one folder per tenant"),
+    )
+    parser.add_argument(
+        '--slots',
+        dest='slots',
+        default=4,
+        type=int,
+        help=("Adwords units and other stages running at once across all tenants"),
+    )
+    parser.add_argument(
+        '--summary',
+        dest='summary_path',
+        default='batch_summary.json',
+        help=("Path to the JSON summary of the tenants of a batch"),
+    )
     args = parser.parse_args()
+    if not args.mcc and not args.tenants:
+        parser.error("an MCC or --tenants is required")
+
+    ### Periodic full refresh of the conversions table
+    if args.full_refresh_weekday == datetime.datetime.today().weekday():
+        logging.info("Full refresh day, Snowflake extract switched to full mode")
+        args.snow_mode = 'full'
 
     logging.info("Lauching report with parameters: {}".format(args))
 
-    ### Call to main function
-    main(
-        args.mcc,
-        args.date_begin,
-        args.date_end,
-        args.bq_dataset,
-        args.google_yaml,
-        args.snow_yaml,
+    ### Options shared by every tenant of a batch
+    options = dict(
+        workers=args.workers,
+        snow_batch_size=args.snow_batch_size,
+        snow_mode=args.snow_mode,
+        snow_watermark=args.snow_watermark,
+        snow_lookback=args.snow_lookback,
+        join_mode=args.join_mode,
+        load_mode=args.load_mode,
+        manifest_path=args.manifest_path,
+        resume=args.resume,
+        adw_rate=args.adw_rate,
+        adw_account_rate=args.adw_account_rate,
+        kw_cache_path=args.kw_cache_path,
+        kw_ttl=args.kw_ttl,
+        accounts_cache_path=args.accounts_cache_path,
+        accounts_ttl=args.accounts_ttl,
+        accounts_max_age=args.accounts_max_age,
+        refresh_accounts=args.refresh_accounts,
+        buffer_mb=args.buffer_mb,
+        selected_stages=args.stages.split(',') if args.stages else None,
+        skipped_stages=args.skip.split(',') if args.skip else None,
+        metrics_json=args.metrics_json,
+        metrics_prom=args.metrics_prom,
+        max_query_gb=args.max_query_gb,
+        max_run_gb=args.max_run_gb,
+        over_budget=args.over_budget,
+        query_cache_path=args.query_cache_path,
+        export_mode=args.export_mode,
+        export_max_rows=args.export_max_rows,
+        export_window_days=args.export_window_days,
+        export_reader=args.export_reader,
+        join_backend=args.join_backend,
+        local_dir=args.local_dir,
+        local_upload=args.local_upload,
+        gclid_mode=args.gclid_mode,
+        gclid_window_days=args.gclid_window_days,
+        gclid_filter_path=args.gclid_filter_path,
+        snow_transfer=args.snow_transfer,
+        snow_stage=args.snow_stage,
+        snow_stage_url=args.snow_stage_url,
+        adperf_chunk_rows=args.adperf_chunk_rows,
+        adperf_volumes_path=args.adperf_volumes_path,
+        stream_max_mb=args.stream_max_mb,
     )
+
+    ### Call to main function, once per tenant in batch mode
+    if args.tenants:
+        tenants.run_batch(
+            main,
+            tenants.load_tenants(args.tenants),
+            args.date_begin,
+            args.date_end,
+            args.google_yaml,
+            args.snow_yaml,
+            options,
+            slots=args.slots,
+            work_dir=args.tenants_dir,
+            summary_path=args.summary_path,
+        )
+    else:
+        main(
+            args.mcc,
+            args.date_begin,
+            args.date_end,
+            args.bq_dataset,
+            args.google_yaml,
+            args.snow_yaml,
+            **options
+        )
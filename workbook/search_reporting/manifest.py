@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import json
+import hashlib
+import datetime
+import threading
+
+
+def checksum(content):
+
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class RunManifest:
+    def __init__(self, path, params, resume=False):
+
+        ### Each change of status is appended to a journal next to the
+        ### manifest, which is only rewritten when compacted
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.params = params
+        self.lock = threading.Lock()
+        self.units = {}
+        self.journal = None
+
+        ### Only a manifest written for the same run parameters can be resumed
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('params') == params:
+                self.units = state.get('units', {})
+                self.replay()
+                logging.info(
+                    "Resuming run: {} unit(s) already done".format(
+                        sum(1 for u in self.units.values() if u['status'] == 'done')
+                    )
+                )
+            else:
+                logging.warning("Manifest parameters differ, starting a new run")
+
+        ### The journal of another run must never be replayed on this one
+        if not self.units and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.compact()
+
+    def replay(self):
+
+        ### A line cut short by a crash is the last one, and is ignored
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                self.units[entry['key']] = entry['unit']
+
+    def is_done(self, key):
+
+        with self.lock:
+            return self.units.get(key, {}).get('status') == 'done'
+
+    def done_keys(self, prefix=''):
+
+        return self.keys('done', prefix)
+
+    def keys(self, status, prefix=''):
+
+        with self.lock:
+            return [
+                key
+                for key, unit in self.units.items()
+                if key.startswith(prefix) and unit['status'] == status
+            ]
+
+    def get(self, key):
+
+        with self.lock:
+            return dict(self.units.get(key, {}))
+
+    def mark(self, key, status, content_checksum=None, **info):
+
+        with self.lock:
+            unit = self.units.setdefault(key, {})
+            unit.update(info)
+            unit['status'] = status
+            unit['updated'] = datetime.datetime.now().isoformat()
+            if content_checksum is not None:
+                unit['checksum'] = content_checksum
+
+            ### One line per change, flushed so that a resumed run sees it
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'a')
+            self.journal.write(json.dumps({'key': key, 'unit': unit}) + '\n')
+            self.journal.flush()
+
+    def mark_done(self, key, content_checksum=None, **info):
+
+        self.mark(key, 'done', content_checksum, **info)
+
+    def compact(self):
+
+        with self.lock:
+            self.save_locked()
+
+            ### The journal is only dropped once the manifest holds its lines.
+            ### Replaying it again after a crash right here changes nothing.
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+    def save_locked(self):
+
+        ### Write to a temporary file first, so a crash never leaves a
+        ### truncated manifest behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'params': self.params, 'units': self.units}, f, indent=1)
+        os.replace(tmp_path, self.path)
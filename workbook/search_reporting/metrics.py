@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+### Counters recorded for every operation
+COUNTERS = ['rows', 'bytes_in', 'bytes_out', 'bytes_billed', 'slot_millis']
+
+
+def stream_size(stream):
+
+    ### Size of a file-like object, read from its end
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size
+
+
+class RunMetrics:
+    def __init__(self, params=None):
+
+        self.params = params or {}
+        self.started = datetime.datetime.now()
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.events = []
+
+    @contextlib.contextmanager
+    def timer(self, stage, operation, **labels):
+
+        ### The caller fills the counters of the yielded event
+        event = {'stage': stage, 'operation': operation, 'labels': labels}
+        event.update((counter, 0) for counter in COUNTERS)
+        event['error'] = None
+        start = time.monotonic()
+        try:
+            yield event
+        except Exception as e:
+            event['error'] = str(e)
+            raise
+        finally:
+            event['seconds'] = time.monotonic() - start
+            with self.lock:
+                self.events.append(event)
+
+    def record_job(self, event, job):
+
+        ### BigQuery load and query jobs report their own statistics
+        event['job_id'] = getattr(job, 'job_id', None)
+        event['bytes_billed'] += getattr(job, 'total_bytes_billed', None) or 0
+        event['slot_millis'] += getattr(job, 'slot_millis', None) or 0
+        rows = getattr(job, 'output_rows', None)
+        if rows is None:
+            rows = getattr(job, 'num_dml_affected_rows', None)
+        event['rows'] += rows or 0
+
+    def totals(self, keys=('stage', 'operation')):
+
+        ### Sum the events sharing the same values for keys, which can be
+        ### stage, operation or any label. Events without them are left out.
+        totals = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            key = tuple(event.get(k, event['labels'].get(k)) for k in keys)
+            if None in key:
+                continue
+            total = totals.get(key)
+            if total is None:
+                total = dict(zip(keys, key))
+                total.update({'count': 0, 'errors': 0, 'seconds': 0})
+                total.update((counter, 0) for counter in COUNTERS)
+                totals[key] = total
+            total['count'] += 1
+            total['errors'] += event['error'] is not None
+            total['seconds'] += event['seconds']
+            for counter in COUNTERS:
+                total[counter] += event[counter]
+        return sorted(totals.values(), key=lambda t: -t['seconds'])
+
+    def log_startup(self):
+
+        ### Module imports and client builds, paid by the first stage needing them
+        totals = self.totals(('operation', 'component'))
+        if not totals:
+            return
+        logging.info(
+            "Startup took {:.2f}s: {}".format(
+                sum(t['seconds'] for t in totals),
+                ', '.join(
+                    '{} {} {:.2f}s'.format(t['operation'], t['component'], t['seconds'])
+                    for t in totals
+                ),
+            )
+        )
+
+    def write_json(self, path, stages=None):
+
+        with self.lock:
+            events = list(self.events)
+        report = {
+            'params': self.params,
+            'started': self.started.isoformat(),
+            'finished': datetime.datetime.now().isoformat(),
+            'seconds': time.monotonic() - self.start,
+            'stages': stages or {},
+            'operations': self.totals(),
+            'accounts': self.totals(('stage', 'account')),
+            'reports': self.totals(('stage', 'report')),
+            'tables': self.totals(('stage', 'operation', 'table')),
+            'startup': self.totals(('operation', 'component')),
+            'events': events,
+        }
+        self.write_file(path, json.dumps(report, indent=1, default=str))
+        logging.info("Run report written to '{}'".format(path))
+
+    def write_prometheus(self, path, stages=None):
+
+        ### Text format read by the node_exporter textfile collector
+        lines = []
+
+        def add(name, help_text, samples):
+            lines.append('# HELP search_reporting_{} {}'.format(name, help_text))
+            lines.append('# TYPE search_reporting_{} gauge'.format(name))
+            for labels, value in samples:
+                labels = ','.join('{}="{}"'.format(k, v) for k, v in labels.items())
+                if labels:
+                    labels = '{' + labels + '}'
+                lines.append('search_reporting_{}{} {}'.format(name, labels, value))
+
+        add(
+            'run_seconds',
+            'Wall time of the last run',
+            [({}, round(time.monotonic() - self.start, 3))],
+        )
+        add(
+            'last_run_timestamp_seconds',
+            'Start time of the last run',
+            [({}, int(self.started.timestamp()))],
+        )
+        add(
+            'stage_seconds',
+            'Wall time of each stage',
+            [({'stage': k}, round(v, 3)) for k, v in sorted((stages or {}).items())],
+        )
+        totals = self.totals()
+        for name, help_text in [
+            ('count', 'Number of operations'),
+            ('errors', 'Number of failed operations'),
+            ('seconds', 'Wall time spent in operations'),
+            ('rows', 'Rows read or written'),
+            ('bytes_in', 'Bytes received'),
+            ('bytes_out', 'Bytes sent'),
+            ('bytes_billed', 'BigQuery bytes billed'),
+            ('slot_millis', 'BigQuery slot milliseconds'),
+        ]:
+            add(
+                'operation_' + name,
+                help_text,
+                [
+                    (
+                        {'stage': t['stage'], 'operation': t['operation']},
+                        round(t[name], 3),
+                    )
+                    for t in totals
+                ],
+            )
+        self.write_file(path, '\n'.join(lines) + '\n')
+        logging.info("Prometheus metrics written to '{}'".format(path))
+
+    def write_file(self, path, content):
+
+        ### Collectors must never read a half-written file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
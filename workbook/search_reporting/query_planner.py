@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import json
+import hashlib
+import datetime
+import threading
+from google.cloud import bigquery
+from google.api_core import exceptions
+
+GB = 1024 ** 3
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class QueryPlanner:
+    def __init__(
+        self,
+        bq_client,
+        max_query_bytes=None,
+        max_run_bytes=None,
+        cache_path=None,
+    ):
+
+        self.bq_client = bq_client
+        self.max_query_bytes = max_query_bytes
+        self.max_run_bytes = max_run_bytes
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.spent = 0
+        self.pending = {}
+        self.cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+
+    def dry_run(self, query, job_config=None):
+
+        ### Same query and parameters, but BigQuery only plans it
+        if job_config is None:
+            dry_config = bigquery.QueryJobConfig()
+        else:
+            dry_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr())
+        dry_config.dry_run = True
+        dry_config.use_query_cache = False
+        try:
+            job = self.bq_client.query(query, job_config=dry_config)
+        except exceptions.BadRequest as e:
+            logging.warning("Dry run failed, query not estimated: {}".format(e))
+            return None, []
+        return job.total_bytes_processed or 0, list(job.referenced_tables or [])
+
+    def fingerprint(self, query, config, tables):
+
+        ### Query text, parameters and last modification of every table involved.
+        ### Queries depending on the current date change every day.
+        state = {
+            'query': query,
+            'config': config,
+            'tables': {},
+        }
+        if 'CURRENT_' in query.upper():
+            state['today'] = datetime.date.today().isoformat()
+        for table_ref in tables:
+            try:
+                table = self.bq_client.get_table(table_ref)
+                modified = table.modified.isoformat() if table.modified else None
+            except exceptions.NotFound:
+                modified = None
+            table_id = '{}.{}'.format(table_ref.dataset_id, table_ref.table_id)
+            state['tables'][table_id] = modified
+        content = json.dumps(state, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def check(self, estimate, label):
+
+        with self.lock:
+            spent = self.spent
+        if self.max_query_bytes is not None and estimate > self.max_query_bytes:
+            raise BudgetExceeded(
+                "Query '{}' would process {:.2f} GB, over the {:.2f} GB "
+                "per-query budget".format(
+                    label, estimate / GB, self.max_query_bytes / GB
+                )
+            )
+        if self.max_run_bytes is not None and spent + estimate > self.max_run_bytes:
+            raise BudgetExceeded(
+                "Query '{}' would process {:.2f} GB, {:.2f} GB left in the "
+                "run budget".format(
+                    label, estimate / GB, (self.max_run_bytes - spent) / GB
+                )
+            )
+
+    def run(self, query, job_config=None, label='query', reuse=False, remember=True):
+
+        ### Dry-run first. With reuse, nothing is run when the query and the
+        ### tables it reads and writes did not change since it last ran.
+        estimate, tables = self.dry_run(query, job_config)
+
+        ### A failed dry run or a script may not report the tables read. The
+        ### query text alone says nothing of their content, so it always runs.
+        if reuse and (estimate is None or not tables):
+            logging.info("Query '{}' inputs unknown, not reused".format(label))
+            reuse = False
+        config = None
+        if job_config is not None:
+            config = job_config.to_api_repr()
+            if job_config.destination is not None:
+                tables.append(job_config.destination)
+        if reuse:
+            fingerprint = self.fingerprint(query, config, tables)
+            if self.cache.get(label, {}).get('fingerprint') == fingerprint:
+                logging.info("Query '{}' unchanged since last run".format(label))
+                return None
+
+        if estimate is not None:
+            logging.info(
+                "Query '{}' will process {:.2f} GB".format(label, estimate / GB)
+            )
+            self.check(estimate, label)
+
+        ### BigQuery enforces the per-query budget on its side too
+        if self.max_query_bytes is not None:
+            if job_config is None:
+                job_config = bigquery.QueryJobConfig()
+            job_config.maximum_bytes_billed = self.max_query_bytes
+        query_job = self.bq_client.query(query, job_config=job_config)
+        query_job.result()
+        with self.lock:
+            self.spent += query_job.total_bytes_processed or estimate or 0
+
+        ### Tables written by the query are fingerprinted after it ran
+        if reuse:
+            fingerprint = self.fingerprint(query, config, tables)
+            with self.lock:
+                self.pending[label] = fingerprint
+            if remember:
+                self.remember(label)
+        return query_job
+
+    def remember(self, label):
+
+        ### Only results fully used by the caller can be reused next time
+        with self.lock:
+            fingerprint = self.pending.pop(label, None)
+            if fingerprint is None:
+                return
+            self.cache[label] = {
+                'fingerprint': fingerprint,
+                'saved': datetime.datetime.now().isoformat(),
+            }
+            if not self.cache_path:
+                return
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.cache, f, indent=1)
+            os.replace(tmp_path, self.cache_path)
+
+    def log_stats(self):
+
+        logging.info(
+            "BigQuery queries processed {:.2f} GB{}".format(
+                self.spent / GB,
+                ''
+                if self.max_run_bytes is None
+                else ' of a {:.2f} GB run budget'.format(self.max_run_bytes / GB),
+            )
+        )
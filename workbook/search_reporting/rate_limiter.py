@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import time
+import random
+import socket
+import threading
+import urllib.error
+
+### HTTP codes and Adwords error types worth retrying
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+RETRYABLE_TYPES = (
+    'RATE_EXCEEDED',
+    'RateExceededError',
+    'CONCURRENT_MODIFICATION',
+    'INTERNAL_API_ERROR',
+    'UNEXPECTED_INTERNAL_API_ERROR',
+    'ERROR_GETTING_RESPONSE_FROM_BACKEND',
+    'TRANSIENT_ERROR',
+)
+
+
+def is_retryable(error):
+
+    ### Network failures and timeouts
+    if isinstance(
+        error, (socket.timeout, TimeoutError, ConnectionError, urllib.error.URLError)
+    ):
+        return True
+
+    ### Adwords report errors carry the HTTP code and the API error type
+    if getattr(error, 'code', None) in RETRYABLE_CODES:
+        return True
+    description = '{} {}'.format(getattr(error, 'type', ''), error)
+    return any(error_type in description for error_type in RETRYABLE_TYPES)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+
+        ### Block until a token is available, return the time spent waiting
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdwordsRequestScheduler:
+    def __init__(
+        self,
+        token_rate=10,
+        account_rate=2,
+        max_retries=5,
+        base_delay=1,
+        max_delay=60,
+    ):
+
+        ### One bucket for the developer token, one per client account
+        self.token_bucket = TokenBucket(token_rate)
+        self.token_rate = token_rate
+        self.account_rate = account_rate
+        self.account_buckets = {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'throttled': 0}
+
+    def acquire(self, account_id):
+
+        with self.lock:
+            bucket = self.account_buckets.get(account_id)
+            if bucket is None:
+                bucket = TokenBucket(self.account_rate)
+                self.account_buckets[account_id] = bucket
+        waited = bucket.acquire() + self.token_bucket.acquire()
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['throttled'] += waited
+
+    def call(self, account_id, func, *args, give_up=None, **kwargs):
+
+        ### give_up tells which errors the caller handles better than a retry
+        attempt = 0
+        while True:
+            self.acquire(account_id)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if give_up is not None and give_up(e):
+                    raise
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    with self.lock:
+                        self.stats['failures'] += 1
+                    logging.error(
+                        "Adwords request failed for account {}: {}".format(
+                            account_id, e
+                        )
+                    )
+                    raise
+
+                ### Exponential backoff with full jitter
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** attempt)
+                )
+                attempt += 1
+                with self.lock:
+                    self.stats['retries'] += 1
+                logging.warning(
+                    "Retryable error for account {} ({}), retry {} in {:.1f}s".format(
+                        account_id, e, attempt, delay
+                    )
+                )
+                time.sleep(delay)
+
+    def log_stats(self):
+
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        logging.info(
+            "Adwords requests: {} in {:.0f}s ({:.2f}/s, limit {}/s), "
+            "{} retries, {} failures, {:.0f}s throttled".format(
+                self.stats['requests'],
+                elapsed,
+                self.stats['requests'] / elapsed,
+                self.token_rate,
+                self.stats['retries'],
+                self.stats['failures'],
+                self.stats['throttled'],
+            )
+        )
@@ -3,25 +3,151 @@
 ### Load libraries
 import logging
 import io
+import csv
 import datetime
-import pandas as pd
-from snowflake.connector import DictCursor
 from google.cloud import bigquery
-from googleads import adwords
+from google.api_core import exceptions
+
+### Load project modules
+import accounts
+import bq_create_tables
+import bq_loader
+import buffers
+import date_chunks
+import gclid_filter
+import keyword_cache
+import manifest
+import metrics
+import query_planner
+import rate_limiter
+import scheduler
+
+### Conversions keep one row per GCLID, its latest sale, in every Snowflake mode
+CONVERSION_ORDER = ', '.join(
+    '{} DESC NULLS LAST'.format(column)
+    for column in ['SALEDATE', 'CLICK_TIMESTAMP', 'ORDERS', 'REVENUE', 'SALES_VALUE']
+)
 
 
 class SnowflakeToBigQuery:
-    def __init__(self, sf_connex, bq_client, dataset_name):
+    def __init__(
+        self,
+        sf_connex,
+        bq_client,
+        dataset_name,
+        batch_size=None,
+        buffer_memory=64 * 1024 * 1024,
+        mode='full',
+        watermark_column='SALEDATE',
+        lookback_days=3,
+        run_metrics=None,
+        planner=None,
+        sink=None,
+        converting=None,
+        stage=None,
+        source_table='ADWORDS_GCLID_AGGREGATION',
+    ):
 
         logging.info("Initializing module")
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.planner = planner or query_planner.QueryPlanner(bq_client)
+
+        ### In incremental mode, only rows past the high-water mark of the
+        ### destination table (minus a lookback window) are extracted
+        since = None
+        self.mode = mode
+        if mode == 'incremental':
+            watermark = self.get_watermark(
+                bq_client, dataset_name, 'snow_conversions', watermark_column
+            )
+            if watermark is None:
+                logging.info("No high-water mark found, running a full refresh")
+                self.mode = 'full'
+            else:
+                since = str(self.to_date(watermark) - datetime.timedelta(lookback_days))
+                logging.info(
+                    "High-water mark on {}: {}, extracting from {}".format(
+                        watermark_column, watermark, since
+                    )
+                )
 
-        self.query, self.dest_table_name = self.get_query()
-        self.sf_report_data = self.get_snowflake_data(sf_connex, self.query)
-        self.load_report_to_bq(
-            bq_client, dataset_name, self.dest_table_name, self.sf_report_data
+        ### With a stage, Snowflake unloads the result to the bucket and BigQuery
+        ### loads it from there, without any row going through this host. If
+        ### the unload fails, the rows are extracted in process instead.
+        self.converting = converting
+        self.query, self.dest_table_name = self.get_query(
+            since, watermark_column, source_table
         )
+        self.stage = None
+        self.sf_report_data = None
+        if stage is not None:
+            try:
+                self.prefix = self.unload_to_stage(sf_connex, self.query, stage)
+                self.stage = stage
+            except Exception as e:
+                logging.warning(
+                    "Unload to stage failed, extracting in process: {}".format(e)
+                )
+
+        ### With a batch size, rows are streamed to a compressed spooled buffer.
+        ### Converting GCLIDs are collected on the way for click pruning.
+        if self.stage is None and batch_size:
+            self.sf_report_data = self.get_snowflake_data_streaming(
+                sf_connex, self.query, batch_size, buffer_memory
+            )
+        elif self.stage is None:
+            self.sf_report_data = self.get_snowflake_data(sf_connex, self.query)
 
-    def get_query(self):
+        ### Incremental rows go to a delta table, then are merged by GCLID.
+        ### The delta table always holds exactly the rows of the current run.
+        try:
+            if self.mode == 'incremental' and self.nb_rows == 0:
+                logging.info("No new conversions since the high-water mark")
+                bq_client.delete_table(
+                    bq_client.dataset(dataset_name).table(
+                        self.dest_table_name + '_delta'
+                    ),
+                    not_found_ok=True,
+                )
+            elif self.mode == 'incremental':
+                self.load_to_bq(
+                    bq_client, dataset_name, self.dest_table_name + '_delta'
+                )
+                self.merge_delta(
+                    bq_client,
+                    dataset_name,
+                    self.dest_table_name,
+                    self.dest_table_name + '_delta',
+                )
+            else:
+                if sink is not None and self.stage is None:
+                    sink.write(
+                        self.dest_table_name,
+                        self.sf_report_data,
+                        header=True,
+                        truncate=True,
+                    )
+                self.load_to_bq(bq_client, dataset_name, self.dest_table_name)
+        finally:
+            if self.stage is not None:
+                self.remove_from_stage(sf_connex, self.stage, self.prefix)
+
+        ### Without the full extract in process, the local copy and the
+        ### converting GCLIDs come from the conversions table
+        from_bigquery = self.mode == 'incremental' or self.stage is not None
+        if sink is not None and from_bigquery:
+            sink.drop(self.dest_table_name)
+        if converting is not None and from_bigquery:
+            converting.add_from_bigquery(bq_client, dataset_name, self.planner)
+        elif converting is not None:
+            converting.freeze()
+
+    def get_query(
+        self,
+        since=None,
+        watermark_column='SALEDATE',
+        source_table='ADWORDS_GCLID_AGGREGATION',
+    ):
 
         start_date = '2018-01-01'
         query = """
@@ -32,27 +158,219 @@ class SnowflakeToBigQuery:
             ORDERS,
             REVENUE,
             SALES_VALUE
-        FROM ADWORDS_GCLID_AGGREGATION
+        FROM {1}
         WHERE
             NB_ORDERS > 0 
             AND CLICK_TIMESTAMP >= '{0}'
+            AND TRACKING_GCLID IS NOT NULL
         """.format(
-            start_date
+            start_date, source_table
+        )
+        if since is not None:
+            query += "    AND {0} >= '{1}'\n".format(watermark_column, since)
+
+        ### A GCLID whose latest sale is past the watermark is extracted with
+        ### that sale, so its merged row is the row of a full extract
+        query += """    QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY TRACKING_GCLID ORDER BY {0}
+        ) = 1
+        """.format(
+            CONVERSION_ORDER
         )
         dest_table_name = 'snow_conversions'
 
         return query, dest_table_name
 
+    def get_watermark(self, bq_client, dataset_name, table_name, watermark_column):
+
+        query = "SELECT MAX({0}) FROM `{1}.{2}`".format(
+            watermark_column, dataset_name, table_name
+        )
+        try:
+            with self.metrics.timer('snowflake', 'bq_query', table=table_name) as event:
+                query_job = self.planner.run(query, label='watermark')
+                rows = list(query_job.result())
+                self.metrics.record_job(event, query_job)
+        except exceptions.NotFound:
+            return
+        return rows[0][0]
+
+    def to_date(self, value):
+
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if isinstance(value, datetime.date):
+            return value
+        return datetime.datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
     def get_snowflake_data(self, sf_connex, query):
 
+        ### Only the in-memory extract needs pandas
+        import pandas as pd
+        from snowflake.connector import DictCursor
+
         logging.info("Firing Snowflake query")
-        df = pd.DataFrame(sf_connex.cursor(DictCursor).execute(query).fetchall())
-        report_data = io.StringIO()
-        df.to_csv(report_data, index=False)
+        with self.metrics.timer('snowflake', 'query') as event:
+            df = pd.DataFrame(sf_connex.cursor(DictCursor).execute(query).fetchall())
+            self.nb_rows = len(df)
+            if self.converting is not None and self.nb_rows:
+                for gclid in df['TRACKING_GCLID']:
+                    self.converting.add(gclid)
+            report_data = io.StringIO()
+            df.to_csv(report_data, index=False)
+            self.checksum = manifest.checksum(report_data.getvalue())
+            event['rows'] = self.nb_rows
+            event['bytes_in'] = len(report_data.getvalue().encode('utf-8'))
 
         logging.info("Snowflake query finished")
         return report_data
 
+    def get_snowflake_data_streaming(
+        self, sf_connex, query, batch_size, buffer_memory=64 * 1024 * 1024
+    ):
+
+        logging.info("Firing Snowflake query")
+        with self.metrics.timer('snowflake', 'query') as event:
+            cursor = sf_connex.cursor()
+            cursor.execute(query)
+
+            ### Write the header, then each batch of rows as soon as it is fetched
+            report_data = buffers.ReportBuffer(buffer_memory)
+            writer = csv.writer(report_data, lineterminator='\n')
+            columns = [column[0] for column in cursor.description]
+            writer.writerow(columns)
+            nb_rows = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                nb_rows += len(rows)
+                if self.converting is not None:
+                    index = columns.index('TRACKING_GCLID')
+                    for row in rows:
+                        self.converting.add(row[index])
+            cursor.close()
+            event['rows'] = nb_rows
+            event['bytes_in'] = report_data.size
+        self.nb_rows = nb_rows
+        self.checksum = report_data.checksum()
+
+        raw = report_data.finish()
+        logging.info(
+            "Snowflake query finished: {} rows, {} bytes, {} compressed, "
+            "peak memory {:.0f} MB".format(
+                nb_rows,
+                report_data.size,
+                report_data.compressed_size,
+                buffers.peak_memory_mb(),
+            )
+        )
+        return raw
+
+    def unload_to_stage(self, sf_connex, query, stage):
+
+        prefix = stage.new_prefix(self.dest_table_name)
+        logging.info("Unloading Snowflake query to '{}'".format(stage.location(prefix)))
+        with self.metrics.timer('snowflake', 'unload') as event:
+            cursor = sf_connex.cursor()
+            cursor.execute(stage.unload_query(query, prefix))
+
+            ### rows_unloaded, input_bytes and output_bytes
+            results = cursor.fetchall()
+            cursor.close()
+            self.nb_rows = sum(int(row[0]) for row in results)
+            event['rows'] = self.nb_rows
+            event['bytes_out'] = sum(int(row[2]) for row in results)
+        self.checksum = manifest.checksum('{}\n{}'.format(query, self.nb_rows))
+        logging.info(
+            "Snowflake unload finished: {} rows, {} bytes of Parquet".format(
+                self.nb_rows, event['bytes_out']
+            )
+        )
+        return prefix
+
+    def remove_from_stage(self, sf_connex, stage, prefix):
+
+        cursor = sf_connex.cursor()
+        try:
+            cursor.execute(stage.remove_query(prefix))
+        except Exception as e:
+            logging.warning(
+                "Files of '{}' not removed: {}".format(stage.location(prefix), e)
+            )
+        finally:
+            cursor.close()
+
+    def load_to_bq(self, bq_client, dataset_name, dest_table_name):
+
+        if self.stage is None:
+            self.load_report_to_bq(
+                bq_client, dataset_name, dest_table_name, self.sf_report_data
+            )
+        else:
+            self.load_stage_to_bq(
+                bq_client, dataset_name, dest_table_name, self.stage, self.prefix
+            )
+
+    def load_stage_to_bq(self, bq_client, dataset_name, dest_table_name, stage, prefix):
+
+        ### Parquet files are loaded to a staging table, then cast to the
+        ### standard column types, since Snowflake unloads numbers as decimals
+        dataset_ref = bq_client.dataset(dataset_name)
+        staging_name = dest_table_name + '_unload'
+        columns = [
+            (field.name, bq_create_tables.SQL_TYPES[field.field_type])
+            for field in bq_create_tables.SCHEMAS['snow_conversions']
+        ]
+        if self.nb_rows:
+            job_config = bigquery.LoadJobConfig()
+            job_config.source_format = bigquery.SourceFormat.PARQUET
+            job_config.write_disposition = 'WRITE_TRUNCATE'
+            with self.metrics.timer(
+                'snowflake', 'bq_load', table=staging_name
+            ) as event:
+                load_job = bq_client.load_table_from_uri(
+                    stage.uri(prefix),
+                    dataset_ref.table(staging_name),
+                    job_config=job_config,
+                )
+                logging.info(
+                    "Loading '{}' to BigQuery table '{}.{}'".format(
+                        stage.uri(prefix), dataset_name, staging_name
+                    )
+                )
+                load_job.result()
+                self.metrics.record_job(event, load_job)
+            query = "SELECT {0} FROM `{1}.{2}`".format(
+                ', '.join('CAST({0} AS {1}) AS {0}'.format(*c) for c in columns),
+                dataset_name,
+                staging_name,
+            )
+        else:
+            query = "SELECT {0} LIMIT 0".format(
+                ', '.join('CAST(NULL AS {1}) AS {0}'.format(*c) for c in columns)
+            )
+
+        table_ref = dataset_ref.table(dest_table_name)
+        job_config = bigquery.QueryJobConfig()
+        job_config.destination = table_ref
+        job_config.write_disposition = 'WRITE_TRUNCATE'
+        bq_create_tables.keep_layout(bq_client, table_ref, job_config, dest_table_name)
+        try:
+            with self.metrics.timer(
+                'snowflake', 'bq_query', table=dest_table_name
+            ) as event:
+                query_job = self.planner.run(query, job_config, label=dest_table_name)
+                self.metrics.record_job(event, query_job)
+        finally:
+            bq_client.delete_table(
+                dataset_ref.table(staging_name), not_found_ok=True
+            )
+        logging.info(
+            "Loading to table '{}.{}' done".format(dataset_name, dest_table_name)
+        )
+
     def load_report_to_bq(self, bq_client, dataset_name, dest_table_name, report_data):
 
         dataset_ref = bq_client.dataset(dataset_name)
@@ -60,123 +378,401 @@ class SnowflakeToBigQuery:
         job_config.write_disposition = 'WRITE_TRUNCATE'
         job_config.source_format = bigquery.SourceFormat.CSV
         job_config.skip_leading_rows = 1
-        job_config.autodetect = True
 
-        report_data.seek(0)
-        with report_data as source:
-            load_job = bq_client.load_table_from_file(
-                source, dataset_ref.table(dest_table_name), job_config=job_config
-            )
-            logging.info(
-                "Loading report data to BigQuery table '{}.{}'".format(
-                    dataset_name, dest_table_name
-                )
-            )
+        ### Types are never inferred: a small delta with a column all NULL or
+        ### all integral would not match snow_conversions in the merge
+        job_config.schema = bq_create_tables.SCHEMAS['snow_conversions']
+        bq_create_tables.keep_layout(
+            bq_client, dataset_ref.table(dest_table_name), job_config, dest_table_name
+        )
 
-        load_job.result()
+        with self.metrics.timer(
+            'snowflake', 'bq_load', table=dest_table_name
+        ) as event:
+            event['bytes_out'] = metrics.stream_size(report_data)
+            report_data.seek(0)
+            with report_data as source:
+                load_job = bq_client.load_table_from_file(
+                    source, dataset_ref.table(dest_table_name), job_config=job_config
+                )
+                logging.info(
+                    "Loading report data to BigQuery table '{}.{}'".format(
+                        dataset_name, dest_table_name
+                    )
+                )
+            load_job.result()
+            self.metrics.record_job(event, load_job)
         logging.info(
             "Loading to table '{}.{}' done".format(dataset_name, dest_table_name)
         )
 
+    def merge_delta(self, bq_client, dataset_name, dest_table_name, delta_table_name):
+
+        ### Upsert the delta rows into the destination table, one row per GCLID
+        columns = [
+            'CLICK_TIMESTAMP',
+            'SALEDATE',
+            'TRACKING_GCLID',
+            'ORDERS',
+            'REVENUE',
+            'SALES_VALUE',
+        ]
+        query = """
+        MERGE `{0}.{1}` AS t
+        USING (
+            SELECT *
+            FROM `{0}.{2}`
+            WHERE TRACKING_GCLID IS NOT NULL
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY TRACKING_GCLID ORDER BY {6}
+            ) = 1
+        ) AS s
+        ON t.TRACKING_GCLID = s.TRACKING_GCLID
+        WHEN MATCHED THEN
+            UPDATE SET {3}
+        WHEN NOT MATCHED THEN
+            INSERT ({4}) VALUES ({5})
+        """.format(
+            dataset_name,
+            dest_table_name,
+            delta_table_name,
+            ', '.join('{0} = s.{0}'.format(c) for c in columns),
+            ', '.join(columns),
+            ', '.join('s.{}'.format(c) for c in columns),
+            CONVERSION_ORDER,
+        )
+
+        logging.info(
+            "Merging '{}.{}' into '{}.{}'".format(
+                dataset_name, delta_table_name, dataset_name, dest_table_name
+            )
+        )
+        with self.metrics.timer(
+            'snowflake', 'bq_query', table=dest_table_name
+        ) as event:
+            query_job = self.planner.run(query, label=dest_table_name)
+            self.metrics.record_job(event, query_job)
+        logging.info(
+            "Merge done: {} row(s) affected".format(query_job.num_dml_affected_rows)
+        )
+
 
 class AdwordsToBigQuery:
     def __init__(
-        self, account, adw_client, bq_client, dataset_name, date_begin, date_end
+        self,
+        account,
+        adw_client,
+        bq_client,
+        dataset_name,
+        date_begin,
+        date_end,
+        workers=1,
+        client_factory=None,
+        loader=None,
+        load_mode='append',
+        run_manifest=None,
+        request_scheduler=None,
+        kw_cache=None,
+        hierarchy=None,
+        buffer_memory=64 * 1024 * 1024,
+        run_metrics=None,
+        sink=None,
+        upload=True,
+        converting=None,
+        slots=None,
+        slot_owner=None,
+        volumes=None,
+        writer=None,
+        click_window_days=30,
+        planner=None,
     ):
 
         logging.info("Initializing module")
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.planner = planner or query_planner.QueryPlanner(bq_client)
+        self.converting = converting
+        self.volumes = volumes
+
+        ### Clicks of the last click_window_days are never pruned, their
+        ### conversion may not be known yet
+        self.prune_before = str(
+            datetime.date.today() - datetime.timedelta(click_window_days)
+        )
+
+        ### All Adwords calls share the same rate limits and retry policy
+        if request_scheduler is None:
+            request_scheduler = rate_limiter.AdwordsRequestScheduler()
+        self.requests = request_scheduler
+        if hierarchy is None:
+            hierarchy = accounts.AccountHierarchy(request_scheduler=request_scheduler)
+        self.hierarchy = hierarchy
 
         ### Get list of accounts
         self.accounts = self.get_all_accounts(adw_client, account)
         logging.info("List of accounts: {}".format(self.accounts))
 
-        ### Make Adwords API calls for each account
-        for account_id in self.accounts:
-            logging.info("Processing account {}".format(account_id))
-
-            ### Ad Performance report
-            self.kw_report_data = self.get_ad_performance_report(
-                adw_client, account_id, date_begin, date_end
-            )
-            self.load_report_to_table(
-                bq_client, dataset_name, 'adw_keywords', self.kw_report_data
-            )
-
-            ### Keywords names & IDs
-            self.kw_names = self.get_keywords_names(adw_client, account_id)
-            self.load_report_to_table(
-                bq_client, dataset_name, 'adw_kw_names', self.kw_names
+        ### Without a client factory, every unit has to share the provided client
+        if client_factory is None:
+            if workers > 1:
+                logging.warning(
+                    "No Adwords client factory provided, falling back to 1 worker"
+                )
+            workers = 1
+            client_factory = lambda: adw_client
+
+        ### Reports are gathered per destination table and loaded in batches.
+        ### Each buffer keeps up to buffer_memory bytes in memory.
+        self.buffer_memory = buffer_memory
+        if loader is None:
+            loader = bq_loader.BatchLoader(
+                bq_client,
+                dataset_name,
+                mode=load_mode,
+                manifest=run_manifest,
+                max_memory=buffer_memory,
+                run_metrics=self.metrics,
+                sink=sink,
+                upload=upload,
+                writer=writer,
             )
-
-            ### Gclid reports (one for each day)
-            for date in self.get_period_dates(date_begin, date_end):
-                self.gclid_report_data = self.get_gclid_report_oneday(
-                    adw_client, account_id, date
+        self.loader = loader
+
+        ### Units whose stream was committed by a stopped run are done
+        self.loader.recover_commits()
+
+        ### Make Adwords API calls for each work unit, and always flush what
+        ### has been downloaded so far, even if the run is interrupted
+        self.date_begin = date_begin
+        self.date_end = date_end
+        self.run_manifest = run_manifest
+        self.kw_cache = kw_cache
+        self.kw_counts = {}
+        if kw_cache is not None:
+            self.kw_counts = self.get_keyword_counts(dataset_name)
+        self.units = self.get_work_units(self.accounts, date_begin, date_end)
+        if run_manifest is not None:
+            self.units = [
+                unit
+                for unit in self.units
+                if not run_manifest.is_done(self.unit_key(unit))
+            ]
+        self.scheduler = scheduler.WorkUnitScheduler(
+            workers, client_factory, slots=slots, owner=slot_owner or account
+        )
+        try:
+            self.failed_units = self.scheduler.run(self.units, self.process_unit)
+        finally:
+            self.loader.flush_all()
+            self.requests.log_stats()
+
+        ### Units of a batch that failed to load, keyed like in the manifest
+        self.failed_loads = list(self.loader.failed_keys)
+
+    def get_work_units(self, accounts, date_begin, date_end):
+
+        units = []
+        dates = self.get_period_dates(date_begin, date_end)
+        for account_id in accounts:
+            units.extend(self.get_adperf_units(account_id, date_begin, date_end))
+            if self.kw_cache is None or not self.kw_cache.is_fresh(
+                account_id, self.kw_counts.get(str(account_id), 0)
+            ):
+                units.append(scheduler.WorkUnit(account_id, 'kwnames', None))
+            for date in dates:
+                units.append(scheduler.WorkUnit(account_id, 'gclid', date))
+        return units
+
+    def get_keyword_counts(self, dataset_name):
+
+        ### Number of keywords of each account in the table, checked against
+        ### the cache so that a recreated table is loaded again
+        query = """
+        SELECT ExternalCustomerId, COUNT(*) AS nb_keys
+        FROM `{0}.adw_kw_names`
+        GROUP BY ExternalCustomerId
+        """.format(
+            dataset_name
+        )
+        try:
+            query_job = self.planner.run(query, label='keyword_counts')
+        except exceptions.NotFound:
+            return {}
+        return {str(row[0]): row[1] for row in query_job.result()}
+
+    def get_adperf_units(self, account_id, date_begin, date_end):
+
+        ### Dates loaded by a previous attempt are left out, whatever the
+        ### ranges it used. The rest is cut in ranges sized by the rows per
+        ### day seen for the account, all in one range without volumes.
+        dates = self.get_dates_range(date_begin, date_end)
+        if self.run_manifest is not None:
+            prefix = 'adwords/{}/adperf/'.format(account_id)
+            loaded = set()
+            for key in self.run_manifest.done_keys(prefix):
+                begin, end = key[len(prefix) :].split('..')
+                loaded.update(self.get_dates_range(begin, end))
+            dates = [date for date in dates if date not in loaded]
+        days = len(dates)
+        if self.volumes is not None:
+            days = self.volumes.chunk_days(account_id)
+        return [
+            scheduler.WorkUnit(account_id, 'adperf', '{}..{}'.format(begin, end))
+            for begin, end in date_chunks.split_dates(dates, days)
+        ]
+
+    def unit_range(self, unit):
+
+        if unit.date and '..' in unit.date:
+            return unit.date.split('..')
+        return self.date_begin, self.date_end
+
+    def unit_key(self, unit):
+
+        date = unit.date or '{}..{}'.format(self.date_begin, self.date_end)
+        return 'adwords/{}/{}/{}'.format(unit.account_id, unit.report, date)
+
+    def process_unit(self, adw_client, unit):
+
+        on_loaded = None
+
+        ### Ad Performance report for a range of dates. A range timing out
+        ### is replaced by its two halves.
+        if unit.report == 'adperf':
+            date_begin, date_end = self.unit_range(unit)
+            halves = date_chunks.halve(date_begin, date_end)
+            try:
+                report_data = self.get_ad_performance_report(
+                    adw_client,
+                    unit.account_id,
+                    date_begin,
+                    date_end,
+                    give_up=date_chunks.is_timeout if halves else None,
                 )
-                self.load_report_to_table(
-                    bq_client, dataset_name, 'adw_gclid_list', self.gclid_report_data
+            except Exception as e:
+                if halves is None or not date_chunks.is_timeout(e):
+                    raise
+                logging.warning(
+                    "Ad Performance report of account {} timed out from {} to {}, "
+                    "split in two".format(unit.account_id, date_begin, date_end)
+                )
+                return [
+                    scheduler.WorkUnit(unit.account_id, 'adperf', '{}..{}'.format(*h))
+                    for h in halves
+                ]
+            table_name = 'adw_keywords'
+            dates = self.get_dates_range(date_begin, date_end)
+            if self.volumes is not None:
+                self.volumes.record(unit.account_id, report_data.lines, len(dates))
+
+        ### Keywords names & IDs
+        elif unit.report == 'kwnames':
+            report_data = self.get_keywords_names(adw_client, unit.account_id)
+            table_name = 'adw_kw_names'
+            dates = []
+
+            ### Unchanged keywords are not loaded again
+            if self.kw_cache is not None:
+                content = report_data.getvalue()
+                new_hash = keyword_cache.content_hash(content)
+                nb_keys = keyword_cache.key_count(content)
+                table_keys = self.kw_counts.get(str(unit.account_id), 0)
+                if not self.kw_cache.has_changed(unit.account_id, new_hash, table_keys):
+                    logging.info(
+                        "Keywords of account {} unchanged".format(unit.account_id)
+                    )
+                    self.kw_cache.update(unit.account_id, new_hash, nb_keys)
+                    if self.run_manifest is not None:
+                        self.run_manifest.mark_done(self.unit_key(unit))
+                    return
+                on_loaded = lambda: self.kw_cache.update(
+                    unit.account_id, new_hash, nb_keys
                 )
 
-    def get_all_accounts(self, adw_client, account):
-
-        ### Initialize appropriate service.
-        managed_customer_service = adw_client.GetService(
-            'ManagedCustomerService', version='v201809'
-        )
+        ### Gclid report for one day
+        elif unit.report == 'gclid':
+            report_data = self.get_gclid_report_oneday(
+                adw_client, unit.account_id, unit.date
+            )
+            table_name = 'adw_gclid_list'
+            dates = [unit.date]
+
+            ### Only clicks with a known conversion keep their GCLID
+            if self.converting is not None and str(unit.date) < self.prune_before:
+                with self.metrics.timer(
+                    'adwords', 'prune', account=unit.account_id, report='gclid'
+                ) as event:
+                    report_data = gclid_filter.prune_clicks(
+                        report_data, self.converting, self.buffer_memory, event
+                    )
 
-        ### Construct selector to get all accounts.
-        page_size = 500
-        offset = 0
-        selector = {
-            'fields': ['CustomerId', 'Name'],
-            'paging': {'startIndex': str(offset), 'numberResults': str(page_size)},
-        }
-        more_pages = True
-        child_links = {}
-
-        ### Browse through accounts
-        while more_pages:
-            page = managed_customer_service.get(selector)
-            if 'entries' in page and page['entries']:
-                if 'links' in page:
-                    for link in page['links']:
-                        if link['managerCustomerId'] not in child_links:
-                            child_links[link['managerCustomerId']] = []
-                        child_links[link['managerCustomerId']].append(link)
-            offset += page_size
-            selector['paging']['startIndex'] = str(offset)
-            more_pages = offset < int(page['totalNumEntries'])
-
-        ### Check if account is an MCC, otherwise just return the provided account ID
-        mcc = int(str(account).replace('-', ''))
-        if int(mcc) in child_links:
-            accounts_list = [i['clientCustomerId'] for i in child_links[int(mcc)]]
         else:
-            accounts_list = [mcc]
+            raise Exception("Unknown report type '{}'".format(unit.report))
 
-        return accounts_list
-
-    def load_report_to_table(self, bq_client, dataset_name, table_name, report_data):
-
-        dataset_ref = bq_client.dataset(dataset_name)
-        job_config = bigquery.LoadJobConfig()
-        job_config.source_format = bigquery.SourceFormat.CSV
-
-        report_data.seek(0)
-        with report_data as source:
-            load_job = bq_client.load_table_from_file(
-                source, dataset_ref.table(table_name), job_config=job_config
+        unit_key = self.unit_key(unit)
+        if self.run_manifest is not None:
+            self.run_manifest.mark(
+                unit_key, 'downloaded', report_data.checksum()
             )
+        report_data.finish()
+        logging.info(
+            "Unit {}: {} bytes downloaded, {} compressed, peak memory {:.0f} MB".format(
+                unit_key,
+                report_data.size,
+                report_data.compressed_size,
+                buffers.peak_memory_mb(),
+            )
+        )
+        self.loader.add(
+            table_name,
+            report_data,
+            dates,
+            unit_key,
+            on_loaded,
+            account_id=unit.account_id,
+        )
 
-        load_job.result()
-        logging.info("Data loaded to table '{}.{}'".format(dataset_name, table_name))
+    def get_all_accounts(self, adw_client, account):
+
+        ### Nested managers are resolved down to their client accounts
+        return self.hierarchy.get_accounts(adw_client, account)
 
-    def get_ad_performance_report(self, adw_client, account_id, date_begin, date_end):
+    def download_report(self, adw_client, account_id, report, give_up=None):
 
         ### Initialize appropriate service
         adw_client.SetClientCustomerId(account_id)
         report_downloader = adw_client.GetReportDownloader(version='v201809')
 
+        ### Stream the report content to a compressed spooled buffer, chunk
+        ### by chunk. Each attempt starts from an empty buffer.
+        def download():
+            with self.metrics.timer(
+                'adwords',
+                'download',
+                account=account_id,
+                report=report['reportType'],
+            ) as event:
+                report_data = buffers.ReportBuffer(self.buffer_memory)
+                stream = report_downloader.DownloadReportAsStream(
+                    report,
+                    skip_report_header=True,
+                    skip_column_header=True,
+                    skip_report_summary=True,
+                    include_zero_impressions=False,
+                )
+                try:
+                    report_data.write_stream(stream)
+                finally:
+                    stream.close()
+                event['rows'] = report_data.lines
+                event['bytes_in'] = report_data.size
+            return report_data
+
+        return self.requests.call(account_id, download, give_up=give_up)
+
+    def get_ad_performance_report(
+        self, adw_client, account_id, date_begin, date_end, give_up=None
+    ):
+
         ### Construct query
         report = {
             'reportName': 'Last X days AD_PERFORMANCE_REPORT',
@@ -200,33 +796,16 @@ class AdwordsToBigQuery:
                     'Clicks',
                     'Conversions',
                     'AveragePosition',
+                    'ExternalCustomerId',
                 ],
                 'dateRange': {'min': date_begin, 'max': date_end},
             },
         }
 
-        ### Retrieve the report content and return it as StringIO object
-        try:
-            report_data = io.StringIO()
-            report_downloader.DownloadReport(
-                report,
-                report_data,
-                skip_report_header=True,
-                skip_column_header=True,
-                skip_report_summary=True,
-                include_zero_impressions=False,
-            )
-            return report_data
-        except:
-            logging.error("Error: could not generate report")
-            return
+        return self.download_report(adw_client, account_id, report, give_up)
 
     def get_keywords_names(self, adw_client, account_id):
 
-        ### Initialize appropriate service
-        adw_client.SetClientCustomerId(account_id)
-        report_downloader = adw_client.GetReportDownloader(version='v201809')
-
         ### Construct query
         report = {
             'reportName': 'Last X days KEYWORDS_PERFORMANCE_REPORT',
@@ -240,33 +819,16 @@ class AdwordsToBigQuery:
                     'Criteria',
                     'KeywordMatchType',
                     'Id',
+                    'ExternalCustomerId',
                 ],
                 'dateRange': {'min': '2018-01-01'},
             },
         }
 
-        ### Retrieve the report content and return it as StringIO object
-        try:
-            report_data = io.StringIO()
-            report_downloader.DownloadReport(
-                report,
-                report_data,
-                skip_report_header=True,
-                skip_column_header=True,
-                skip_report_summary=True,
-                include_zero_impressions=False,
-            )
-            return report_data
-        except:
-            logging.error("Error: could not generate report")
-            return
+        return self.download_report(adw_client, account_id, report)
 
     def get_gclid_report_oneday(self, adw_client, account_id, date):
 
-        ### Initialize appropriate service
-        adw_client.SetClientCustomerId(account_id)
-        report_downloader = adw_client.GetReportDownloader(version='v201809')
-
         ### Construct query
         report = {
             'reportName': 'CLICK_PERFORMANCE_REPORT',
@@ -284,26 +846,22 @@ class AdwordsToBigQuery:
                     'Device',
                     'GclId',
                     'Clicks',
+                    'ExternalCustomerId',
                 ],
                 'dateRange': {'min': date, 'max': date},
             },
         }
 
-        ### Retrieve the report content and return it as StringIO object
-        try:
-            report_data = io.StringIO()
-            report_downloader.DownloadReport(
-                report,
-                report_data,
-                skip_report_header=True,
-                skip_column_header=True,
-                skip_report_summary=True,
-                include_zero_impressions=False,
-            )
-            return report_data
-        except:
-            logging.error("Error: could not generate report")
-            return
+        return self.download_report(adw_client, account_id, report)
+
+    def get_dates_range(self, date_begin, date_end):
+
+        date_begin = datetime.datetime.strptime(date_begin, "%Y-%m-%d").date()
+        date_end = datetime.datetime.strptime(date_end, "%Y-%m-%d").date()
+        return [
+            str(date_begin + datetime.timedelta(days=i))
+            for i in range((date_end - date_begin).days + 1)
+        ]
 
     def get_period_dates(self, date_begin, date_end):
 
@@ -340,23 +898,111 @@ class AdwordsToBigQuery:
 
 
 class JoinFinalTable:
-    def __init__(self, bq_client, dataset_name, date_begin, date_end):
+    def __init__(
+        self,
+        bq_client,
+        dataset_name,
+        date_begin,
+        date_end,
+        mode='full',
+        run_metrics=None,
+        planner=None,
+        over_budget='fail',
+        backend=None,
+    ):
 
         logging.info("Initializing module")
-        self.join_final_table(
-            bq_client, dataset_name, 'final_report', date_begin, date_end
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.planner = planner or query_planner.QueryPlanner(bq_client)
+
+        ### An unconverted final table keeps its 'YYYYMMDD' dates
+        dest_table_name = 'final_report'
+        self.date_type = bq_create_tables.date_type(
+            bq_client, bq_client.dataset(dataset_name).table(dest_table_name)
         )
 
-    def join_final_table(
-        self, bq_client, dataset_name, dest_table_name, date_begin, date_end
-    ):
+        ### Incremental mode only rebuilds the dates touched by the current run
+        if mode == 'incremental' and not self.table_exists(
+            bq_client, dataset_name, dest_table_name
+        ):
+            logging.info(
+                "Table '{}' not found, running a full rebuild".format(dest_table_name)
+            )
+            mode = 'full'
+
+        ### Another backend runs the join elsewhere and replaces the same
+        ### dates of the final table, as one range
+        if backend is not None:
+            if mode == 'incremental':
+                self.dates = self.get_touched_dates(
+                    bq_client, dataset_name, date_begin, date_end
+                )
+                date_begin, date_end = self.dates[0], self.dates[-1]
+            backend.join_final_table(dest_table_name, date_begin, date_end)
+        elif mode == 'incremental':
+            self.dates = self.get_touched_dates(
+                bq_client, dataset_name, date_begin, date_end
+            )
+            self.replace_dates(bq_client, dataset_name, dest_table_name, self.dates)
+        else:
+            try:
+                self.join_final_table(
+                    bq_client, dataset_name, dest_table_name, date_begin, date_end
+                )
+            except query_planner.BudgetExceeded as e:
+                if over_budget != 'narrow':
+                    raise
+                logging.warning("{}, narrowing the date range".format(e))
+                self.narrow_dates(
+                    bq_client, dataset_name, dest_table_name, date_begin, date_end
+                )
 
-        dataset_ref = bq_client.dataset(dataset_name)
-        table_ref = dataset_ref.table(dest_table_name)
-        job_config = bigquery.QueryJobConfig()
-        job_config.destination = table_ref
-        job_config.write_disposition = 'WRITE_TRUNCATE'
+    def table_exists(self, bq_client, dataset_name, table_name):
+
+        try:
+            bq_client.get_table(bq_client.dataset(dataset_name).table(table_name))
+        except exceptions.NotFound:
+            return False
+        return True
+
+    def get_touched_dates(self, bq_client, dataset_name, date_begin, date_end):
+
+        ### Dates of the Adwords period of the current run
+        date_begin = datetime.datetime.strptime(date_begin, "%Y-%m-%d").date()
+        date_end = datetime.datetime.strptime(date_end, "%Y-%m-%d").date()
+        dates = set()
+        for i in range((date_end - date_begin).days + 1):
+            dates.add(date_begin + datetime.timedelta(days=i))
+
+        ### Dates of the clicks behind conversions that arrived in this run
+        query = """
+        SELECT DISTINCT a.Date
+        FROM `{0}.adw_gclid_list` AS a
+        INNER JOIN `{0}.snow_conversions_delta` AS b
+        ON a.GCLID = b.TRACKING_GCLID
+        """.format(
+            dataset_name
+        )
+        try:
+            with self.metrics.timer(
+                'join', 'bq_query', table='snow_conversions_delta'
+            ) as event:
+                query_job = self.planner.run(query, label='touched_dates')
+                new_dates = set(row[0] for row in query_job.result())
+                self.metrics.record_job(event, query_job)
+        except exceptions.NotFound:
+            new_dates = set()
+        logging.info(
+            "{} date(s) in period, {} more touched by new conversions".format(
+                len(dates), len(new_dates - dates)
+            )
+        )
 
+        return sorted(dates | new_dates)
+
+    def get_join_query(self, dataset_name, date_filter):
+
+        ### date_filter is a condition on '{0}.Date', formatted with each table alias
         query = """
         WITH gclid AS (
             SELECT *
@@ -369,13 +1015,18 @@ class JoinFinalTable:
                     AND NB_ORDERS > 0
             ) AS b
             ON a.GCLID = b.TRACKING_GCLID
+            WHERE {0}
         ),
         kwnames AS (
-            SELECT DISTINCT
-                AdGroupId, 
+            SELECT
+                AdGroupId,
                 KeywordId,
                 Keyword
             FROM `{2}.adw_kw_names`
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY AdGroupId, KeywordId ORDER BY Keyword
+            ) = 1
         )
 
         SELECT
@@ -392,7 +1043,7 @@ class JoinFinalTable:
             kw.CreativeId AS CreativeId,
             kwnames.Keyword AS Keyword,
             kw.Device AS Device,
-            FORMAT_DATE("%Y%m%d", kw.Date) AS Date,
+            {3} AS Date,
             kw.Cost/1000000 AS Cost,
             kw.Impressions AS Impressions,
             kw.Clicks AS Clicks,
@@ -417,19 +1068,123 @@ class JoinFinalTable:
             kw.AdGroupId = kwnames.AdGroupId
             AND kw.KeywordId = kwnames.KeywordId
 
-        WHERE kw.Date BETWEEN '{0}' AND '{1}'
+        WHERE {1}
 
         GROUP BY 1,2,3,4,5,6,7,8,9,10,11,12,13,14,15;
         """.format(
-            date_begin, date_end, dataset_name
+            date_filter.format('a'),
+            date_filter.format('kw'),
+            dataset_name,
+            bq_create_tables.date_value('kw.Date', self.date_type),
+        )
+
+        return query
+
+    def join_final_table(
+        self, bq_client, dataset_name, dest_table_name, date_begin, date_end
+    ):
+
+        dataset_ref = bq_client.dataset(dataset_name)
+        table_ref = dataset_ref.table(dest_table_name)
+        job_config = bigquery.QueryJobConfig()
+        job_config.destination = table_ref
+        job_config.write_disposition = 'WRITE_TRUNCATE'
+        bq_create_tables.keep_layout(bq_client, table_ref, job_config, dest_table_name)
+
+        query = self.get_join_query(
+            dataset_name,
+            "{{0}}.Date BETWEEN '{0}' AND '{1}'".format(date_begin, date_end),
         )
 
         logging.info("Firing BigQuery query")
-        query_job = bq_client.query(query, job_config=job_config)
-        query_job.result()
+        with self.metrics.timer('join', 'bq_query', table=dest_table_name) as event:
+            query_job = self.planner.run(
+                query,
+                job_config,
+                label='{}.{}'.format(dataset_name, dest_table_name),
+                reuse=True,
+            )
+            if query_job is not None:
+                self.metrics.record_job(event, query_job)
         logging.info(
             "Query results loaded to table '{}.{}'".format(
                 dataset_name, dest_table_name
             )
         )
 
+    def replace_dates(self, bq_client, dataset_name, dest_table_name, dates):
+
+        ### Delete and re-insert the given dates in a single transaction
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [
+            bigquery.ArrayQueryParameter('dates', 'DATE', dates)
+        ]
+        query = """
+        BEGIN TRANSACTION;
+
+        DELETE FROM `{0}.{1}`
+        WHERE Date IN (SELECT {3} FROM UNNEST(@dates) AS d);
+
+        INSERT INTO `{0}.{1}` (
+            Site, AccountName, CampaignName, CampaignType, Partner, AdGroupName,
+            CreativeId, Keyword, Device, Date, Cost, Impressions, Clicks,
+            Conversions, AveragePosition, Orders, Revenue, SalesValue
+        )
+        {2};
+
+        COMMIT TRANSACTION;
+        """.format(
+            dataset_name,
+            dest_table_name,
+            self.get_join_query(dataset_name, "{0}.Date IN UNNEST(@dates)").rstrip(
+                "; \n"
+            ),
+            bq_create_tables.date_value('d', self.date_type),
+        )
+
+        logging.info("Firing BigQuery query for {} date(s)".format(len(dates)))
+        with self.metrics.timer('join', 'bq_query', table=dest_table_name) as event:
+            query_job = self.planner.run(
+                query,
+                job_config,
+                label='{}.{}'.format(dataset_name, dest_table_name),
+                reuse=True,
+            )
+            if query_job is not None:
+                self.metrics.record_job(event, query_job)
+        logging.info(
+            "Dates replaced in table '{}.{}'".format(dataset_name, dest_table_name)
+        )
+
+    def narrow_dates(
+        self, bq_client, dataset_name, dest_table_name, date_begin, date_end
+    ):
+
+        ### Keep the most recent half of the range until the query fits the
+        ### budget. Older dates already in the table are left as they are.
+        begin = datetime.datetime.strptime(date_begin, "%Y-%m-%d").date()
+        end = datetime.datetime.strptime(date_end, "%Y-%m-%d").date()
+        exists = self.table_exists(bq_client, dataset_name, dest_table_name)
+        while begin < end:
+            begin += datetime.timedelta(((end - begin).days + 1) // 2)
+            try:
+                if exists:
+                    dates = [
+                        begin + datetime.timedelta(i)
+                        for i in range((end - begin).days + 1)
+                    ]
+                    self.replace_dates(bq_client, dataset_name, dest_table_name, dates)
+                else:
+                    self.join_final_table(
+                        bq_client, dataset_name, dest_table_name, str(begin), date_end
+                    )
+            except query_planner.BudgetExceeded as e:
+                logging.warning("{}, narrowing again".format(e))
+                continue
+            logging.warning(
+                "Final table only rebuilt from {} to {}".format(begin, date_end)
+            )
+            return
+        raise query_planner.BudgetExceeded(
+            "No date range of the final table fits the budget"
+        )
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import time
+import itertools
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+### One Adwords download: an account, a report type and an optional date
+WorkUnit = collections.namedtuple('WorkUnit', ['account_id', 'report', 'date'])
+
+
+class FairSemaphore:
+    def __init__(self, slots):
+
+        ### Work slots shared by several owners (the tenants of a batch). A freed
+        ### slot goes to the waiting owner holding the fewest slots, so that an
+        ### owner with many units queued cannot starve the others.
+        self.slots = max(1, int(slots))
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+        self.waiters = {}
+        self.held = collections.Counter()
+        self.waited = collections.Counter()
+        self.in_use = 0
+
+    def next_ticket(self):
+
+        return min(self.waiters, key=lambda t: (self.held[self.waiters[t]], t))
+
+    def acquire(self, owner):
+
+        start = time.monotonic()
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiters[ticket] = owner
+            try:
+                while self.in_use >= self.slots or self.next_ticket() != ticket:
+                    self.condition.wait()
+            except BaseException:
+                del self.waiters[ticket]
+                self.condition.notify_all()
+                raise
+            del self.waiters[ticket]
+            self.in_use += 1
+            self.held[owner] += 1
+            self.waited[owner] += time.monotonic() - start
+
+            ### Another waiter may be next in line for a slot still free
+            self.condition.notify_all()
+
+    def release(self, owner):
+
+        with self.condition:
+            self.in_use -= 1
+            self.held[owner] -= 1
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, owner):
+
+        self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release(owner)
+
+
+class WorkUnitScheduler:
+    def __init__(self, workers=1, client_factory=None, slots=None, owner=None):
+
+        ### With slots, every unit also waits for a slot shared with other owners
+        self.workers = max(1, int(workers))
+        self.client_factory = client_factory
+        self.slots = slots
+        self.owner = owner
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.failed = []
+
+    def get_client(self):
+
+        ### Each worker thread builds its own client on first use, so that
+        ### SetClientCustomerId calls never leak from one thread to another
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.client_factory()
+            if client is None:
+                raise Exception("Client factory did not return a client")
+            self.local.client = client
+        return client
+
+    def run_unit(self, unit, handler):
+
+        ### A handler may replace its unit with smaller ones, run in turn
+        try:
+            if self.slots is None:
+                units = handler(self.get_client(), unit)
+            else:
+                with self.slots.slot(self.owner):
+                    units = handler(self.get_client(), unit)
+        except Exception as e:
+            logging.error("Work unit {} failed: {}".format(unit, e))
+            with self.lock:
+                self.failed.append(unit)
+            return []
+
+        if units:
+            with self.lock:
+                self.total += len(units) - 1
+            logging.info("Work unit {} split into {}".format(unit, len(units)))
+            return units
+
+        with self.lock:
+            self.done += 1
+            logging.info("Work unit {}/{} done: {}".format(self.done, self.total, unit))
+        return []
+
+    def run(self, units, handler):
+
+        units = list(units)
+        self.total = len(units)
+        logging.info(
+            "Running {} work units with {} worker(s)".format(self.total, self.workers)
+        )
+
+        ### Dispatch every unit to the pool, and the units replacing a split
+        ### one as soon as it returns, until all of them are finished
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            running = set(executor.submit(self.run_unit, u, handler) for u in units)
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for unit in future.result():
+                        running.add(executor.submit(self.run_unit, unit, handler))
+
+        logging.info(
+            "Work units finished: {} done, {} failed".format(
+                self.done, len(self.failed)
+            )
+        )
+        return self.failed
+
+
+### One step of the nightly run, with the tables it reads and writes
+Stage = collections.namedtuple('Stage', ['name', 'func', 'inputs', 'outputs'])
+
+
+class StageScheduler:
+    def __init__(self, stages):
+
+        self.stages = collections.OrderedDict((stage.name, stage) for stage in stages)
+        self.results = {}
+        self.durations = {}
+        self.spans = {}
+        self.failed = []
+        self.blocked = []
+
+        ### A stage depends on every other stage writing one of its inputs
+        self.depends = {}
+        for stage in self.stages.values():
+            self.depends[stage.name] = set(
+                other.name
+                for other in self.stages.values()
+                if other.name != stage.name and set(other.outputs) & set(stage.inputs)
+            )
+
+    def select(self, names=None, skip=None):
+
+        selected = list(names or self.stages)
+        unknown = set(selected) | set(skip or [])
+        unknown -= set(self.stages)
+        if unknown:
+            raise Exception("Unknown stage(s): {}".format(', '.join(sorted(unknown))))
+        return [
+            name
+            for name in self.stages
+            if name in selected and name not in (skip or [])
+        ]
+
+    def run_stage(self, name):
+
+        start = time.monotonic()
+        logging.info("Stage '{}' started".format(name))
+        try:
+            self.results[name] = self.stages[name].func()
+        finally:
+            self.spans[name] = (start, time.monotonic())
+            self.durations[name] = self.spans[name][1] - start
+            logging.info(
+                "Stage '{}' finished in {:.0f}s".format(name, self.durations[name])
+            )
+
+    def run(self, names=None, skip=None):
+
+        ### Stages left out of the selection count as already satisfied
+        pending = set(self.select(names, skip))
+        running = {}
+        start = time.monotonic()
+        logging.info("Running stages: {}".format(', '.join(sorted(pending))))
+
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            while pending or running:
+
+                ### Submit every stage whose dependencies are all done
+                for name in [n for n in self.stages if n in pending]:
+                    depends = self.depends[name] & (pending | set(running.values()))
+                    failed = self.depends[name] & set(self.failed + self.blocked)
+                    if failed:
+                        logging.error(
+                            "Stage '{}' skipped, failed dependencies: {}".format(
+                                name, ', '.join(sorted(failed))
+                            )
+                        )
+                        pending.discard(name)
+                        self.blocked.append(name)
+                    elif not depends:
+                        pending.discard(name)
+                        running[executor.submit(self.run_stage, name)] = name
+
+                if not running:
+                    if pending:
+                        raise Exception(
+                            "Stage dependencies form a cycle: {}".format(
+                                ', '.join(sorted(pending))
+                            )
+                        )
+                    continue
+
+                ### Wait for any running stage to finish
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.exception("Stage '{}' failed: {}".format(name, e))
+                        self.failed.append(name)
+
+        logging.info(
+            "Stages finished in {:.0f}s ({:.0f}s if run in sequence), "
+            "{} failed, {} skipped".format(
+                time.monotonic() - start,
+                sum(self.durations.values()),
+                len(self.failed),
+                len(self.blocked),
+            )
+        )
+        return self.failed + self.blocked
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import uuid
+
+### Largest Parquet file written by Snowflake, BigQuery loads them in parallel
+MAX_FILE_SIZE = 256 * 1024 * 1024
+
+
+class UnloadStage:
+    def __init__(self, name, url):
+
+        ### A Snowflake external stage and the bucket path it points to,
+        ### e.g. '@SEARCH_REPORTING_UNLOAD' and 'gs://bucket/unload'
+        self.name = name if name.startswith('@') else '@' + name
+        self.url = url.rstrip('/')
+
+    def new_prefix(self, table_name):
+
+        ### Each unload gets its own folder, never mixed with another run
+        return '{}/{}'.format(table_name, uuid.uuid4().hex[:12])
+
+    def location(self, prefix):
+
+        return '{}/{}/'.format(self.name, prefix)
+
+    def uri(self, prefix):
+
+        return '{}/{}/*'.format(self.url, prefix)
+
+    def unload_query(self, query, prefix):
+
+        ### Snowflake writes the result straight to the stage, as Parquet
+        return """
+        COPY INTO {0}
+        FROM ({1})
+        FILE_FORMAT = (TYPE = PARQUET COMPRESSION = SNAPPY)
+        HEADER = TRUE
+        OVERWRITE = TRUE
+        MAX_FILE_SIZE = {2}
+        """.format(
+            self.location(prefix), query.strip(), MAX_FILE_SIZE
+        )
+
+    def remove_query(self, prefix):
+
+        return "REMOVE {0}".format(self.location(prefix))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import io
+import csv
+import gzip
+import datetime
+import threading
+from google.api_core import exceptions
+
+### The BigQuery Storage Write API is optional. Without it, every batch goes
+### through a load job.
+try:
+    from google.cloud import bigquery_storage_v1
+    from google.cloud.bigquery_storage_v1 import types
+    from google.protobuf import descriptor_pb2
+    from google.protobuf import descriptor_pool
+    from google.protobuf import message_factory
+except ImportError:
+    bigquery_storage_v1 = None
+
+### Load project modules
+import metrics
+
+### Tables whose batches may be streamed instead of loaded
+STREAM_TABLES = ['adw_keywords', 'adw_gclid_list', 'adw_kw_names']
+
+### An AppendRows request must stay under 10 MB
+MAX_REQUEST_BYTES = 8 * 1024 * 1024
+
+### Storage Write API encoding of the BigQuery columns
+EPOCH = datetime.date(1970, 1, 1)
+PROTO_TYPES = {
+    'STRING': 'TYPE_STRING',
+    'INTEGER': 'TYPE_INT64',
+    'FLOAT': 'TYPE_DOUBLE',
+    'DATE': 'TYPE_INT32',
+    'TIMESTAMP': 'TYPE_INT64',
+    'DATETIME': 'TYPE_STRING',
+}
+
+
+def message_class(descriptor_proto):
+
+    ### Message class of a self-describing row descriptor
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name='{}.proto'.format(descriptor_proto.name), syntax='proto2'
+    )
+    file_proto.message_type.add().CopyFrom(descriptor_proto)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return message_factory.GetMessageClass(
+        pool.FindMessageTypeByName(descriptor_proto.name)
+    )
+
+
+def row_descriptor(schema):
+
+    descriptor_proto = descriptor_pb2.DescriptorProto(name='Row')
+    for number, field in enumerate(schema, 1):
+        descriptor_proto.field.add(
+            name=field.name,
+            number=number,
+            type=getattr(
+                descriptor_pb2.FieldDescriptorProto, PROTO_TYPES[field.field_type]
+            ),
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+        )
+    return descriptor_proto
+
+
+def date_value(value):
+
+    return (datetime.date.fromisoformat(value[:10]) - EPOCH).days
+
+
+def timestamp_value(value):
+
+    timestamp = datetime.datetime.fromisoformat(value.replace(' UTC', ''))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return int(timestamp.timestamp() * 1000000)
+
+
+### Conversion of the CSV values of each column type, strings are kept as is
+CONVERTERS = {
+    'INTEGER': int,
+    'FLOAT': float,
+    'DATE': date_value,
+    'TIMESTAMP': timestamp_value,
+}
+
+
+class StorageWriter:
+    def __init__(
+        self, bq_client, dataset_name, write_client=None, max_bytes=0, run_metrics=None
+    ):
+
+        ### Batches up to max_bytes (uncompressed) of the streamable tables
+        ### are appended to a pending stream, committed in one go
+        self.bq_client = bq_client
+        self.dataset_name = dataset_name
+        self.max_bytes = max_bytes
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.write_client = write_client
+        if write_client is None and bigquery_storage_v1 is not None:
+            self.write_client = bigquery_storage_v1.BigQueryWriteClient()
+        self.lock = threading.Lock()
+        self.classes = {}
+
+    def accepts(self, table_name, nb_bytes):
+
+        return (
+            self.write_client is not None
+            and table_name in STREAM_TABLES
+            and 0 < nb_bytes <= self.max_bytes
+        )
+
+    def table_path(self, table_name):
+
+        return self.write_client.table_path(
+            self.bq_client.project, self.dataset_name, table_name
+        )
+
+    def row_class(self, schema):
+
+        key = tuple((field.name, field.field_type) for field in schema)
+        with self.lock:
+            if key not in self.classes:
+                descriptor_proto = row_descriptor(schema)
+                self.classes[key] = (descriptor_proto, message_class(descriptor_proto))
+            return self.classes[key]
+
+    def serialize(self, report_data, schema):
+
+        ### Compressed CSV rows as serialized protocol buffers. Empty values
+        ### are left unset, i.e. NULL, as a CSV load job would.
+        row_class = self.row_class(schema)[1]
+        columns = [(f.name, CONVERTERS.get(f.field_type)) for f in schema]
+        report_data.seek(0)
+        source = io.TextIOWrapper(
+            gzip.GzipFile(fileobj=report_data, mode='rb'), encoding='utf-8', newline=''
+        )
+        try:
+            for values in csv.reader(source):
+                if not values:
+                    continue
+                fields = {}
+                for (name, convert), value in zip(columns, values):
+                    if value != '':
+                        fields[name] = convert(value) if convert else value
+                yield row_class(**fields).SerializeToString()
+        finally:
+            source.close()
+
+    def requests(self, stream_name, report_data, schema, event):
+
+        ### The schema goes with the first request only. Offsets make a
+        ### request sent twice fail instead of appending its rows again.
+        descriptor_proto = self.row_class(schema)[0]
+        rows = []
+        size = 0
+        first = True
+        for serialized in self.serialize(report_data, schema):
+            rows.append(serialized)
+            size += len(serialized)
+            if size >= MAX_REQUEST_BYTES:
+                yield self.request(stream_name, descriptor_proto, rows, event, first)
+                first = False
+                rows = []
+                size = 0
+        if rows or first:
+            yield self.request(stream_name, descriptor_proto, rows, event, first)
+
+    def request(self, stream_name, descriptor_proto, rows, event, first):
+
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.rows = types.ProtoRows(serialized_rows=rows)
+        if first:
+            proto_data.writer_schema = types.ProtoSchema(
+                proto_descriptor=descriptor_proto
+            )
+        request = types.AppendRowsRequest(offset=event['rows'], proto_rows=proto_data)
+        if first:
+            request.write_stream = stream_name
+        event['rows'] += len(rows)
+        event['bytes_out'] += sum(len(row) for row in rows)
+        return request
+
+    def append(self, table_name, report_data, schema):
+
+        ### Rows of a pending stream are invisible until committed
+        with self.metrics.timer('adwords', 'bq_stream', table=table_name) as event:
+            write_stream = self.write_client.create_write_stream(
+                parent=self.table_path(table_name),
+                write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING),
+            )
+            responses = self.write_client.append_rows(
+                requests=self.requests(write_stream.name, report_data, schema, event),
+                metadata=(
+                    ('x-goog-request-params', 'write_stream=' + write_stream.name),
+                ),
+            )
+            for response in responses:
+                if response.error.code or response.row_errors:
+                    raise Exception(
+                        "Append to stream of table '{}' failed: {} {}".format(
+                            table_name, response.error.message, response.row_errors
+                        )
+                    )
+            self.write_client.finalize_write_stream(name=write_stream.name)
+        logging.info(
+            "{} row(s) appended to a pending stream of table '{}.{}'".format(
+                event['rows'], self.dataset_name, table_name
+            )
+        )
+        return write_stream.name
+
+    def commit(self, table_name, stream_names):
+
+        response = self.write_client.batch_commit_write_streams(
+            types.BatchCommitWriteStreamsRequest(
+                parent=self.table_path(table_name), write_streams=stream_names
+            )
+        )
+        if response.stream_errors:
+            raise Exception(
+                "Commit to table '{}' failed: {}".format(
+                    table_name, response.stream_errors
+                )
+            )
+        logging.info(
+            "Stream(s) committed to table '{}.{}'".format(self.dataset_name, table_name)
+        )
+
+    def is_committed(self, stream_name):
+
+        try:
+            write_stream = self.write_client.get_write_stream(name=stream_name)
+        except exceptions.NotFound:
+            return False
+        return bool(write_stream.commit_time)
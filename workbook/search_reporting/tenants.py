@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import logging
+import os
+import json
+import time
+import datetime
+import inspect
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+### Load project modules
+import connections
+import metrics
+import scheduler
+
+### Keys of a tenant in the batch file, other options go under 'options'
+TENANT_KEYS = [
+    'name',
+    'mcc',
+    'dataset',
+    'snow_source',
+    'export_bucket',
+    'google',
+    'snow',
+    'options',
+]
+
+### Files written by a run, kept in one directory per tenant
+PATH_OPTIONS = [
+    'manifest_path',
+    'kw_cache_path',
+    'accounts_cache_path',
+    'metrics_json',
+    'metrics_prom',
+    'query_cache_path',
+    'local_dir',
+    'gclid_filter_path',
+    'adperf_volumes_path',
+]
+
+
+def load_tenants(path):
+
+    ### A YAML list of tenants, with optional defaults applied to each of them:
+    ###   defaults: {snow_source: ADWORDS_GCLID_AGGREGATION}
+    ###   tenants:
+    ###     - {name: site1, mcc: '1234567890', dataset: site1, export_bucket: b1}
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    defaults = config.get('defaults') or {}
+    tenants = []
+    for entry in config.get('tenants') or []:
+        tenant = dict(defaults, **entry)
+        unknown = set(tenant) - set(TENANT_KEYS)
+        if unknown:
+            raise Exception(
+                "Unknown tenant key(s): {}".format(', '.join(sorted(unknown)))
+            )
+        for key in ['mcc', 'dataset']:
+            if not tenant.get(key):
+                raise Exception("Tenant without '{}': {}".format(key, entry))
+        tenant['mcc'] = str(tenant['mcc'])
+        tenant.setdefault('name', tenant['dataset'])
+        tenants.append(tenant)
+    names = [tenant['name'] for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise Exception("Tenant names must be unique: {}".format(', '.join(names)))
+    if not tenants:
+        raise Exception("No tenant found in '{}'".format(path))
+    return tenants
+
+
+def tenant_options(run, tenant, options, work_dir):
+
+    ### Batch options, then the tenant's own, with the files of the run
+    ### (given or default) moved to the tenant directory
+    options = dict(options, **(tenant.get('options') or {}))
+    directory = os.path.join(work_dir, tenant['name'])
+    os.makedirs(directory, exist_ok=True)
+    defaults = inspect.signature(run).parameters
+    for key in PATH_OPTIONS:
+        path = options.get(key, defaults[key].default)
+        if path:
+            options[key] = os.path.join(directory, os.path.basename(path))
+    for key in ['snow_source', 'export_bucket']:
+        if tenant.get(key):
+            options[key] = tenant[key]
+    return options
+
+
+def run_batch(
+    run,
+    tenants,
+    date_from,
+    date_until,
+    google_yaml,
+    snow_yaml,
+    options=None,
+    slots=4,
+    work_dir='tenants',
+    summary_path='batch_summary.json',
+):
+
+    ### All tenants run at the same time in one process. They share the
+    ### clients, and their Adwords units and other stages share the slots.
+    batch_metrics = metrics.RunMetrics({'tenants': len(tenants)})
+    pool = connections.ClientPool(google_yaml, batch_metrics)
+    fair_slots = scheduler.FairSemaphore(slots)
+    summary = {}
+
+    def run_tenant(tenant):
+
+        start = time.monotonic()
+        result = {
+            'mcc': tenant['mcc'],
+            'dataset': tenant['dataset'],
+            'started': datetime.datetime.now().isoformat(),
+            'status': 'done',
+            'error': None,
+        }
+        stages = None
+        try:
+            stages = run(
+                tenant['mcc'],
+                date_from,
+                date_until,
+                tenant['dataset'],
+                tenant.get('google') or google_yaml,
+                tenant.get('snow') or snow_yaml,
+                pool=pool,
+                slots=fair_slots,
+                tenant=tenant['name'],
+                **tenant_options(run, tenant, options or {}, work_dir)
+            )
+        except Exception as e:
+            logging.exception("Tenant '{}' failed: {}".format(tenant['name'], e))
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            stages = getattr(e, 'stages', None)
+        result['seconds'] = round(time.monotonic() - start, 3)
+        result['slot_wait_seconds'] = round(fair_slots.waited[tenant['name']], 3)
+        if stages is not None:
+            result['stages'] = {k: round(v, 3) for k, v in stages.durations.items()}
+            result['failed_stages'] = stages.failed + stages.blocked
+        summary[tenant['name']] = result
+
+    logging.info(
+        "Running {} tenant(s) with {} shared slot(s)".format(len(tenants), slots)
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=len(tenants)) as executor:
+            for future in [executor.submit(run_tenant, t) for t in tenants]:
+                future.result()
+    finally:
+        pool.close()
+        batch_metrics.log_startup()
+
+    ### One summary for the whole batch, in the order of the batch file
+    failed = [name for name, result in summary.items() if result['status'] != 'done']
+    report = {
+        'started': batch_metrics.started.isoformat(),
+        'finished': datetime.datetime.now().isoformat(),
+        'seconds': round(time.monotonic() - batch_metrics.start, 3),
+        'slots': slots,
+        'startup': batch_metrics.totals(('operation', 'component')),
+        'tenants': {t['name']: summary.get(t['name']) for t in tenants},
+    }
+    if summary_path:
+        batch_metrics.write_file(summary_path, json.dumps(report, indent=1))
+        logging.info("Batch summary written to '{}'".format(summary_path))
+    for tenant in tenants:
+        result = summary[tenant['name']]
+        logging.info(
+            "Tenant '{}': {} in {:.0f}s, units waited {:.0f}s for a slot".format(
+                tenant['name'],
+                result['status'],
+                result['seconds'],
+                result['slot_wait_seconds'],
+            )
+        )
+    if failed:
+        raise Exception("Tenant(s) not completed: {}".format(', '.join(failed)))
+    return report
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import pyarrow as pa
+
+### Load project modules
+import bq_reader
+
+HEADER = 'Parameters:TimeZone=Europe/Paris\nGoogle Click ID,Conversion Value\n'
+
+
+def batch(start, nb_rows):
+
+    return pa.record_batch(
+        [
+            pa.array(['gclid-{:04d}'.format(i) for i in range(start, start + nb_rows)]),
+            pa.array([float(i) for i in range(start, start + nb_rows)]),
+        ],
+        names=['GclId', 'ConversionValue'],
+    )
+
+
+def shard_rows(shard):
+
+    lines = shard.getvalue().decode('utf-8').splitlines()
+    assert '\n'.join(lines[:2]) + '\n' == HEADER
+    return lines[2:]
+
+
+def test_shards_hold_at_most_max_rows():
+
+    writer = bq_reader.CsvShardWriter(HEADER, max_rows=4, max_bytes=1024 * 1024)
+    shards = writer.write_batches([batch(0, 3), batch(3, 7)])
+    assert [len(shard_rows(shard)) for shard in shards] == [4, 4, 2]
+    rows = [row for shard in shards for row in shard_rows(shard)]
+    assert rows[0] == '"gclid-0000",0'
+    assert rows[-1] == '"gclid-0009",9'
+    assert writer.rows == 10
+
+
+def test_shards_hold_at_most_max_bytes():
+
+    max_bytes = len(HEADER) + 60
+    writer = bq_reader.CsvShardWriter(HEADER, max_rows=1000, max_bytes=max_bytes)
+    shards = writer.write_batches([batch(0, 10)])
+    assert len(shards) > 1
+    assert all(len(shard.getvalue()) <= max_bytes for shard in shards)
+    assert sum(len(shard_rows(shard)) for shard in shards) == 10
+
+
+def test_batches_kept_as_a_table():
+
+    writer = bq_reader.CsvShardWriter(HEADER, 100, 1024 * 1024, keep_batches=True)
+    writer.write_batches([batch(0, 2), batch(2, 3)])
+    assert writer.table().num_rows == 5
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import io
+import gzip
+import hashlib
+
+### Load project modules
+import buffers
+
+
+def test_buffer_spills_past_max_memory():
+
+    content = ''.join('row {}\n'.format(i) for i in range(20000))
+    report_data = buffers.ReportBuffer(max_memory=1024)
+    report_data.write(content)
+    raw = report_data.finish()
+    assert raw._rolled
+    assert gzip.decompress(raw.read()).decode('utf-8') == content
+    assert report_data.getvalue() == content
+    assert report_data.size == len(content)
+    assert report_data.lines == 20000
+    assert 0 < report_data.compressed_size < report_data.size
+
+
+def test_buffer_stays_in_memory_below_max_memory():
+
+    report_data = buffers.ReportBuffer(max_memory=1024 * 1024)
+    report_data.write('a,b\n')
+    assert not report_data.finish()._rolled
+
+
+def test_checksum_of_content_written():
+
+    report_data = buffers.ReportBuffer()
+    report_data.write('a,b\n')
+    report_data.write('c,d\n')
+    expected = hashlib.sha256(b'a,b\nc,d\n').hexdigest()
+    assert report_data.checksum() == expected
+
+
+def test_write_from_ends_every_report_with_a_newline():
+
+    first = buffers.ReportBuffer()
+    first.write('a,b')
+    second = buffers.ReportBuffer()
+    second.write('c,d\n')
+    batch = buffers.ReportBuffer()
+    batch.write_from(first)
+    batch.write_from(second)
+    assert batch.getvalue() == 'a,b\nc,d\n'
+
+
+def test_write_stream_decodes_characters_split_across_chunks(monkeypatch):
+
+    monkeypatch.setattr(buffers, 'CHUNK_SIZE', 3)
+    content = 'chaussures été,1\nbottes,2\n'
+    report_data = buffers.ReportBuffer()
+    report_data.write_stream(io.BytesIO(content.encode('utf-8')))
+    assert report_data.getvalue() == content
+    expected = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    assert report_data.checksum() == expected
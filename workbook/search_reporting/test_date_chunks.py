@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import socket
+
+### Load project modules
+import date_chunks
+
+
+def test_split_dates_cuts_runs_of_consecutive_dates():
+
+    dates = [
+        '2026-01-01',
+        '2026-01-02',
+        '2026-01-03',
+        '2026-01-04',
+        '2026-01-05',
+        '2026-01-08',
+    ]
+    assert date_chunks.split_dates(reversed(dates), 2) == [
+        ('2026-01-01', '2026-01-02'),
+        ('2026-01-03', '2026-01-04'),
+        ('2026-01-05', '2026-01-05'),
+        ('2026-01-08', '2026-01-08'),
+    ]
+
+
+def test_split_dates_at_least_one_day():
+
+    assert date_chunks.split_dates(['2026-01-01', '2026-01-02'], 0) == [
+        ('2026-01-01', '2026-01-01'),
+        ('2026-01-02', '2026-01-02'),
+    ]
+
+
+def test_halve_covers_the_range():
+
+    assert date_chunks.halve('2026-01-01', '2026-01-05') == [
+        ('2026-01-01', '2026-01-02'),
+        ('2026-01-03', '2026-01-05'),
+    ]
+    assert date_chunks.halve('2026-01-31', '2026-02-01') == [
+        ('2026-01-31', '2026-01-31'),
+        ('2026-02-01', '2026-02-01'),
+    ]
+    assert date_chunks.halve('2026-01-01', '2026-01-01') is None
+
+
+def test_is_timeout():
+
+    assert date_chunks.is_timeout(socket.timeout("The read operation timed out"))
+    assert date_chunks.is_timeout(Exception("DEADLINE_EXCEEDED"))
+    assert not date_chunks.is_timeout(Exception("RateExceededError"))
+
+
+def test_chunk_days_follow_recorded_volumes(tmp_path):
+
+    path = str(tmp_path / 'volumes.json')
+    volumes = date_chunks.ReportVolumes(path, chunk_rows=1000, default_days=7)
+    assert volumes.chunk_days(1) == 7
+    volumes.record(1, 2000, 10)
+    assert volumes.chunk_days(1) == 5
+    assert date_chunks.ReportVolumes(path, chunk_rows=1000).chunk_days(1) == 5
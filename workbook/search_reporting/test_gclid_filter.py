@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import csv
+
+### Load project modules
+import buffers
+import gclid_filter
+
+
+def report(rows):
+
+    report_data = buffers.ReportBuffer()
+    csv.writer(report_data, lineterminator='\n').writerows(rows)
+    return report_data
+
+
+def test_filter_membership_and_file(tmp_path):
+
+    converting = gclid_filter.GclidFilter()
+    for gclid in ['g2', 'g1', 'g2']:
+        converting.add(gclid)
+    converting.add('')
+    converting.freeze()
+    assert len(converting) == 2
+    assert 'g1' in converting and 'g3' not in converting
+
+    path = str(tmp_path / 'gclid_filter.bin')
+    converting.save(path)
+    loaded = gclid_filter.GclidFilter.load(path)
+    assert list(loaded.hashes) == list(converting.hashes)
+
+
+def test_prune_clicks_sums_other_clicks_per_key():
+
+    click = ['Site1', 'SEA-a', '1', '2', '3', '2026-01-01', 'Computers']
+    rows = [
+        click + ['g1', '1', '100'],
+        click + ['g2', '1', '100'],
+        click + ['g3', '2', '100'],
+        click + ['g4', '1', '200'],
+        click[:-1] + ['Tablets', 'g5', '1', '100'],
+    ]
+    converting = gclid_filter.GclidFilter()
+    converting.add('g1')
+    converting.freeze()
+
+    event = {}
+    pruned = gclid_filter.prune_clicks(report(rows), converting, event=event)
+    result = list(csv.reader(pruned.getvalue().splitlines()))
+    assert result == [
+        click + ['g1', '1', '100'],
+        click + ['', '3', '100'],
+        click + ['', '1', '200'],
+        click[:-1] + ['Tablets', '', '1', '100'],
+    ]
+    assert event['rows'] == 5
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import io
+import datetime
+
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+### Load project modules
+import fakes
+import join_backends
+
+pytest.importorskip('duckdb')
+
+DAY = datetime.date(2026, 1, 2)
+KEYWORD = {
+    'AccountDescriptiveName': 'Site1 Account',
+    'CampaignName': 'SEA-partner-shoes',
+    'CampaignId': '10',
+    'AdGroupName': 'Shoes',
+    'AdGroupId': '100',
+    'AdGroupStatus': 'enabled',
+    'CreativeId': '1000',
+    'Device': 'Computers',
+    'Cost': 2500000.0,
+    'Impressions': 100,
+    'Clicks': 3,
+    'Conversions': 1.0,
+    'AveragePosition': '1.5',
+    'ExternalCustomerId': '1',
+}
+
+
+def table(table_name, rows):
+
+    schema = join_backends.arrow_schema(table_name)
+    return pa.Table.from_pylist(
+        [{name: row.get(name) for name in schema.names} for row in rows], schema
+    )
+
+
+def make_sink(tmp_path):
+
+    sink = join_backends.LocalSink(str(tmp_path / 'local_tables'))
+    sink.write_table(
+        'adw_keywords',
+        table(
+            'adw_keywords',
+            [
+                dict(KEYWORD, KeywordId='1', Date=DAY),
+                dict(KEYWORD, KeywordId='2', Date=DAY),
+                dict(KEYWORD, KeywordId='1', Date=DAY - datetime.timedelta(1)),
+            ],
+        ),
+    )
+    click = dict(KEYWORD, AccountName='Site1 Account', KeywordId='1', Date=DAY)
+    sink.write_table(
+        'adw_gclid_list',
+        table(
+            'adw_gclid_list',
+            [
+                dict(click, GclId='g1', Clicks=1),
+                dict(click, GclId='g2', Clicks=1),
+                dict(click, GclId='g3', Clicks=1),
+            ],
+        ),
+    )
+    sink.write_table(
+        'adw_kw_names',
+        table(
+            'adw_kw_names',
+            [
+                {'AdGroupId': '100', 'KeywordId': '1', 'Keyword': 'shoes'},
+                {'AdGroupId': '100', 'KeywordId': '1', 'Keyword': 'boots'},
+                {'AdGroupId': '100', 'KeywordId': '2', 'Keyword': 'sandals'},
+            ],
+        ),
+    )
+    sink.write_table(
+        'snow_conversions',
+        table(
+            'snow_conversions',
+            [
+                {
+                    'TRACKING_GCLID': 'g1',
+                    'ORDERS': 2,
+                    'REVENUE': 10.5,
+                    'SALES_VALUE': 40.0,
+                },
+                {
+                    'TRACKING_GCLID': 'g3',
+                    'ORDERS': 1,
+                    'REVENUE': 4.25,
+                    'SALES_VALUE': 12.0,
+                },
+                {'TRACKING_GCLID': 'g9', 'ORDERS': 5, 'REVENUE': 1.0},
+            ],
+        ),
+    )
+    return sink
+
+
+def test_local_join_rows(tmp_path):
+
+    sink = make_sink(tmp_path)
+    backend = join_backends.DuckDBBackend(
+        sink, fakes.FakeBigQueryClient(fakes.SyntheticData(1, 1, 1, 1, 1)), 'test'
+    )
+    path = backend.run_join(str(DAY), str(DAY))
+    rows = sorted(pq.read_table(path).to_pylist(), key=lambda row: row['Keyword'])
+    expected = {
+        'Site': 'ST1',
+        'AccountName': 'Site1 Account',
+        'CampaignName': 'SEA-partner-shoes',
+        'CampaignType': 'SEA',
+        'Partner': 'partner',
+        'AdGroupName': 'Shoes',
+        'CreativeId': '1000',
+        'Device': 'Computers',
+        'Date': DAY,
+        'Cost': 2.5,
+        'Impressions': 100,
+        'Clicks': 3,
+        'Conversions': 1.0,
+        'AveragePosition': 1.5,
+    }
+    assert rows == [
+        dict(expected, Keyword='boots', Orders=3, Revenue=14.75, SalesValue=52.0),
+        dict(expected, Keyword='sandals', Orders=None, Revenue=None, SalesValue=None),
+    ]
+
+
+def test_unit_written_again_replaces_its_file(tmp_path):
+
+    sink = join_backends.LocalSink(str(tmp_path / 'local_tables'))
+    row = dict(KEYWORD, AccountName='Site1 Account', KeywordId='1', Date=DAY)
+    line = ','.join(
+        str(row.get(name, ''))
+        for name in join_backends.arrow_schema('adw_gclid_list').names
+    )
+    for _ in range(2):
+        sink.write('adw_gclid_list', io.StringIO(line + '\n'), name='adwords/1/gclid')
+    files = sink.files('adw_gclid_list')
+    assert len(files) == 1
+    assert pq.read_table(files[0]).num_rows == 1
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+### Load project modules
+import manifest
+
+PARAMS = {'from': '2026-01-01', 'to': '2026-01-07', 'dataset': 'test'}
+
+
+def test_resume_keeps_done_units(tmp_path):
+
+    path = str(tmp_path / 'run_manifest.json')
+    run_manifest = manifest.RunManifest(path, PARAMS)
+    run_manifest.mark_done('snowflake', manifest.checksum('rows'), mode='full')
+    run_manifest.mark('adwords/1/gclid/2026-01-01', 'failed', error='timeout')
+
+    resumed = manifest.RunManifest(path, PARAMS, resume=True)
+    assert resumed.is_done('snowflake')
+    assert resumed.get('snowflake')['mode'] == 'full'
+    assert resumed.get('snowflake')['checksum'] == manifest.checksum('rows')
+    assert resumed.keys('failed', 'adwords/') == ['adwords/1/gclid/2026-01-01']
+    assert not resumed.is_done('adwords/1/gclid/2026-01-01')
+
+
+def test_new_run_without_resume_or_with_other_params(tmp_path):
+
+    path = str(tmp_path / 'run_manifest.json')
+    manifest.RunManifest(path, PARAMS).mark_done('snowflake')
+    assert not manifest.RunManifest(path, PARAMS).is_done('snowflake')
+
+    manifest.RunManifest(path, PARAMS).mark_done('snowflake')
+    other = dict(PARAMS, to='2026-01-08')
+    assert not manifest.RunManifest(path, other, resume=True).is_done('snowflake')
+
+
+def test_last_status_wins(tmp_path):
+
+    path = str(tmp_path / 'run_manifest.json')
+    run_manifest = manifest.RunManifest(path, PARAMS)
+    key = 'adwords/1/adperf/2026-01-01..2026-01-07'
+    run_manifest.mark(key, 'downloaded', 'abc')
+    run_manifest.mark_done(key)
+    resumed = manifest.RunManifest(path, PARAMS, resume=True)
+    assert resumed.done_keys('adwords/') == [key]
+    assert resumed.get(key)['checksum'] == 'abc'
+
+
+def test_journal_replayed_then_compacted(tmp_path):
+
+    path = str(tmp_path / 'run_manifest.json')
+    run_manifest = manifest.RunManifest(path, PARAMS)
+    run_manifest.mark_done('snowflake')
+    run_manifest.mark_done('join')
+    with open(path + '.journal', 'a') as f:
+        f.write('{"key": "export", "unit": {"sta')
+
+    resumed = manifest.RunManifest(path, PARAMS, resume=True)
+    assert resumed.done_keys() == ['snowflake', 'join']
+    assert not (tmp_path / 'run_manifest.json.journal').exists()
+    assert manifest.RunManifest(path, PARAMS, resume=True).is_done('join')
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+### Load libraries
+from google.cloud import bigquery
+
+### Load project modules
+import bq_create_tables
+import fakes
+import query_planner
+
+QUERY = "INSERT INTO `test.final_report` SELECT * FROM `test.adw_keywords`"
+
+
+class ScriptBigQueryClient(fakes.FakeBigQueryClient):
+
+    ### Dry runs of scripts report no referenced table
+    def query(self, query, job_config=None, **kwargs):
+
+        job = super().query(query, job_config, **kwargs)
+        if getattr(job_config, 'dry_run', False):
+            job.referenced_tables = []
+        return job
+
+
+def make_planner(client_class, tmp_path):
+
+    data = fakes.SyntheticData(1, 1, 10, 10, 10)
+    bq_client = client_class(data)
+    dataset_ref = bq_client.dataset('test')
+    bq_create_tables.create_table_adperf(bq_client, dataset_ref)
+    bq_create_tables.create_table_final(bq_client, dataset_ref)
+    return query_planner.QueryPlanner(
+        bq_client, cache_path=str(tmp_path / 'query_cache.json')
+    )
+
+
+def test_reuse_unchanged_inputs(tmp_path):
+
+    planner = make_planner(fakes.FakeBigQueryClient, tmp_path)
+    assert planner.run(QUERY, label='join', reuse=True) is not None
+    assert planner.run(QUERY, label='join', reuse=True) is None
+
+
+def test_no_reuse_without_input_tables(tmp_path):
+
+    planner = make_planner(ScriptBigQueryClient, tmp_path)
+    assert planner.run(QUERY, label='join', reuse=True) is not None
+    assert planner.run(QUERY, label='join', reuse=True) is not None
+    assert 'join' not in planner.cache
+
+
+def test_no_reuse_after_failed_dry_run(tmp_path, monkeypatch):
+
+    planner = make_planner(fakes.FakeBigQueryClient, tmp_path)
+    monkeypatch.setattr(planner, 'dry_run', lambda *args: (None, []))
+    job_config = bigquery.QueryJobConfig()
+    assert planner.run(QUERY, job_config, label='join', reuse=True)
+    assert planner.run(QUERY, job_config, label='join', reuse=True)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import time
+import threading
+
+import pytest
+
+### Load project modules
+import scheduler
+
+
+def wait_for(condition, timeout=5):
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition not met in {}s".format(timeout))
+        time.sleep(0.01)
+
+
+def test_freed_slot_goes_to_owner_holding_fewest():
+
+    slots = scheduler.FairSemaphore(2)
+    slots.acquire('a')
+    slots.acquire('a')
+    order = []
+
+    def take(owner):
+
+        slots.acquire(owner)
+        order.append(owner)
+
+    ### 'a' queued first, but already holds every slot
+    threads = []
+    for owner in ['a', 'b']:
+        thread = threading.Thread(target=take, args=(owner,))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: len(slots.waiters) == len(threads))
+
+    slots.release('a')
+    wait_for(lambda: order)
+    assert order == ['b']
+    slots.release('a')
+    for thread in threads:
+        thread.join(5)
+    assert order == ['b', 'a']
+    assert slots.in_use == 2
+
+
+def test_work_unit_split_runs_its_parts():
+
+    handled = []
+
+    def handler(client, unit):
+
+        handled.append(unit.date)
+        if unit.date == 'all':
+            return [
+                scheduler.WorkUnit(unit.account_id, unit.report, half)
+                for half in ['first', 'second']
+            ]
+
+    runner = scheduler.WorkUnitScheduler(2, client_factory=lambda: object())
+    failed = runner.run([scheduler.WorkUnit(1, 'adperf', 'all')], handler)
+    assert failed == []
+    assert sorted(handled) == ['all', 'first', 'second']
+    assert (runner.done, runner.total) == (2, 2)
+
+
+def test_work_unit_failure_is_reported():
+
+    def handler(client, unit):
+
+        raise Exception("download failed")
+
+    runner = scheduler.WorkUnitScheduler(1, client_factory=lambda: object())
+    unit = scheduler.WorkUnit(1, 'gclid', '2026-01-01')
+    assert runner.run([unit], handler) == [unit]
+
+
+def make_stages(order, fail=()):
+
+    def step(name):
+
+        def run():
+
+            if name in fail:
+                raise Exception("{} failed".format(name))
+            order.append(name)
+            return name
+
+        return run
+
+    return [
+        scheduler.Stage('join', step('join'), ['adwords', 'snow'], ['final']),
+        scheduler.Stage('adwords', step('adwords'), [], ['adwords']),
+        scheduler.Stage('snowflake', step('snowflake'), [], ['snow']),
+        scheduler.Stage('export', step('export'), ['snow'], []),
+    ]
+
+
+def test_stages_run_after_their_dependencies():
+
+    order = []
+    stages = scheduler.StageScheduler(make_stages(order))
+    assert stages.run() == []
+    assert order.index('join') > order.index('adwords')
+    assert order.index('join') > order.index('snowflake')
+    assert order.index('export') > order.index('snowflake')
+    assert stages.results['join'] == 'join'
+
+
+def test_failed_stage_blocks_its_dependents_only():
+
+    order = []
+    stages = scheduler.StageScheduler(make_stages(order, fail=['snowflake']))
+    assert stages.run() == ['snowflake', 'join', 'export']
+    assert order == ['adwords']
+
+
+def test_unselected_stages_count_as_done():
+
+    order = []
+    stages = scheduler.StageScheduler(make_stages(order))
+    assert stages.run(skip=['adwords', 'snowflake']) == []
+    assert sorted(order) == ['export', 'join']
+
+
+def test_dependency_cycle_is_refused():
+
+    stages = scheduler.StageScheduler(
+        [
+            scheduler.Stage('a', lambda: None, ['y'], ['x']),
+            scheduler.Stage('b', lambda: None, ['x'], ['y']),
+        ]
+    )
+    with pytest.raises(Exception, match='cycle'):
+        stages.run()
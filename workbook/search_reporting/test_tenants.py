@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+### Load libraries
+import os
+
+import pytest
+
+### Load project modules
+import tenants
+
+
+def run(
+    account,
+    date_from,
+    date_until,
+    dataset,
+    google_yaml,
+    snow_yaml,
+    manifest_path='run_manifest.json',
+    kw_cache_path='kw_names_cache.json',
+    accounts_cache_path='accounts_cache.json',
+    metrics_json=None,
+    metrics_prom=None,
+    query_cache_path='query_cache.json',
+    local_dir='local_tables',
+    gclid_filter_path='gclid_filter.bin',
+    adperf_volumes_path='adperf_volumes.json',
+    snow_source='ADWORDS_GCLID_AGGREGATION',
+    export_bucket='client_bucket',
+    workers=4,
+):
+
+    pass
+
+
+def test_tenant_files_moved_to_its_directory(tmp_path):
+
+    work_dir = str(tmp_path)
+    tenant = {
+        'name': 'site1',
+        'mcc': '123',
+        'dataset': 'site1',
+        'export_bucket': 'bucket1',
+        'options': {'workers': 2},
+    }
+    options = tenants.tenant_options(
+        run, tenant, {'manifest_path': '/var/run/manifest.json', 'workers': 8}, work_dir
+    )
+    directory = os.path.join(work_dir, 'site1')
+    assert os.path.isdir(directory)
+    assert options['manifest_path'] == os.path.join(directory, 'manifest.json')
+    assert options['kw_cache_path'] == os.path.join(directory, 'kw_names_cache.json')
+    assert options['local_dir'] == os.path.join(directory, 'local_tables')
+    assert 'metrics_json' not in options
+    assert options['workers'] == 2
+    assert options['export_bucket'] == 'bucket1'
+    assert 'snow_source' not in options
+
+
+def test_load_tenants_applies_defaults(tmp_path):
+
+    path = tmp_path / 'tenants.yaml'
+    path.write_text(
+        "defaults: {export_bucket: shared}\n"
+        "tenants:\n"
+        "  - {mcc: 123, dataset: site1}\n"
+        "  - {name: other, mcc: '456', dataset: site2, export_bucket: own}\n"
+    )
+    loaded = tenants.load_tenants(str(path))
+    assert [t['name'] for t in loaded] == ['site1', 'other']
+    assert [t['mcc'] for t in loaded] == ['123', '456']
+    assert [t['export_bucket'] for t in loaded] == ['shared', 'own']
+
+
+@pytest.mark.parametrize(
+    'entries, error',
+    [
+        ("  - {mcc: 1, dataset: a, color: red}\n", 'Unknown tenant key'),
+        ("  - {mcc: 1}\n", "without 'dataset'"),
+        ("  - {mcc: 1, dataset: a}\n  - {mcc: 2, dataset: a}\n", 'unique'),
+    ],
+)
+def test_load_tenants_refuses_invalid_batches(tmp_path, entries, error):
+
+    path = tmp_path / 'tenants.yaml'
+    path.write_text("tenants:\n" + entries)
+    with pytest.raises(Exception, match=error):
+        tenants.load_tenants(str(path))